@@ -0,0 +1,259 @@
+"""!
+Local benchmark suite on a synthetic tree (see `fos.synthetic`).
+
+Every benchmark times one step of the usual workflow on the fake data and tracks its
+memory: the peak of traced allocations (numpy included) and the process peak RSS.
+```
+fos benchmark --scale small --repeat 3 --output benchmarks.jsonl
+```
+Results are appended to a JSON-lines file, one line per benchmark and run, and
+`compare` prints the latest run against the previous results, so regressions show up.
+"""
+
+import gc
+import json
+import os
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from fos import instrument, synthetic
+from fos.catalog import WrfCatalog
+from fos.models import run_batched
+from fos.snowmetrics import water_year_metrics
+from fos.spatial import GridLocator, extract_sites
+from fos.util import (
+    _wrfread_gcm,
+    console,
+    get_wrf_from_shp,
+    make_time_lists,
+    screen_times_wrf,
+)
+from fos.zonal import basin_weights
+
+## the benchmarks in the order they run, each fills `state` for the next ones
+BENCHMARKS = [
+    "discover_files",
+    "open_screen",
+    "extract_points",
+    "extract_basins",
+    "zonal_basins",
+    "peak_metrics",
+    "site_metrics",
+    "fit_models",
+]
+
+
+def _discover_files(tree, state):
+    cat = WrfCatalog(tree["wrfdir"], path=os.path.join(state["workdir"], "catalog.pkl"))
+    cat.refresh(force=True)
+    state["nfiles"] = len(cat.table)
+
+
+def _open_screen(tree, state):
+    model, variant = tree["models"][0]
+    run = f"{model}_{variant}_historical_bc"
+    datadir = os.path.join(tree["wrfdir"], run, "postprocess")
+    data = _wrfread_gcm("hist", run, variant, datadir, "snow", "d02", use_store=False)
+    first, last = tree["years_hist"][0], tree["years_hist"][-1]
+    data = screen_times_wrf(data, [first, 1, 1], [last, 12, 31])
+    # load it, the open is lazy
+    state["data"] = data.load()
+
+
+def _extract_points(tree, state):
+    lat, lon, hgt = (state["grid"][name] for name in ("lat", "lon", "hgt"))
+    meta = pd.read_csv(os.path.join(tree["snoteldir"], "snotelmeta.csv"))
+    j, k, _ = GridLocator(lat, lon, hgt).query(meta.lat, meta.lon, elev=meta.elev)
+    points = extract_sites(state["data"], j, k)
+    state["points"] = points.assign_coords(site=meta.site_number.to_numpy())
+
+
+def _extract_basins(tree, state):
+    import geopandas as gpd
+
+    huc8 = gpd.read_file(os.path.join(tree["spatialdir"], "huc8.shp"))
+    lat, lon = state["grid"]["lat"], state["grid"]["lon"]
+    means = []
+    for i in range(len(huc8)):
+        _, _, values = get_wrf_from_shp(huc8.iloc[[i]], lat, lon, state["data"])
+        means.append(np.nanmean(values, axis=1) if values.size else None)
+    state["nbasins"] = sum(m is not None for m in means)
+
+
+def _zonal_basins(tree, state):
+    import geopandas as gpd
+
+    huc8 = gpd.read_file(os.path.join(tree["spatialdir"], "huc8.shp"))
+    lat, lon = state["grid"]["lat"], state["grid"]["lon"]
+    # the weights are built on the first run and loaded from disk on the repeats
+    weights = basin_weights(huc8, lat, lon, cachedir=state["workdir"])
+    means = weights.reduce(state["data"].chunk({"day": 365})).compute()
+    state["nbasins"] = int(means.notnull().any("day").sum())
+
+
+def _peak_metrics(tree, state):
+    water_year_metrics(state["data"].chunk({"day": 365}), threshold=1.0).compute()
+
+
+def _site_metrics(tree, state):
+    from fos.sitemetrics import build_site_metrics
+
+    meta = pd.read_csv(os.path.join(tree["snoteldir"], "snotelmeta.csv"))
+    model = tree["models"][0][0]
+    table, failures = build_site_metrics(
+        meta, datadir=tree["wrfts"][model], snoteldir=tree["snoteldir"], workers=1
+    )
+    assert len(failures) == 0, failures
+
+
+def _fit_models(tree, state):
+    points = state["points"].rename(day="date")
+    forcing = xr.Dataset({"SNOTEL_SWE": points})
+    obs = xr.Dataset({"SWE": points * 1.1 + 5})
+    years = tree["years_hist"]
+    split = years[len(years) // 2]
+    dates_lists = make_time_lists(
+        {
+            "train": (f"{years[0]}-01-01", f"{split}-09-30"),
+            "test": (f"{split}-10-01", f"{years[-1]}-11-30"),
+        }
+    )
+    for kind, params in [("linear", {}), ("poly", {"degree": 3})]:
+        run_batched(kind, forcing, obs, dates_lists, dict(params, vars=["SWE"]))
+
+
+_FUNCS = {name: globals()[f"_{name}"] for name in BENCHMARKS}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _measure(func, tree, state):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        func(tree, state)
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return seconds, peak
+
+
+def run_benchmarks(
+    root: str = None,
+    scale: str = "small",
+    repeat: int = 1,
+    benchmarks=None,
+    output: str = None,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """!
+    Generate (or reuse) a synthetic tree and time every benchmark on it.
+    @param root [str]: directory of the synthetic tree, a temporary one by default. An
+        existing tree written with the same scale and seed is reused.
+    @param scale [str]: a key of synthetic.SCALES.
+    @param repeat [int]: runs per benchmark, the fastest one is reported.
+    @param benchmarks [list]: names from BENCHMARKS, default all. The earlier ones
+        are still run (once, untimed) when later ones need their results.
+    @param output [str]: optional JSON-lines file the results are appended to.
+    @return pd.DataFrame with one row per benchmark: seconds (min), mean_seconds,
+        peak_traced (bytes), peak_rss (bytes) and run metadata.
+    """
+    selected = BENCHMARKS if benchmarks is None else [b for b in BENCHMARKS if b in benchmarks]
+    with tempfile.TemporaryDirectory() as tmp:
+        root = root or os.path.join(tmp, "tree")
+        tree = _tree(root, scale, seed)
+        lat, lon, hgt = _grid(tree["coorddir"])
+        state = dict(workdir=tmp, grid=dict(lat=lat, lon=lon, hgt=hgt))
+        run = dict(
+            run=f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:6]}",
+            commit=_git_commit(),
+            scale=scale,
+            shape=list(tree["shape"]),
+            nsites=tree["nsites"],
+            years=tree["years"],
+        )
+        rows = []
+        last = max(BENCHMARKS.index(b) for b in selected)
+        for name in BENCHMARKS[: last + 1]:
+            if name not in selected:
+                _FUNCS[name](tree, state)
+                continue
+            timings = [_measure(_FUNCS[name], tree, state) for _ in range(repeat)]
+            seconds = [t for t, _ in timings]
+            row = dict(
+                run,
+                benchmark=name,
+                seconds=min(seconds),
+                mean_seconds=float(np.mean(seconds)),
+                peak_traced=max(p for _, p in timings),
+                peak_rss=instrument.peak_rss(),
+            )
+            console.log(f"{name}: {row['seconds']:.3f} s, {row['peak_traced'] / 2**20:.1f} MiB")
+            rows.append(row)
+
+    if output is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, "a") as fh:
+            for row in rows:
+                fh.write(json.dumps(row) + "\n")
+    return pd.DataFrame(rows)
+
+
+def _grid(coorddir):
+    with xr.open_dataset(os.path.join(coorddir, "wrfinput_d02")) as ds:
+        return ds.XLAT[0].values, ds.XLONG[0].values, ds.HGT[0].values
+
+
+def _tree(root, scale, seed):
+    """The tree at `root`, written unless one with the same scale and seed is there."""
+    spec = os.path.join(root, "synthetic.json")
+    try:
+        with open(spec) as fh:
+            tree = json.load(fh)
+        if tree.get("scale") == scale and tree.get("seed") == seed:
+            return tree
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+    tree = synthetic.make_fake_tree(root, scale=scale, seed=seed)
+    tree.update(scale=scale, seed=seed, shape=list(tree["shape"]))
+    with open(spec, "w") as fh:
+        json.dump(tree, fh)
+    return tree
+
+
+def compare(path: str) -> pd.DataFrame:
+    """!
+    Latest run against the previous result of each of its benchmarks (same scale) in
+    a results file.
+    @return pd.DataFrame per benchmark with seconds and peak_traced of both runs and
+        their ratio (> 1 is slower or larger).
+    """
+    results = pd.read_json(path, lines=True)
+    latest = results.iloc[-1]
+    same = results[results.scale == latest.scale]
+    now = same[same.run == latest.run].set_index("benchmark")[["seconds", "peak_traced"]]
+    before = same[same.run != latest.run].groupby("benchmark").last()
+    table = now.join(before[["seconds", "peak_traced"]], rsuffix="_before", how="left")
+    table["seconds_ratio"] = table.seconds / table.seconds_before
+    table["peak_ratio"] = table.peak_traced / table.peak_traced_before
+    return table
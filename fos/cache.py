@@ -0,0 +1,295 @@
+"""!
+Disk cache for expensive function calls, replacing a bare `joblib.Memory`.
+
+Differences with joblib.Memory:
+- the key can include the state of input files: every argument named in `inputs`
+  contributes the mtime and size of the file, or of every file below a directory,
+  or a hash of the contents with `hash_inputs=True`. A cached `get_data(dpath)` with
+  `inputs=["dpath"]` is recomputed when `dpath` changes. Other string arguments are
+  plain values, even when they happen to name a path.
+- the cache is bounded: after every write the least recently used entries are
+  removed until the total size is under `max_bytes` (FOS_CACHE_MAX_BYTES).
+- hits, misses and bytes read/written are counted in `stats.json`, updated under a
+  file lock so concurrent worker processes do not lose counts.
+
+```
+from fos.util import memory
+
+@memory.cache(inputs=["dpath"])
+def get_data(dpath):
+    ...
+
+get_data(dpath)          # cached
+get_data.refresh(dpath)  # recompute and overwrite the entry
+get_data.call(dpath)     # bypass the cache entirely
+```
+`fos cache stats|prune|clear` manages the cache from the command line.
+"""
+
+import contextlib
+import functools
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import time
+
+import joblib
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, stats updates are then unlocked
+    fcntl = None
+
+## default size budget, override with FOS_CACHE_MAX_BYTES
+MAX_BYTES = 10 * 1024**3
+STATS_FILE = "stats.json"
+## bump when the entry layout changes
+CACHE_VERSION = 1
+_STATS_KEYS = ("hits", "misses", "bytes_read", "bytes_written", "evictions")
+
+
+def _file_digest(path, blocksize=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(blocksize), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def input_state(path: str, hash_inputs: bool = False) -> list:
+    """!
+    State of a file or of every file below a directory, as sorted
+    (relative path, mtime_ns, size) entries, or (relative path, sha256) with hash_inputs.
+    """
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        files = []
+        for root, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            files.extend(os.path.join(root, f) for f in sorted(filenames))
+    else:
+        files = [path]
+    state = []
+    for fname in files:
+        rel = os.path.relpath(fname, path)
+        if hash_inputs:
+            state.append((rel, _file_digest(fname)))
+        else:
+            st = os.stat(fname)
+            state.append((rel, st.st_mtime_ns, st.st_size))
+    return state
+
+
+@contextlib.contextmanager
+def _file_lock(path):
+    """Exclusive lock on `path` across processes (and threads), while in the block."""
+    with open(path, "a") as fh:
+        if fcntl is not None:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def _log(message):
+    # imported here, fos.util imports this module
+    from fos.util import console
+
+    console.log(message)
+
+
+def _func_id(func):
+    module = func.__module__ or "__main__"
+    return f"{module}.{func.__qualname__}".replace("<", "").replace(">", "")
+
+
+def _func_code(func):
+    # recompute when the function body changes, like joblib does
+    try:
+        return inspect.getsource(func)
+    except (OSError, TypeError):
+        return func.__code__.co_code if hasattr(func, "__code__") else None
+
+
+class Cache:
+    """!
+    Size-bounded, input-aware disk cache, see the module docstring.
+    @param location [str]: cache directory.
+    @param max_bytes [int]: size budget of all entries, None for FOS_CACHE_MAX_BYTES.
+    @param verbose [int]: log hits and misses when > 0.
+    """
+
+    def __init__(self, location: str, max_bytes: int = None, verbose: int = 0):
+        self.location = os.path.expanduser(location)
+        if max_bytes is None:
+            max_bytes = int(os.environ.get("FOS_CACHE_MAX_BYTES", MAX_BYTES))
+        self.max_bytes = max_bytes
+        self.verbose = verbose
+
+    # --- decorator -------------------------------------------------------------------
+
+    def cache(self, func=None, *, inputs=None, hash_inputs: bool = False):
+        """!
+        Cache `func` on disk. Usable as `@memory.cache` or `@memory.cache(inputs=["dpath"])`.
+        @param inputs [list]: names of the arguments that are input files/directories,
+            whose state is part of the key. By default the file system is ignored.
+        @param hash_inputs [bool]: key on content hashes instead of mtimes and sizes.
+        @return the wrapped function, with `.call` (bypass) and `.refresh` (recompute).
+        """
+        if func is None:
+            return functools.partial(self.cache, inputs=inputs, hash_inputs=hash_inputs)
+        return CachedFunction(self, func, inputs, hash_inputs)
+
+    # --- entries ---------------------------------------------------------------------
+
+    def _entries(self):
+        """(path, size, last access) of every entry."""
+        entries = []
+        if not os.path.isdir(self.location):
+            return entries
+        for func_dir in os.scandir(self.location):
+            if not func_dir.is_dir():
+                continue
+            for entry in os.scandir(func_dir.path):
+                if entry.name.endswith(".pkl"):
+                    st = entry.stat()
+                    entries.append((entry.path, st.st_size, st.st_mtime))
+        return entries
+
+    def prune(self, max_bytes: int = None, older_than: float = None) -> int:
+        """!
+        Evict least recently used entries until the cache fits `max_bytes`, and every
+        entry not used for `older_than` seconds.
+        @return number of evicted entries.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        total = sum(e[1] for e in entries)
+        now = time.time()
+        evicted = 0
+        for path, size, used in entries:
+            if total <= max_bytes and (older_than is None or now - used < older_than):
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        if evicted:
+            self._update_stats(evictions=evicted)
+        return evicted
+
+    def clear(self):
+        """Remove every entry and the statistics."""
+        if os.path.isdir(self.location):
+            shutil.rmtree(self.location)
+
+    # --- statistics ------------------------------------------------------------------
+
+    def _stats_path(self):
+        return os.path.join(self.location, STATS_FILE)
+
+    def _read_stats(self):
+        try:
+            with open(self._stats_path()) as fh:
+                return json.load(fh)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {key: 0 for key in _STATS_KEYS}
+
+    def _update_stats(self, **counts):
+        os.makedirs(self.location, exist_ok=True)
+        # read-modify-write under the lock, or concurrent workers lose counts
+        with _file_lock(f"{self._stats_path()}.lock"):
+            stats = self._read_stats()
+            for key, value in counts.items():
+                stats[key] = stats.get(key, 0) + value
+            tmp = f"{self._stats_path()}.{os.getpid()}.tmp"
+            with open(tmp, "w") as fh:
+                json.dump(stats, fh)
+            os.replace(tmp, self._stats_path())
+
+    def stats(self) -> dict:
+        """Counters since the last clear plus the current number of entries and size."""
+        entries = self._entries()
+        stats = {key: 0 for key in _STATS_KEYS}
+        stats.update(self._read_stats())
+        stats.update(
+            entries=len(entries), size_bytes=sum(e[1] for e in entries), max_bytes=self.max_bytes
+        )
+        return stats
+
+
+class CachedFunction:
+    """A function wrapped by `Cache.cache`."""
+
+    def __init__(self, cache: Cache, func, inputs, hash_inputs):
+        self.cache = cache
+        self.func = func
+        self.inputs = inputs
+        self.hash_inputs = hash_inputs
+        self.signature = inspect.signature(func)
+        self.func_dir = os.path.join(cache.location, _func_id(func))
+        self.code = _func_code(func)
+        functools.update_wrapper(self, func)
+
+    def _input_paths(self, arguments):
+        return {name: arguments[name] for name in self.inputs or () if arguments.get(name)}
+
+    def key(self, *args, **kwargs) -> str:
+        """Cache key of a call: the arguments, the input file state and the function code."""
+        bound = self.signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        arguments = dict(bound.arguments)
+        state = {
+            name: input_state(path, self.hash_inputs)
+            for name, path in self._input_paths(arguments).items()
+        }
+        return joblib.hash((CACHE_VERSION, self.code, arguments, state))
+
+    def _path(self, key):
+        return os.path.join(self.func_dir, f"{key}.pkl")
+
+    def call(self, *args, **kwargs):
+        """Call the function without reading or writing the cache."""
+        return self.func(*args, **kwargs)
+
+    def refresh(self, *args, **kwargs):
+        """Recompute and overwrite the cached entry of this call."""
+        return self._compute(self.key(*args, **kwargs), args, kwargs)
+
+    def _compute(self, key, args, kwargs):
+        result = self.func(*args, **kwargs)
+        path = self._path(key)
+        os.makedirs(self.func_dir, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        joblib.dump(result, tmp)
+        os.replace(tmp, path)
+        size = os.path.getsize(path)
+        self.cache._update_stats(misses=1, bytes_written=size)
+        if self.cache.verbose > 0:
+            _log(f"[cache] computed {_func_id(self.func)} ({size} bytes)")
+        self.cache.prune()
+        return result
+
+    def __call__(self, *args, **kwargs):
+        key = self.key(*args, **kwargs)
+        path = self._path(key)
+        try:
+            result = joblib.load(path)
+        except (FileNotFoundError, EOFError):
+            return self._compute(key, args, kwargs)
+        # the entry's mtime is its last access for the LRU order
+        try:
+            os.utime(path)
+            self.cache._update_stats(hits=1, bytes_read=os.path.getsize(path))
+        except FileNotFoundError:
+            # evicted by another process meanwhile
+            self.cache._update_stats(hits=1)
+        if self.cache.verbose > 0:
+            _log(f"[cache] loaded {_func_id(self.func)}")
+        return result
@@ -0,0 +1,261 @@
+"""!
+Persistent file catalog for the WRF postprocess tree.
+
+The postprocess tree is laid out as (see README.md)
+```
+{wrfdir}/{model}_{variant}_{experiment}_{bc}/postprocess/{domain}/
+    {variable}.{sampling}.{model}_{experiment}_{variant}_{domain}_{year}.nc
+```
+Listing those directories on the campaign filesystem is slow, so the filenames are
+parsed once into a table that is pickled under `FOS_CACHE_DIR`. On refresh only the
+domain directories whose mtime changed are listed again.
+"""
+
+import os
+import pickle
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+from fos.dirs import cachedir
+
+## {variable}.{sampling}.{model}_{experiment}_{variant}_{domain}_{year}.nc
+FILE_PATTERN = re.compile(
+    r"^(?P<variable>[^.]+)\.(?P<sampling>[^.]+)\."
+    r"(?P<model>[^_]+)_(?P<experiment>[^_]+)_(?P<variant>[^_]+)_"
+    r"(?P<domain>d\d\d)_(?P<year>\d{4})\.nc$"
+)
+## {model}_{variant}_{experiment}[_bc]
+RUN_PATTERN = re.compile(
+    r"^(?P<model>[^_]+)_(?P<variant>[^_]+)_(?P<experiment>[^_]+?)(?P<bc>_bc)?$"
+)
+COLUMNS = [
+    "path",
+    "run",
+    "model",
+    "variant",
+    "experiment",
+    "bc",
+    "domain",
+    "variable",
+    "sampling",
+    "year",
+]
+## bump when the pickled layout changes
+CATALOG_VERSION = 1
+
+# catalogs already loaded in this process, keyed on the wrf directory
+_catalogs = {}
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _scan_domain_dir(run, domaindir):
+    """Parse all catalog-able filenames in one `postprocess/{domain}` directory."""
+    runmatch = RUN_PATTERN.match(run)
+    rows = []
+    for fname in os.listdir(domaindir):
+        match = FILE_PATTERN.match(fname)
+        if match is None:
+            continue
+        row = match.groupdict()
+        # the run directory holds the canonical names, the filenames abbreviate
+        # e.g. the experiment ("hist" vs "historical")
+        if runmatch is not None:
+            row.update(
+                model=runmatch["model"],
+                variant=runmatch["variant"],
+                experiment=runmatch["experiment"],
+            )
+        row["path"] = os.path.join(domaindir, fname)
+        row["run"] = run
+        row["bc"] = run.endswith("_bc")
+        row["year"] = int(row["year"])
+        rows.append(row)
+    return rows
+
+
+def _to_frame(rows):
+    table = pd.DataFrame(rows, columns=COLUMNS)
+    table = table.astype({"bc": bool, "year": np.int32})
+    return table.sort_values(["run", "domain", "variable", "year"], ignore_index=True)
+
+
+class WrfCatalog:
+    """!
+    Queryable table of the files in a WRF postprocess tree.
+
+    Use `get_catalog(wrfdir)` rather than constructing this directly so that the
+    table is shared within the process.
+    """
+
+    def __init__(self, wrfdir: str, path: str = None):
+        self.wrfdir = os.path.normpath(wrfdir)
+        if path is None:
+            key = re.sub(r"[^A-Za-z0-9]+", "_", self.wrfdir).strip("_")
+            path = os.path.join(cachedir, "catalog", f"{key}.pkl")
+        self.path = path
+        self.table = _to_frame([])
+        # mtimes of every directory scanned, {dirpath: mtime_ns}
+        self.mtimes = {}
+        self.last_refresh = 0.0
+        self._index = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "rb") as fh:
+                state = pickle.load(fh)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return
+        if state.get("version") != CATALOG_VERSION or state.get("wrfdir") != self.wrfdir:
+            return
+        self.table = state["table"]
+        self.mtimes = state["mtimes"]
+        self._build_index()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        state = dict(
+            version=CATALOG_VERSION, wrfdir=self.wrfdir, table=self.table, mtimes=self.mtimes
+        )
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as fh:
+            pickle.dump(state, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+
+    def _build_index(self):
+        # (run, domain, variable, sampling) -> (years, paths), so file lookups skip pandas
+        keys = ["run", "domain", "variable", "sampling"]
+        self._index = {
+            key: (group.year.to_numpy(), group.path.to_numpy())
+            for key, group in self.table.groupby(keys, sort=False)
+        }
+
+    def refresh(self, force: bool = False):
+        """!
+        Bring the catalog up to date with the filesystem.
+        Only `{run}/postprocess/{domain}` directories whose mtime changed since the last
+        refresh are listed again, unchanged directories just cost a stat.
+        @param force [bool]: re-list every directory regardless of its mtime.
+        @return self
+        """
+        mtimes = {}
+        keep = []
+        rows = []
+        changed = False
+        for run in sorted(os.listdir(self.wrfdir)):
+            ppdir = os.path.join(self.wrfdir, run, "postprocess")
+            if not os.path.isdir(ppdir):
+                continue
+            for domain in sorted(os.listdir(ppdir)):
+                domaindir = os.path.join(ppdir, domain)
+                if not os.path.isdir(domaindir):
+                    continue
+                mtime = _mtime(domaindir)
+                mtimes[domaindir] = mtime
+                if not force and self.mtimes.get(domaindir) == mtime:
+                    keep.append(domaindir)
+                    continue
+                changed = True
+                rows.extend(_scan_domain_dir(run, domaindir))
+        # directories that disappeared also count as a change
+        changed = changed or set(mtimes) != set(self.mtimes)
+        if changed:
+            kept = self.table[self.table.path.map(os.path.dirname).isin(keep)]
+            table = pd.concat([kept, _to_frame(rows)], ignore_index=True)
+            self.table = table.sort_values(
+                ["run", "domain", "variable", "year"], ignore_index=True
+            )
+            self.mtimes = mtimes
+            self._build_index()
+            self._save()
+        self.last_refresh = time.time()
+        return self
+
+    def query(
+        self,
+        variable: str = None,
+        model: str = None,
+        variant: str = None,
+        experiment: str = None,
+        bc: bool = None,
+        domain: str = None,
+        sampling: str = None,
+        run: str = None,
+        years: tuple = None,
+    ) -> pd.DataFrame:
+        """!
+        Select catalog rows, every argument left as None matches everything.
+        @param years [tuple]: inclusive (first, last) year range.
+        @return pd.DataFrame with the catalog columns, sorted by run/domain/variable/year.
+        """
+        mask = np.ones(len(self.table), dtype=bool)
+        for col, val in [
+            ("variable", variable),
+            ("model", model),
+            ("variant", variant),
+            ("experiment", experiment),
+            ("bc", bc),
+            ("domain", domain),
+            ("sampling", sampling),
+            ("run", run),
+        ]:
+            if val is not None:
+                mask &= (self.table[col] == val).to_numpy()
+        if years is not None:
+            mask &= ((self.table.year >= years[0]) & (self.table.year <= years[1])).to_numpy()
+        return self.table[mask]
+
+    def files(
+        self, run: str, variable: str, domain: str, years: tuple = None, sampling="daily"
+    ) -> list:
+        """!
+        Sorted file paths for one variable of one run, optionally in an inclusive
+        (first, last) year range. This is the fast path used by the readers.
+        """
+        entry = self._index.get((run, domain, variable, sampling))
+        if entry is None:
+            return []
+        fyears, paths = entry
+        if years is not None:
+            paths = paths[(fyears >= years[0]) & (fyears <= years[1])]
+        return paths.tolist()
+
+    def runs(self, bc: bool = None) -> pd.DataFrame:
+        """Unique model/variant/experiment runs in the catalog."""
+        cols = ["run", "model", "variant", "experiment", "bc"]
+        runs = self.table[cols].drop_duplicates(ignore_index=True)
+        if bc is not None:
+            runs = runs[runs.bc == bc].reset_index(drop=True)
+        return runs
+
+    def years(self, run: str, variable: str, domain: str, sampling="daily") -> np.ndarray:
+        """Years available for one variable of one run."""
+        entry = self._index.get((run, domain, variable, sampling))
+        return np.array([], dtype=np.int32) if entry is None else entry[0]
+
+
+def get_catalog(wrfdir: str, refresh: bool = None, max_age: float = 60.0) -> WrfCatalog:
+    """!
+    Return the (process-wide) catalog for `wrfdir`, refreshed if it is stale.
+    @param wrfdir [str]: root of the postprocess tree, e.g. `dirs.wrfdir`.
+    @param refresh [bool]: True to always check mtimes, False to never check,
+        None to check when the last check is older than `max_age` seconds.
+    @param max_age [float]: seconds between automatic mtime checks.
+    @return WrfCatalog
+    """
+    key = os.path.normpath(wrfdir)
+    catalog = _catalogs.get(key)
+    if catalog is None:
+        catalog = _catalogs[key] = WrfCatalog(key)
+    if refresh or (refresh is None and time.time() - catalog.last_refresh > max_age):
+        catalog.refresh()
+    return catalog
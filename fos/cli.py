@@ -5,11 +5,21 @@ See `fos --help` for more information.
 
 import atexit
 import cProfile
+import os
 import sys
 
 import click
 
-from fos.util import console, create_wrf_df, get_coords
+from fos import dirs, instrument
+from fos.convert import TILE, TIME_CHUNK, convert_run
+from fos.sitemetrics import build_site_metrics
+from fos.sitestore import (
+    build_snotel_store,
+    build_wrfts_store,
+    snotel_store_path,
+    wrfts_store_path,
+)
+from fos.util import console
 
 
 @click.group()
@@ -19,13 +29,21 @@ from fos.util import console, create_wrf_df, get_coords
     default="profile.out",
     help="Output file when profiling, else it's ignored.",
 )
-def cli(profile: bool, profile_output: str) -> None:
+@click.option(
+    "--report",
+    default=None,
+    help="Write timers, counters, I/O, dask tasks and peak memory to this .json/.jsonl file.",
+)
+@click.pass_context
+def cli(ctx, profile: bool, profile_output: str, report: str) -> None:
     """!
     This function provides the command line interface for the fos package.
     See subcommand options with `fos --help` or `fos <subcommand> --help`.
     See click.group() for more information on the arguments.
     @param profile [bool]: Whether to profile the program or not.
     @param profile_output [str]: The output file when profiling, else it's ignored.
+    @param report [str]: Optional instrumentation report, see fos.instrument; .jsonl
+        files are appended to so runs can be compared.
     @return None
     """
     # Profiling snippet modified from
@@ -44,23 +62,282 @@ def cli(profile: bool, profile_output: str) -> None:
             )
 
         atexit.register(exit)
+    if report is not None:
+        instrument.enable()
+        # closed last to first: the subcommand's stage ends before the report is written
+        ctx.call_on_close(lambda: console.log(f"Report in {instrument.write_report(report)}"))
+        ctx.with_resource(instrument.stage(f"fos {ctx.invoked_subcommand}"))
     console.log("Beginning analysis...", style="bold yellow")
 
 
+@click.command(name="site-metrics")
+@click.option(
+    "--wrfts-dir",
+    default=os.path.join(dirs.projectdir, "wrfts", "ukesm1-0-ll_bc"),
+    help="Directory of the extracted wrfpoint_/wrfbasin_ .npy series.",
+)
+@click.option("--snoteldir", default=dirs.snoteldir, help="Directory of the snotel CSVs.")
+@click.option("--output", default="site_metrics.parquet", help="Output parquet table.")
+@click.option("--workers", default=4, help="Number of worker processes.")
+@click.option("--wrfts-store", default=None, help="Read the WRF series from this store instead.")
+def site_metrics(wrfts_dir, snoteldir, output, workers, wrfts_store):
+    """
+    Peak SWE metrics per site, source and water year for all non-AK SNOTEL sites.
+    """
+    from fos.data import snotel_no_ak
+
+    table, failures = build_site_metrics(
+        snotel_no_ak,
+        datadir=wrfts_dir,
+        snoteldir=snoteldir,
+        output=output,
+        workers=workers,
+        wrfstore=wrfts_store,
+    )
+    console.log(f"Wrote {len(table)} rows to {output}, {len(failures)} sites failed")
+
+
+cli.add_command(site_metrics)
+
+
+@click.command()
+@click.argument("model")
+@click.argument("variant")
+@click.option("--var", "variables", multiple=True, default=["snow"], help="Variable(s) to convert.")
+@click.option("--wrfdir", default=dirs.wrfdir, help="Root of the WRF postprocess tree.")
+@click.option("--domain", default="d02", help="WRF domain.")
+@click.option(
+    "--experiment",
+    "experiments",
+    multiple=True,
+    default=["historical", "ssp370"],
+    help="Experiment(s) to convert.",
+)
+@click.option("--storedir", default=dirs.storedir, help="Output directory for the stores.")
+@click.option("--time-chunk", default=TIME_CHUNK, help="Days per chunk.")
+@click.option("--tile", default=TILE, help="Grid cells per chunk along each spatial axis.")
+@click.option("--workers", default=4, help="Number of time blocks written in parallel.")
+@click.option("--overwrite", is_flag=True, help="Rewrite stores instead of resuming them.")
+@click.option(
+    "--compact",
+    type=click.Choice(["float32", "int16"]),
+    default=None,
+    help="Store float32 or int16 packed values (see fos.compact), read back as float32.",
+)
+def convert(
+    model,
+    variant,
+    variables,
+    wrfdir,
+    domain,
+    experiments,
+    storedir,
+    time_chunk,
+    tile,
+    workers,
+    overwrite,
+    compact,
+):
+    """
+    Rechunk per-year WRF files of MODEL VARIANT into time-series optimized stores.
+    Interrupted conversions resume where they stopped when rerun.
+    """
+    for var in variables:
+        paths = convert_run(
+            wrfdir,
+            model,
+            variant,
+            var=var,
+            domain=domain,
+            experiments=experiments,
+            storedir=storedir,
+            time_chunk=time_chunk,
+            tile=tile,
+            workers=workers,
+            overwrite=overwrite,
+            compact=compact,
+        )
+        for path in paths:
+            console.log("Wrote", path)
+
+
+cli.add_command(convert)
+
+
+@click.command(name="snotel-store")
+@click.option("--snoteldir", default=dirs.snoteldir, help="Directory of the snotel CSVs.")
+@click.option("--output", default=None, help="Store directory, default FOS_STORE_DIR/snotel.")
+@click.option("--float32", is_flag=True, help="Store float32 instead of float64.")
+def snotel_store(snoteldir, output, float32):
+    """
+    Consolidate the snotel CSVs into one memory-mapped site x day store.
+    Rerunning only re-reads the CSVs that changed.
+    """
+    dtype = "f4" if float32 else "f8"
+    store = build_snotel_store(snoteldir, output or snotel_store_path(), dtype=dtype)
+    console.log(f"{store.path}: {len(store.sites)} sites x {store.ndays} days")
+
+
+cli.add_command(snotel_store)
+
+
+@click.command(name="wrfts-store")
+@click.argument("run")
+@click.option("--wrfts-dir", default=None, help="Directory of the .npy series, default wrfts/RUN.")
+@click.option("--output", default=None, help="Store directory, default FOS_STORE_DIR/wrfts/RUN.")
+@click.option("--float32", is_flag=True, help="Store float32 instead of float64.")
+def wrfts_store(run, wrfts_dir, output, float32):
+    """
+    Consolidate the wrfpoint_/wrfbasin_ series of RUN (e.g. ukesm1-0-ll_bc) into one
+    memory-mapped site x day store indexed by site number.
+    """
+    from fos.data import snotel_no_ak
+
+    datadir = wrfts_dir or os.path.join(dirs.projectdir, "wrfts", run)
+    dtype = "f4" if float32 else "f8"
+    store = build_wrfts_store(datadir, snotel_no_ak, output or wrfts_store_path(run), dtype=dtype)
+    console.log(f"{store.path}: {len(store.sites)} sites x {store.ndays} days")
+
+
+cli.add_command(wrfts_store)
+
+
+@click.group(name="cache")
+def cache_group():
+    """
+    Inspect and manage the function cache (FOS_CACHE_DIR/memory).
+    """
+
+
+@cache_group.command(name="stats")
+def cache_stats():
+    """Hits, misses, bytes read/written and the current size of the cache."""
+    from fos.util import memory
+
+    for key, value in memory.stats().items():
+        console.log(f"{key}: {value}")
+
+
+@cache_group.command(name="prune")
+@click.option("--max-bytes", type=int, default=None, help="Size budget, default the cache's.")
+@click.option("--older-than", type=float, default=None, help="Also evict entries unused for DAYS.")
+def cache_prune(max_bytes, older_than):
+    """Evict least recently used entries until the cache fits its budget."""
+    from fos.util import memory
+
+    older_than = None if older_than is None else older_than * 24 * 3600
+    evicted = memory.prune(max_bytes=max_bytes, older_than=older_than)
+    console.log(f"Evicted {evicted} entries, {memory.stats()['size_bytes']} bytes left")
+
+
+@cache_group.command(name="clear")
+def cache_clear():
+    """Remove every cache entry."""
+    from fos.util import memory
+
+    memory.clear()
+    console.log(f"Cleared {memory.location}")
+
+
+cli.add_command(cache_group)
+
+
+@click.command(name="run-models")
+@click.argument("config")
+@click.option("--output", default="model_results.parquet", help="Output parquet table.")
+@click.option("--workers", default=4, help="Number of worker processes.")
+def run_models(config, output, workers):
+    """
+    Fit and score the models x parameter grids x sites x windows described in the
+    JSON file CONFIG (see fos.experiments). Rerunning resumes an interrupted sweep
+    and retries the failed tasks. Exits with 1 if any task failed.
+    """
+    from fos.experiments import SITE_CHUNK, load_config, run_experiments
+
+    config = load_config(config)
+    table, failures = run_experiments(
+        config["experiments"],
+        config["models"],
+        config["time_periods"],
+        sites=config.get("sites"),
+        output=output,
+        workers=workers,
+        site_chunk=config.get("site_chunk", SITE_CHUNK),
+        units=config.get("units"),
+    )
+    console.log(f"Wrote {len(table)} rows to {output}, {len(failures)} tasks failed")
+    if len(failures) > 0:
+        sys.exit(1)
+
+
+cli.add_command(run_models)
+
+
+@click.command()
+@click.argument("config")
+@click.option("--stage", "stages", multiple=True, help="Only these stages (and their inputs).")
+@click.option("--force", is_flag=True, help="Rerun the stages even if they are up to date.")
+@click.option("--workers", default=4, help="Number of stages run concurrently.")
+def pipeline(config, stages, force, workers):
+    """
+    Bring the outputs of the JSON pipeline description CONFIG up to date (see
+    fos.pipeline.fos_pipeline), skipping stages and partitions whose inputs did not
+    change. The manifest and run log are kept in the config's workdir.
+    """
+    import json
+
+    from fos.pipeline import BROKEN, fos_pipeline
+
+    with open(config) as fh:
+        pipe = fos_pipeline(json.load(fh))
+    records = pipe.run(targets=list(stages) or None, force=force, workers=workers, log=console.log)
+    for name, record in records.items():
+        console.log(f"{name}: {record['status']}")
+    if any(record["status"] in BROKEN for record in records.values()):
+        sys.exit(1)
+
+
+cli.add_command(pipeline)
+
+
 @click.command()
-def dev():
+@click.argument("root")
+@click.option("--scale", default="small", help="tiny, small, medium or full.")
+@click.option("--seed", default=0, help="Random seed of the terrain, sites and years.")
+def synthetic(root, scale, seed):
     """
-    Command for development purposes.
+    Write a synthetic WRF postprocess tree with SNOTEL and HUC inputs under ROOT
+    (see fos.synthetic).
     """
-    res = get_coords()
-    create_wrf_df(res["snotel_gdf"])
+    from fos.synthetic import make_fake_tree
+
+    tree = make_fake_tree(root, scale=scale, seed=seed)
+    console.log(f"Wrote {len(tree['files'])} WRF files and {tree['nsites']} sites to {root}")
+
+
+cli.add_command(synthetic)
 
 
-cli.add_command(dev)
+@click.command()
+@click.option("--root", default=None, help="Synthetic tree to (re)use, default a temporary one.")
+@click.option("--scale", default="small", help="tiny, small, medium or full.")
+@click.option("--repeat", default=1, help="Runs per benchmark, the fastest is reported.")
+@click.option("--bench", "benchmarks", multiple=True, help="Only these benchmarks.")
+@click.option("--output", default="benchmarks.jsonl", help="JSON-lines file to append to.")
+def benchmark(root, scale, repeat, benchmarks, output):
+    """
+    Time and measure the memory of the main workflow steps on a synthetic tree and
+    compare with the previous run in OUTPUT (see fos.benchmark).
+    """
+    from fos.benchmark import compare, run_benchmarks
+
+    run_benchmarks(
+        root=root, scale=scale, repeat=repeat, benchmarks=list(benchmarks) or None, output=output
+    )
+    console.print(compare(output).to_string())
 
 
-# TODO
-# Add the subcommands
+cli.add_command(benchmark)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,169 @@
+"""!
+Compact representations of WRF and SNOTEL arrays, opt in where memory is the limit
+(e.g. full-domain, multi-GCM daily cubes).
+
+- "float32": values are cast to float32, half the size of the float64 copies.
+- "int16": values are packed as int16 with an explicit scale and offset,
+  `value = packed * scale_factor + add_offset`, missing values stored as FILL.
+
+The int16 layout is the CF packing convention: the scale_factor/add_offset/_FillValue
+attrs are the ones netCDF and zarr use, so a packed array written to a store is
+decoded by any reader, and `unpack` decodes it (lazily) in memory.
+
+Units travel in `attrs["units"]`. Conversions happen in the consumer with `to_units`,
+which only adds a multiply to the dask graph (or to the selection), instead of the
+readers converting eagerly. The reductions (`snowmetrics`, `elevation`, `spatial`)
+unpack block by block and accumulate in float64.
+```
+snow = compact(_wrfread_gcm(...), "int16")    # 2 bytes per value, lazy
+peak = to_units(snow, "in").max("day")        # unpacked and converted per chunk
+```
+"""
+
+import numpy as np
+import xarray as xr
+
+from fos.constants import CONVERSIONS
+
+MODES = ("float32", "int16")
+## int16 value of missing data, the packed range is symmetric around it: +-32767
+FILL = np.int16(-32768)
+## default (scale_factor, add_offset) per units: the scale is the quantization step
+## and 32767 * scale + offset the largest value, e.g. 16 m of SWE in 0.5 mm steps
+PACKING = {
+    "mm": (0.5, 0.0),
+    "in": (0.02, 0.0),
+    "K": (0.01, 273.15),
+}
+## the attrs describing int16 packing
+PACKED_ATTRS = ("scale_factor", "add_offset", "_FillValue")
+
+
+def is_packed(data) -> bool:
+    """True if `data` holds int16 values packed with a scale_factor."""
+    return "scale_factor" in data.attrs
+
+
+def packing(data, scale: float = None, offset: float = None) -> tuple:
+    """!
+    The int16 (scale_factor, add_offset) of `data`.
+    @param scale, offset [float]: explicit packing, by default PACKING[data units].
+    @return (scale, offset) as float32, so unpacked values are float32 too.
+    """
+    if scale is None:
+        units = data.attrs.get("units")
+        if units not in PACKING:
+            raise ValueError(f"No default int16 packing for units {units!r}, pass a scale")
+        scale, default = PACKING[units]
+        offset = default if offset is None else offset
+    return np.float32(scale), np.float32(offset or 0.0)
+
+
+def _pack_block(block, scale, offset):
+    packed = np.round((block - offset) / scale)
+    finite = np.isfinite(packed)
+    if np.any(np.abs(packed[finite]) > 32767):
+        raise ValueError(f"Values outside the int16 range of scale {scale}, offset {offset}")
+    return np.where(finite, packed, FILL).astype(np.int16)
+
+
+def _unpack_block(block, scale, offset, fill, dtype):
+    out = block.astype(dtype) * dtype(scale) + dtype(offset)
+    out[block == fill] = np.nan
+    return out
+
+
+def compact(data, mode: str = "float32", scale: float = None, offset: float = None):
+    """!
+    Compact version of a DataArray (or of every variable of a Dataset). Dask arrays
+    stay lazy, the conversion runs per block.
+    @param mode [str]: "float32", "int16", or None to return `data` unchanged.
+    @param scale, offset [float]: int16 packing, by default PACKING[data units]. Blocks
+        with values outside the packed range raise a ValueError when computed.
+    @return the same type, int16 arrays with scale_factor/add_offset/_FillValue attrs.
+    """
+    if mode is None:
+        return data
+    if mode not in MODES:
+        raise ValueError(f"Unknown compact mode {mode!r}, use one of {MODES}")
+    if isinstance(data, xr.Dataset):
+        return data.map(compact, keep_attrs=True, mode=mode, scale=scale, offset=offset)
+    if is_packed(data):
+        return data if mode == "int16" else unpack(data)
+    if mode == "float32":
+        return data.astype(np.float32)
+    scale, offset = packing(data, scale, offset)
+    packed = xr.apply_ufunc(
+        _pack_block,
+        data,
+        kwargs=dict(scale=scale, offset=offset),
+        dask="parallelized",
+        output_dtypes=[np.int16],
+        keep_attrs=True,
+    )
+    return packed.assign_attrs(scale_factor=scale, add_offset=offset, _FillValue=FILL)
+
+
+def unpack(data, dtype=np.float32):
+    """!
+    Decode int16-packed data (lazily) to `dtype`, anything else is returned as is.
+    @param data [xr.DataArray or xr.Dataset]
+    """
+    if isinstance(data, xr.Dataset):
+        return data.map(unpack, keep_attrs=True, dtype=dtype)
+    if not is_packed(data):
+        return data
+    attrs = {key: value for key, value in data.attrs.items() if key not in PACKED_ATTRS}
+    out = xr.apply_ufunc(
+        _unpack_block,
+        data,
+        kwargs=dict(
+            scale=data.attrs["scale_factor"],
+            offset=data.attrs.get("add_offset", 0.0),
+            fill=data.attrs.get("_FillValue", FILL),
+            dtype=np.dtype(dtype).type,
+        ),
+        dask="parallelized",
+        output_dtypes=[dtype],
+    )
+    out.attrs = attrs
+    return out
+
+
+def to_units(data, units: str):
+    """!
+    `data` in `units`, from its attrs["units"] with the factors of
+    constants.CONVERSIONS. Lazy: dask data only gets a multiply in its graph, and
+    float32 data stays float32. Packed data is unpacked first.
+    @param data [xr.DataArray or xr.Dataset]
+    @param units [str]: target units, None returns the (unpacked) data.
+    """
+    if isinstance(data, xr.Dataset):
+        return data.map(to_units, keep_attrs=True, units=units)
+    data = unpack(data)
+    current = data.attrs.get("units")
+    if units is None or units == current:
+        return data
+    try:
+        factor = CONVERSIONS[(current, units)]
+    except KeyError:
+        raise ValueError(f"Cannot convert {data.name} from {current} to {units}") from None
+    out = data * factor
+    out.attrs = dict(data.attrs, units=units)
+    return out
+
+
+def encoding(data, mode: str, scale: float = None, offset: float = None) -> dict:
+    """!
+    netCDF/zarr encoding writing `data` in a compact mode; readers decode it back
+    to float32.
+    @return the encoding entries of the variable, empty for mode None.
+    """
+    if mode is None:
+        return {}
+    if mode not in MODES:
+        raise ValueError(f"Unknown compact mode {mode!r}, use one of {MODES}")
+    if mode == "float32":
+        return {"dtype": "float32"}
+    scale, offset = packing(data, scale, offset)
+    return {"dtype": "int16", "scale_factor": scale, "add_offset": offset, "_FillValue": FILL}
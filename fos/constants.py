@@ -2,3 +2,6 @@
 ## CONSTANTS ## 
 
 MM_TO_IN = 0.03937008
+
+## factors converting between units, see compact.to_units and sitestore.SiteDayStore
+CONVERSIONS = {("mm", "in"): MM_TO_IN, ("in", "mm"): 1 / MM_TO_IN}
@@ -0,0 +1,273 @@
+"""!
+Convert per-year WRF NetCDFs into time-series optimized zarr stores.
+
+The postprocessed files hold one year of the full domain each, so reading a single
+cell's 1980-2100 series touches every file and decompresses the whole grid each time.
+A converted store is chunked as (long time span) x (spatial tile) so the same read
+touches a handful of small chunks. Stores live under `dirs.storedir` as
+`{storedir}/{gcm}/{var}_{domain}.zarr` and `_wrfread_gcm` prefers them when complete
+and converted from the files it was asked to read (see `source_fingerprint`).
+"""
+
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from fos.catalog import get_catalog
+from fos.compact import compact as compact_array
+from fos.compact import encoding as compact_encoding
+from fos.compact import is_packed, unpack
+from fos.dirs import storedir as default_storedir
+
+## bookkeeping file written inside each store, used to resume interrupted conversions
+PROGRESS_FILE = ".fos_progress.json"
+## default chunking: ten years by 64 x 64 cells
+TIME_CHUNK = 3650
+TILE = 64
+
+
+def store_path(gcm: str, var: str, domain: str, storedir: str = None) -> str:
+    """Location of the converted store for one run/variable/domain."""
+    return os.path.join(storedir or default_storedir, gcm, f"{var}_{domain}.zarr")
+
+
+def _read_progress(path):
+    try:
+        with open(os.path.join(path, PROGRESS_FILE)) as fh:
+            return json.load(fh)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _write_progress(path, progress):
+    tmp = os.path.join(path, f"{PROGRESS_FILE}.tmp")
+    with open(tmp, "w") as fh:
+        json.dump(progress, fh)
+    os.replace(tmp, os.path.join(path, PROGRESS_FILE))
+
+
+def source_fingerprint(wrfdir: str, gcm: str, var: str, domain: str) -> dict:
+    """!
+    The source files of a run's store: the tree they are in and the name, size and
+    mtime of every file in catalog order, recorded by `convert_run`.
+    """
+    files = get_catalog(wrfdir).files(gcm, var, domain)
+    stats = [os.stat(f) for f in files]
+    return dict(
+        wrfdir=os.path.realpath(wrfdir),
+        files=[os.path.basename(f) for f in files],
+        sizes=[st.st_size for st in stats],
+        mtimes=[st.st_mtime_ns for st in stats],
+    )
+
+
+def store_matches(path: str, fingerprint: dict) -> bool:
+    """True if `path` is a complete store converted from the sources of `fingerprint`."""
+    progress = _read_progress(path)
+    if progress is None or not progress.get("complete", False):
+        return False
+    recorded = progress.get("fingerprint", {})
+    return all(recorded.get(key) == value for key, value in fingerprint.items())
+
+
+def store_complete(path: str) -> bool:
+    """True if `path` is a store whose conversion ran to the end."""
+    progress = _read_progress(path)
+    return progress is not None and progress.get("complete", False)
+
+
+def open_store(path: str, var: str, packed: bool = False) -> xr.DataArray:
+    """!
+    Lazily open a converted store.
+    @param packed [bool]: keep the values of an int16 store packed (see fos.compact)
+        instead of decoding them to float32.
+    @return xr.DataArray with dims (day, lat2d, lon2d), chunked as stored.
+    """
+    data = xr.open_zarr(path, mask_and_scale=not packed)[var]
+    if packed and not is_packed(data):
+        # a float store, the fill value attribute only matters to packed data
+        data.attrs.pop("_FillValue", None)
+    return data
+
+
+def convert_dataarray(
+    data: xr.DataArray,
+    path: str,
+    fingerprint: dict = None,
+    time_chunk: int = TIME_CHUNK,
+    tile: int = TILE,
+    workers: int = 4,
+    overwrite: bool = False,
+    compact: str = None,
+) -> str:
+    """!
+    Write a (day, lat2d, lon2d) DataArray to a chunked zarr store.
+    Each block of `time_chunk` days is written as an independent region by a pool of
+    `workers` threads, and finished blocks are recorded in the store, so rerunning
+    after an interruption only writes the missing blocks. When the source only grew
+    by new trailing files (e.g. the next ssp370 year), the new days are appended to a
+    complete store instead of rewriting it.
+    @param data [xr.DataArray]: the (lazy) variable, named, with a datetime `day` axis.
+    @param path [str]: output store path.
+    @param fingerprint [dict]: describes the source, a mismatch forces a rewrite.
+    @param time_chunk [int]: days per chunk.
+    @param tile [int]: cells per chunk along lat2d and lon2d.
+    @param workers [int]: number of blocks written concurrently.
+    @param overwrite [bool]: discard any existing store.
+    @param compact [str]: store the values as "float32" or as "int16" packed with the
+        default scale/offset of their units, see fos.compact. Opening decodes them to
+        float32.
+    @return path
+    """
+    var = data.name
+    data = data.reset_coords(drop=True)
+    if compact == "int16":
+        # quantize as the encoding will, so out of range values raise instead of
+        # wrapping around in the int16 cast
+        data = unpack(compact_array(data, compact))
+    chunks = {"day": time_chunk, "lat2d": tile, "lon2d": tile}
+    ds = data.chunk(chunks).to_dataset()
+    fingerprint = dict(fingerprint or {}, time_chunk=time_chunk, tile=tile, n=ds.sizes["day"])
+    if compact is not None:
+        fingerprint["compact"] = compact
+
+    progress = None if overwrite else _read_progress(path)
+    if progress is not None and progress.get("fingerprint") != fingerprint:
+        if progress["complete"] and _appendable(progress["fingerprint"], fingerprint):
+            return _append_days(ds, path, progress, fingerprint)
+        progress = None
+    if progress is None:
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        encoding = {var: {"chunks": (time_chunk, tile, tile)}}
+        encoding[var].update(compact_encoding(data, compact))
+        ds.to_zarr(path, mode="w", compute=False, encoding=encoding)
+        progress = dict(fingerprint=fingerprint, done=[], complete=False)
+        _write_progress(path, progress)
+    elif progress["complete"]:
+        return path
+
+    nday = ds.sizes["day"]
+    blocks = [
+        (i, slice(start, min(start + time_chunk, nday)))
+        for i, start in enumerate(range(0, nday, time_chunk))
+        if i not in progress["done"]
+    ]
+    lock = threading.Lock()
+
+    def write_block(block):
+        i, region = block
+        ds.isel(day=region).to_zarr(path, region={"day": region})
+        with lock:
+            progress["done"].append(i)
+            _write_progress(path, progress)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for future in as_completed([pool.submit(write_block, block) for block in blocks]):
+            future.result()
+
+    progress["complete"] = True
+    _write_progress(path, progress)
+    return path
+
+
+def _appendable(old: dict, new: dict) -> bool:
+    """True if `new` describes the `old` source files followed by more files."""
+    files, sizes = old.get("files"), old.get("sizes")
+    if files is None or sizes is None:
+        return False
+    per_file = ("files", "sizes", "mtimes", "n")
+    same = {k: v for k, v in old.items() if k not in per_file}
+    mtimes = old.get("mtimes", [])
+    return (
+        same == {k: v for k, v in new.items() if k not in per_file}
+        and new["files"][: len(files)] == files
+        and new["sizes"][: len(sizes)] == sizes
+        and new.get("mtimes", [])[: len(mtimes)] == mtimes
+        and new["n"] > old["n"]
+    )
+
+
+def _append_days(ds: xr.Dataset, path: str, progress: dict, fingerprint: dict) -> str:
+    """Append the days past the store's end, the first block completes its last chunk."""
+    old_n, time_chunk = progress["fingerprint"]["n"], fingerprint["time_chunk"]
+    new = ds.isel(day=slice(old_n, None))
+    first = min(time_chunk - old_n % time_chunk, new.sizes["day"])
+    rest = new.sizes["day"] - first
+    chunks = (first,) + (time_chunk,) * (rest // time_chunk)
+    if rest % time_chunk:
+        chunks += (rest % time_chunk,)
+    new.chunk({"day": chunks}).to_zarr(path, append_dim="day")
+    nblocks = -(-fingerprint["n"] // time_chunk)
+    progress.update(fingerprint=fingerprint, done=list(range(nblocks)), complete=True)
+    _write_progress(path, progress)
+    return path
+
+
+def convert_run(
+    wrfdir: str,
+    model: str,
+    variant: str,
+    var: str = "snow",
+    domain: str = "d02",
+    experiments=("historical", "ssp370"),
+    storedir: str = None,
+    **kwargs,
+) -> list:
+    """!
+    Convert one variable of a model/variant into a store per experiment.
+    Extra keyword arguments are passed to `convert_dataarray`.
+    @param wrfdir [str]: root of the postprocess tree, e.g. `dirs.wrfdir`.
+    @param experiments [tuple]: experiments to convert, the bias corrected runs
+        `{model}_{variant}_{experiment}_bc` are used.
+    @return list of the store paths written.
+    """
+    # avoid a circular import, util looks for converted stores
+    from fos.util import _wrfread_gcm
+
+    paths = []
+    for exp in experiments:
+        gcm = f"{model}_{variant}_{exp}_bc"
+        fingerprint = source_fingerprint(wrfdir, gcm, var, domain)
+        modeldir = os.path.join(wrfdir, gcm, "postprocess")
+        data = _wrfread_gcm(exp, gcm, variant, modeldir, var, domain, use_store=False)
+        data = data.rename(var)
+        path = store_path(gcm, var, domain, storedir)
+        paths.append(convert_dataarray(data, path, fingerprint=fingerprint, **kwargs))
+    return paths
+
+
+def read_store(
+    gcm: str,
+    var: str,
+    domain: str,
+    years: tuple = None,
+    storedir: str = None,
+    packed=False,
+    wrfdir: str = None,
+):
+    """!
+    Open the converted store for a run if one is complete, else return None.
+    @param years [tuple]: optional inclusive (first, last) year range.
+    @param packed [bool]: see `open_store`.
+    @param wrfdir [str]: the tree the caller reads the run from. The store is only
+        used if it was converted from the current files of the run in that tree, so
+        added, replaced or touched files and other trees give None.
+    """
+    path = store_path(gcm, var, domain, storedir)
+    if wrfdir is not None:
+        if not store_matches(path, source_fingerprint(wrfdir, gcm, var, domain)):
+            return None
+    elif not store_complete(path):
+        return None
+    data = open_store(path, var, packed=packed)
+    if years is not None:
+        year = pd.DatetimeIndex(data["day"].values).year
+        data = data.isel(day=np.flatnonzero((year >= years[0]) & (year <= years[1])))
+    return data
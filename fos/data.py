@@ -1,46 +1,154 @@
 #!/usr/bin/env python3
 
-## data loader for fate of snotel project ## 
+## data loader for fate of snotel project ##
 
 ## DATA
 
-from fos.dirs import basedir, projectdir, snoteldir
-import geopandas as gpd
-import pandas as pd
+import os
+import pickle
+
+from fos import dirs
+
+# geopandas and pandas are imported where they are used, so `import fos.data` stays cheap
 
 '''
 snotelmeta
 snotel_gdf
 in6s, in8s
 snotel_no_ak
+huc6, huc8
+
+Everything is loaded on first access (`from fos.data import in6s` or `data.in6s`), so
+importing this module is cheap. snotelmeta and the HUC membership of each site are
+cached as a pickle under FOS_CACHE_DIR, which is rebuilt when a source file changes.
 '''
 
-snotelmeta = pd.read_csv(snoteldir + 'snotelmeta.csv')
-huc6 = gpd.read_file(projectdir + 'spatialdata/huc6.shp')
-huc8 = gpd.read_file(projectdir + 'spatialdata/huc8.shp')
-snotel_gdf = gpd.GeoDataFrame(data = {'site_name':snotelmeta.site_name,
-                                     'elev': snotelmeta.elev,
-                                     'site_number':snotelmeta.site_number,
-                                     'state':snotelmeta.state,
-                                     'namestr':snotelmeta.namestr,
-                                     'startdt':snotelmeta.startdt}, geometry = gpd.points_from_xy(snotelmeta.lon, snotelmeta.lat), crs = 'epsg:4326')
-
-## time series of the difference in time between peak SWE at the grid box where the SNOTEL resides 
-## and the time of peak SWE across the HUC-6 watershed in which the SNOTEL resides
-in6 = []
-in8 = []
-ptnames = []
-for i in snotel_gdf.index:
-    point = snotel_gdf[snotel_gdf.index == i].geometry[i]
-    ptname = snotel_gdf[snotel_gdf.index == i].site_number[i]
-    basin = huc6[huc6.contains(point)]
-    k = basin.name.index[0]
-    in6.append(basin.name[k])
-    basin = huc8[huc8.contains(point)]
-    k = basin.name.index[0]
-    in8.append(basin.name[k])
-    ptnames.append(ptname)
-in6s = pd.Series(in6, index = ptnames)
-in8s = pd.Series(in8, index = ptnames)
-
-snotel_no_ak = snotel_gdf[snotel_gdf.state != "AK"]
+## bump when the cached layout changes
+CACHE_VERSION = 1
+
+_loaded = {}
+
+
+def _sources():
+    return dict(
+        snotelmeta=os.path.join(dirs.snoteldir, 'snotelmeta.csv'),
+        huc6=os.path.join(dirs.projectdir, 'spatialdata', 'huc6.shp'),
+        huc8=os.path.join(dirs.projectdir, 'spatialdata', 'huc8.shp'),
+    )
+
+
+def _cache_path():
+    return os.path.join(dirs.cachedir, 'data', 'fos_data.pkl')
+
+
+def _fingerprint(sources):
+    # the attribute table of a shapefile lives in the .dbf next to the .shp
+    paths = list(sources.values()) + [
+        os.path.splitext(p)[0] + '.dbf' for p in sources.values() if p.endswith('.shp')
+    ]
+    fp = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            fp.append((path, st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            fp.append((path, None, None))
+    return fp
+
+
+def _make_snotel_gdf(snotelmeta):
+    import geopandas as gpd
+
+    return gpd.GeoDataFrame(data = {'site_name':snotelmeta.site_name,
+                                    'elev': snotelmeta.elev,
+                                    'site_number':snotelmeta.site_number,
+                                    'state':snotelmeta.state,
+                                    'namestr':snotelmeta.namestr,
+                                    'startdt':snotelmeta.startdt}, geometry = gpd.points_from_xy(snotelmeta.lon, snotelmeta.lat), crs = 'epsg:4326')
+
+
+def _huc_membership(snotel_gdf, huc):
+    """Name of the basin containing each site, indexed by site number (one spatial join)."""
+    import geopandas as gpd
+    import pandas as pd
+
+    if huc.crs is not None and huc.crs != snotel_gdf.crs:
+        huc = huc.to_crs(snotel_gdf.crs)
+    joined = gpd.sjoin(snotel_gdf[['site_number', 'geometry']], huc[['name', 'geometry']],
+                       how='left', predicate='within')
+    # overlapping basins: keep the first match like huc[huc.contains(point)] did
+    joined = joined[~joined.index.duplicated(keep='first')]
+    return pd.Series(joined.name.values, index = joined.site_number.values)
+
+
+def _load_cached():
+    """snotelmeta, in6s and in8s from the cache, rebuilt if any source changed."""
+    sources = _sources()
+    fp = _fingerprint(sources)
+    path = _cache_path()
+    try:
+        with open(path, 'rb') as fh:
+            state = pickle.load(fh)
+        if state.get('version') == CACHE_VERSION and state.get('fingerprint') == fp:
+            return state
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        pass
+
+    import pandas as pd
+
+    snotelmeta = pd.read_csv(sources['snotelmeta'])
+    snotel_gdf = _make_snotel_gdf(snotelmeta)
+    ## time series of the difference in time between peak SWE at the grid box where the SNOTEL resides
+    ## and the time of peak SWE across the HUC-6 watershed in which the SNOTEL resides
+    state = dict(
+        version=CACHE_VERSION,
+        fingerprint=fp,
+        snotelmeta=snotelmeta,
+        in6s=_huc_membership(snotel_gdf, _get('huc6')),
+        in8s=_huc_membership(snotel_gdf, _get('huc8')),
+    )
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as fh:
+        pickle.dump(state, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+    return state
+
+
+def _get(name):
+    if name in _loaded:
+        return _loaded[name]
+    if name in ('huc6', 'huc8'):
+        import geopandas as gpd
+
+        value = gpd.read_file(_sources()[name])
+    elif name in ('snotelmeta', 'in6s', 'in8s'):
+        value = _load_cached()[name]
+    elif name == 'snotel_gdf':
+        value = _make_snotel_gdf(_get('snotelmeta'))
+    elif name == 'snotel_no_ak':
+        snotel_gdf = _get('snotel_gdf')
+        value = snotel_gdf[snotel_gdf.state != "AK"]
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    _loaded[name] = value
+    return value
+
+
+def __getattr__(name):
+    # only called for names not yet in the module namespace (PEP 562)
+    value = _get(name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + ['snotelmeta', 'snotel_gdf', 'in6s', 'in8s',
+                                     'snotel_no_ak', 'huc6', 'huc8'])
+
+
+def reset():
+    """Forget everything loaded so the next access reloads (e.g. after changing dirs)."""
+    for name in list(_loaded):
+        globals().pop(name, None)
+    _loaded.clear()
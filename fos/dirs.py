@@ -7,3 +7,8 @@ projectdir = basedir + 'fos-data/'
 snoteldir = projectdir + 'snoteldata/'
 wrfdir = '/glade/campaign/uwyo/wyom0112/postprocess/'
 coorddir = projectdir + 'wrf_coordinates/'
+
+## local caches (catalogs, converted stores, etc.) - set with FOS_CACHE_DIR
+cachedir = os.path.expanduser(os.environ.get("FOS_CACHE_DIR", "~/.fos_cachedir"))
+## time-series optimized stores written by `fos convert` - set with FOS_STORE_DIR
+storedir = os.path.expanduser(os.environ.get("FOS_STORE_DIR", os.path.join(cachedir, "stores")))
@@ -0,0 +1,138 @@
+"""!
+Elevation-band aggregation of gridded WRF fields.
+
+Every grid cell gets one elevation-band label from HGT, and each (region, band) group
+becomes a row of a sparse group x cell matrix. A field is then reduced one time chunk
+at a time with a few sparse products, so memory is bounded by the chunk instead of
+bands x grid x time as with a broadcast boolean mask.
+```
+lat, lon, hgt, _ = util._read_wrf_meta_data(coorddir, "d02")
+bands = ElevationBands(hgt[0], lat[0], lon[0], step=100)
+stats = bands.reduce(swe)  # (region, band, day): mean, sum, area, snow_fraction
+```
+"""
+
+import dask.array as dsa
+import numpy as np
+import xarray as xr
+from scipy import sparse
+
+from fos.compact import unpack
+from fos.spatial import REGIONS, region_mask
+
+## weighted sums computed per time chunk, in kernel order
+_SUMS = ["sum", "area", "snow_area"]
+
+
+def band_edges(hgt, step: float = 100.0, start: float = None) -> np.ndarray:
+    """Band edges from `start` (default the lowest cell) past the highest cell, every `step`."""
+    hgt = np.asarray(hgt, dtype=np.float64)
+    start = np.nanmin(hgt) if start is None else start
+    return np.arange(start, np.nanmax(hgt) + step, step)
+
+
+def band_labels(hgt, edges) -> np.ndarray:
+    """Band index of every cell, edges[i] <= hgt < edges[i + 1], -1 outside the edges or NaN."""
+    hgt = np.asarray(hgt, dtype=np.float64)
+    labels = np.searchsorted(edges, hgt, side="right") - 1
+    labels[~np.isfinite(hgt) | (labels >= len(edges) - 1)] = -1
+    return labels
+
+
+class ElevationBands:
+    """!
+    Elevation bands x regions of a WRF grid, see the module docstring.
+    @param hgt [array-like]: (lat2d, lon2d) terrain height, e.g. HGT[0] of wrfinput.
+    @param lat2d, lon2d [array-like]: cell center coordinates.
+    @param step [float]: band width in HGT units (m).
+    @param edges [array-like]: explicit band edges instead of `step`.
+    @param regions [list]: names from spatial.REGIONS, default all of them.
+    @param area [array-like]: optional (lat2d, lon2d) cell areas used as weights,
+        e.g. dx * dy / MAPFAC_M**2 from util.get_cell_area. Without it every cell
+        weighs 1: sums, areas and means are per cell count, not area weighted.
+        util.get_elevation_bands passes the WRF cell areas.
+    """
+
+    def __init__(
+        self, hgt, lat2d, lon2d, step: float = 100.0, edges=None, regions=None, area=None
+    ):
+        hgt = np.asarray(hgt, dtype=np.float64)
+        self.shape = hgt.shape
+        self.edges = band_edges(hgt, step) if edges is None else np.asarray(edges, np.float64)
+        self.labels = band_labels(hgt, self.edges)
+        self.regions = list(REGIONS) if regions is None else list(regions)
+        self.nbands = len(self.edges) - 1
+        area = np.ones(self.shape) if area is None else np.asarray(area, dtype=np.float64)
+
+        # one row per (region, band), weighted by the cell area
+        rows, cols, vals = [], [], []
+        flat_labels, flat_area = self.labels.ravel(), area.ravel()
+        for r, region in enumerate(self.regions):
+            cells = np.flatnonzero(region_mask(lat2d, lon2d, region).ravel() & (flat_labels >= 0))
+            rows.append(r * self.nbands + flat_labels[cells])
+            cols.append(cells)
+            vals.append(flat_area[cells])
+        self.weights = sparse.csr_matrix(
+            (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+            shape=(len(self.regions) * self.nbands, int(np.prod(self.shape))),
+        )
+
+    @property
+    def centers(self) -> np.ndarray:
+        return (self.edges[:-1] + self.edges[1:]) / 2
+
+    def _kernel(self, block, threshold):
+        """(time, lat2d, lon2d) block -> (time, len(_SUMS), groups)."""
+        flat = block.reshape(block.shape[0], -1).astype(np.float64)
+        valid = np.isfinite(flat)
+        sums = [np.where(valid, flat, 0.0), valid, valid & (flat > threshold)]
+        # (groups, cells) x (cells, time) for each sum
+        return np.stack([self.weights.dot(x.T.astype(np.float64)).T for x in sums], axis=1)
+
+    def reduce(
+        self, data: xr.DataArray, threshold: float = 0.0, dim: str = "day", time_chunk: int = 365
+    ) -> xr.Dataset:
+        """!
+        Area-weighted statistics of `data` per region x band (x time).
+        Dask input stays lazy; it is rechunked to `time_chunk` steps over the whole grid
+        and every chunk is reduced independently, so time chunks run in parallel.
+        @param data [xr.DataArray]: (dim, lat2d, lon2d) field, or a (lat2d, lon2d) map.
+        @param threshold [float]: values above this count as snow covered.
+        @return xr.Dataset over (region, band[, dim]) with sum (area-weighted sum),
+            mean (sum / valid area), area (valid area), snow_fraction, and band_lower /
+            band_upper / band_center coordinates.
+        """
+        # int16-packed input (fos.compact) is decoded block by block, sums are float64
+        data = unpack(data)
+        squeeze = dim not in data.dims
+        if squeeze:
+            data = data.expand_dims(dim)
+        data = data.transpose(dim, "lat2d", "lon2d")
+        arr = data.data
+        ngroups = len(self.regions) * self.nbands
+        if isinstance(arr, dsa.Array):
+            arr = arr.rechunk({0: time_chunk, 1: -1, 2: -1})
+            out = arr.map_blocks(
+                self._kernel,
+                threshold,
+                dtype=np.float64,
+                chunks=(arr.chunks[0], (len(_SUMS),), (ngroups,)),
+            )
+        else:
+            out = self._kernel(np.asarray(arr), threshold)
+        out = out.reshape(out.shape[0], len(_SUMS), len(self.regions), self.nbands)
+
+        dims = (dim, "region", "band")
+        coords = {
+            dim: data[dim].values if dim in data.coords else np.arange(data.sizes[dim]),
+            "region": self.regions,
+            "band": np.arange(self.nbands),
+            "band_lower": ("band", self.edges[:-1]),
+            "band_upper": ("band", self.edges[1:]),
+            "band_center": ("band", self.centers),
+        }
+        ds = xr.Dataset({name: (dims, out[:, i]) for i, name in enumerate(_SUMS)}, coords=coords)
+        ds["mean"] = ds["sum"] / ds["area"].where(ds["area"] > 0)
+        ds["snow_fraction"] = ds["snow_area"] / ds["area"].where(ds["area"] > 0)
+        ds = ds[["mean", "sum", "area", "snow_fraction"]].transpose("region", "band", dim)
+        return ds.isel({dim: 0}, drop=True) if squeeze else ds
@@ -0,0 +1,186 @@
+"""!
+Multi-GCM ensembles of the bias-corrected WRF runs.
+
+Every model/variant of the catalog becomes one `member`: its historical and ssp370
+runs are read with `util._wrfread_gcm`, cut to the windows of `util.get_wrf_data`
+and joined along `day`, and all members are stacked lazily into one Dataset.
+Reductions run on a local multi-process dask cluster with a memory cap per worker,
+one computation per member, so a member with a broken file is reported instead of
+aborting the whole ensemble:
+```
+ens, failed = open_ensemble(wrfdir, "snow", subset="SW")
+with local_scheduler(workers=8, memory_limit="6GiB") as client:
+    peak, failed_too = map_members(lambda m: m.snow.max("day"), ens, client=client)
+```
+"""
+
+import contextlib
+import os
+
+import pandas as pd
+import xarray as xr
+
+from fos.catalog import get_catalog
+from fos.timeaxis import add_water_year_coords
+from fos.util import _wrfread_gcm, console, screen_times_wrf
+
+## ([year, month, day] start, end) kept of each experiment, as in util.get_wrf_data
+EXPERIMENT_WINDOWS = {
+    "historical": ([1980, 1, 1], [2013, 12, 31]),
+    "ssp370": ([2014, 1, 1], [2100, 12, 31]),
+}
+
+
+def ensemble_members(
+    wrfdir: str, var: str = "snow", domain: str = "d02", bc: bool = True, experiments=None
+) -> pd.DataFrame:
+    """!
+    Discover the model/variant/experiment runs that hold `var`.
+    @param experiments [list]: experiments to include, default EXPERIMENT_WINDOWS.
+    @return pd.DataFrame with member, model, variant, experiment, run, first and last
+        year, one row per run, sorted by member.
+    """
+    experiments = list(EXPERIMENT_WINDOWS) if experiments is None else list(experiments)
+    table = get_catalog(wrfdir).query(variable=var, domain=domain, bc=bc, sampling="daily")
+    table = table[table.experiment.isin(experiments)]
+    runs = (
+        table.groupby(["model", "variant", "experiment", "run"], as_index=False)
+        .agg(first=("year", "min"), last=("year", "max"))
+        .sort_values(["model", "variant", "experiment"], ignore_index=True)
+    )
+    runs.insert(0, "member", runs.model + "_" + runs.variant)
+    return runs
+
+
+def _open_member(wrfdir, runs, var, domain, subset):
+    """One member's runs read lazily, cut to their windows and joined along day."""
+    parts = []
+    for row in runs.itertuples():
+        date_start, date_end = EXPERIMENT_WINDOWS[row.experiment]
+        # only open the year files the window needs (+1 in case a file holds a water year)
+        years = (date_start[0], date_end[0] + 1)
+        datadir = os.path.join(wrfdir, row.run, "postprocess")
+        data = _wrfread_gcm(
+            row.experiment, row.run, row.variant, datadir, var, domain, years=years, subset=subset
+        )
+        parts.append(screen_times_wrf(data, date_start, date_end))
+    data = xr.concat(parts, dim="day") if len(parts) > 1 else parts[0]
+    return data.drop_vars(["water_year", "dowy"]).sortby("day")
+
+
+def open_ensemble(
+    wrfdir: str,
+    var: str = "snow",
+    domain: str = "d02",
+    members=None,
+    experiments=None,
+    subset=None,
+):
+    """!
+    Open every member of the ensemble as one lazy Dataset.
+    @param members [list]: optional member names ({model}_{variant}) to open.
+    @param experiments [list]: experiments joined per member, default EXPERIMENT_WINDOWS.
+    @param subset: optional spatial subset, see `util._wrfread_gcm`.
+    @return (xr.Dataset with `var` over (member, day, lat2d, lon2d) and model/variant
+        member coordinates, {member: error message} of the members that failed to
+        open). Members covering fewer days are padded with NaN.
+    """
+    runs = ensemble_members(wrfdir, var, domain, experiments=experiments)
+    if members is not None:
+        runs = runs[runs.member.isin(members)]
+    groups = dict(list(runs.groupby("member", sort=True)))
+    if not groups:
+        raise ValueError(f"No {var} runs found in {wrfdir}")
+
+    # opened one after the other: only metadata is read here, and HDF5 is not
+    # thread-safe while files are opened
+    opened, failures = {}, {}
+    for member, group in groups.items():
+        try:
+            opened[member] = _open_member(wrfdir, group, var, domain, subset)
+        except Exception as err:
+            failures[member] = f"{type(err).__name__}: {err}"
+    _report(failures, "open")
+    if not opened:
+        raise RuntimeError(f"Every member failed to open: {failures}")
+
+    names = list(opened)
+    stacked = xr.concat(
+        [opened[m] for m in names], dim=pd.Index(names, name="member"), join="outer"
+    )
+    first = runs.drop_duplicates("member").set_index("member").loc[names]
+    ds = stacked.to_dataset(name=var).assign_coords(
+        model=("member", first.model.to_numpy()), variant=("member", first.variant.to_numpy())
+    )
+    return add_water_year_coords(ds), failures
+
+
+@contextlib.contextmanager
+def local_scheduler(
+    workers: int = 4, memory_limit="4GiB", threads_per_worker: int = 1, **kwargs
+):
+    """!
+    Local multi-process dask cluster, used as the scheduler inside the `with` block.
+    Workers past ~80% of `memory_limit` spill to disk and are restarted at 95%.
+    @param workers [int]: number of worker processes.
+    @param memory_limit [str or int]: memory cap per worker, e.g. "4GiB".
+    @param threads_per_worker [int]: threads of each worker.
+    @param kwargs: passed to dask.distributed.LocalCluster.
+    @return yields the dask.distributed.Client.
+    """
+    # imported here, starting the distributed machinery is only needed for a cluster
+    from dask.distributed import Client, LocalCluster
+
+    with LocalCluster(
+        n_workers=workers,
+        threads_per_worker=threads_per_worker,
+        memory_limit=memory_limit,
+        processes=True,
+        **kwargs,
+    ) as cluster, Client(cluster) as client:
+        console.log(f"dask cluster with {workers} workers at {client.dashboard_link}")
+        yield client
+
+
+def map_members(func, ensemble: xr.Dataset, client=None):
+    """!
+    Apply a (lazy) reduction to every member and compute the members independently.
+    @param func: called with the Dataset of one member, returns xarray objects.
+    @param ensemble [xr.Dataset]: from `open_ensemble`.
+    @param client: optional dask.distributed.Client (see `local_scheduler`); members
+        are computed concurrently on it, else one after the other.
+    @return (results stacked along `member`, {member: error message} of the members
+        whose reduction failed).
+    """
+    lazy, failures = {}, {}
+    for member in ensemble.member.values.tolist():
+        try:
+            lazy[member] = func(ensemble.sel(member=member))
+        except Exception as err:
+            failures[member] = f"{type(err).__name__}: {err}"
+
+    results = {}
+    if client is not None:
+        futures = dict(zip(lazy, client.compute(list(lazy.values()))))
+        for member, future in futures.items():
+            try:
+                results[member] = future.result()
+            except Exception as err:
+                failures[member] = f"{type(err).__name__}: {err}"
+    else:
+        for member, value in lazy.items():
+            try:
+                results[member] = value.compute()
+            except Exception as err:
+                failures[member] = f"{type(err).__name__}: {err}"
+    _report(failures, "reduce")
+    if not results:
+        return None, failures
+    names = list(results)
+    stacked = xr.concat([results[m] for m in names], dim="member")
+    return stacked.assign_coords(member=names), failures
+
+
+def _report(failures, what):
+    for member, message in failures.items():
+        console.log(f"{member} failed to {what}: {message}", style="bold red")
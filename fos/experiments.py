@@ -0,0 +1,236 @@
+"""!
+Experiment runner: fit the batched `fos.models` baselines for every experiment x model
+x parameter combination x site chunk over a process pool, score every window with
+`fos.metrics.skill` and collect one tidy table.
+
+An experiment names where its forcing and observations come from, as site x day
+stores (`fos.sitestore`), e.g. the wrfpoint -> wrfbasin regression of one GCM:
+```
+experiments = [
+    dict(
+        name="ukesm1-0-ll_bc",
+        forcing={"SNOTEL_SWE": ("~/.fos_cachedir/stores/wrfts/ukesm1-0-ll_bc", "wrfpoint")},
+        obs={"SWE": ("~/.fos_cachedir/stores/wrfts/ukesm1-0-ll_bc", "wrfbasin")},
+    ),
+]
+models = [("linear", {}), ("poly", {"degree": [2, 3]})]
+time_periods = {"train": ("1981-10-01", "2010-09-30"), "test": ("2010-10-01", "2099-09-30")}
+table, failures = run_experiments(experiments, models, time_periods, output="results.parquet")
+```
+Workers open the stores as memory maps, so no forcing data is pickled between
+processes. Every finished task is written to `{output}.parts/` and skipped when the
+run is started again, so an interrupted sweep resumes where it stopped. Tasks that fail
+are returned and written to `{output stem}.failures.csv`, and run again next time.
+"""
+
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+import xarray as xr
+
+from fos.metrics import METRICS, skill
+from fos.models import BATCHED_KINDS, run_batched
+from fos.sitestore import SiteDayStore
+from fos.util import console, make_time_lists
+
+COLUMNS = ["experiment", "model", "params", "site", "window", "variable"] + METRICS
+FAILURE_COLUMNS = ["experiment", "model", "params", "first_site", "last_site", "error"]
+## sites fitted together in one task
+SITE_CHUNK = 100
+
+
+def expand_models(models) -> list:
+    """!
+    Expand parameter grids into single model configurations.
+    @param models [list]: (kind, grid) pairs, each grid value a scalar or a list of values.
+    @return [(kind, params)] with one entry per combination.
+    """
+    out = []
+    for kind, grid in models:
+        if kind not in BATCHED_KINDS:
+            raise ValueError(f"Unknown model {kind!r}, use one of {BATCHED_KINDS}")
+        keys = sorted(grid)
+        values = [v if isinstance(v, (list, tuple)) else [v] for v in (grid[k] for k in keys)]
+        for combo in itertools.product(*values):
+            out.append((kind, dict(zip(keys, combo))))
+    return out
+
+
+def _store_path(path):
+    return os.path.expanduser(path)
+
+
+def experiment_sites(experiment: dict, sites=None) -> list:
+    """Sites present in every store of an experiment, optionally restricted to `sites`."""
+    common = None
+    for path, _ in list(experiment["forcing"].values()) + list(experiment["obs"].values()):
+        numbers = set(SiteDayStore(_store_path(path)).sites.tolist())
+        common = numbers if common is None else common & numbers
+    if sites is not None:
+        common &= set(sites)
+    return sorted(common)
+
+
+def _load(spec: dict, sites, start, end, units):
+    """Dataset of the (site, date) series named in a {name: (store, variable)} spec."""
+    data = {}
+    for name, (path, var) in spec.items():
+        store = SiteDayStore(_store_path(path))
+        data[name] = store.to_xarray(var, sites=sites, start=start, end=end, units=units)
+    return xr.Dataset(data).rename(day="date").compute()
+
+
+def run_task(experiment: dict, kind: str, params: dict, sites, time_periods: dict, units=None):
+    """!
+    Fit one model configuration for a chunk of sites of one experiment.
+    @return tidy pd.DataFrame with COLUMNS, one row per site x window x variable.
+    """
+    dates_lists = make_time_lists(time_periods)
+    start = min(d[0] for d in dates_lists.values())
+    end = max(d[-1] for d in dates_lists.values())
+    forcing = _load(experiment["forcing"], sites, start, end, units)
+    obs = _load(experiment["obs"], sites, start, end, units)
+    model_params = dict(params, vars=list(experiment["obs"]), fvars=list(experiment["forcing"]))
+    model_out, _ = run_batched(kind, forcing, obs, dates_lists, model_params)
+
+    # one call scores every variable x window x site
+    value = model_out["value"]
+    scores = skill(value.sel(kind="obs"), value.sel(kind="sim"), dim="step")
+    table = scores.to_dataframe()[METRICS].reset_index()
+    table.insert(0, "experiment", experiment["name"])
+    table.insert(1, "model", kind)
+    table.insert(2, "params", json.dumps(params, sort_keys=True))
+    return table[COLUMNS]
+
+
+def _task_id(experiment, kind, params, sites, time_periods, units):
+    key = json.dumps(
+        [experiment, kind, params, [int(s) for s in sites], time_periods, units], sort_keys=True
+    )
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def run_experiments(
+    experiments: list,
+    models: list,
+    time_periods: dict,
+    sites=None,
+    output: str = None,
+    workers: int = 4,
+    site_chunk: int = SITE_CHUNK,
+    units: str = None,
+) -> tuple:
+    """!
+    Run every experiment x model configuration x site chunk, see the module docstring.
+    @param experiments [list]: dicts with a name and forcing/obs {name: (store, variable)}.
+    @param models [list]: (kind, parameter grid) pairs, see `expand_models`.
+    @param time_periods [dict]: {window: (start, end)}, must include 'train'.
+    @param sites [list]: optional site numbers, default every site in all stores.
+    @param output [str]: parquet path of the table. Finished tasks are kept in
+        `{output}.parts/` so rerunning resumes an interrupted sweep, failed tasks are
+        written next to it as `{output stem}.failures.csv`.
+    @param workers [int]: number of processes, 1 runs in this process.
+    @param site_chunk [int]: sites fitted together per task.
+    @param units [str]: convert every series to these units on load, e.g. 'in'.
+    @return (table, failures): pd.DataFrame with COLUMNS of the finished tasks and a
+        pd.DataFrame with FAILURE_COLUMNS of the tasks that failed.
+    """
+    if "train" not in time_periods:
+        raise ValueError("time_periods needs a 'train' window")
+    time_periods = {k: [str(v) for v in dates] for k, dates in time_periods.items()}
+    partdir = None if output is None else f"{os.path.splitext(output)[0]}.parts"
+    if partdir is not None:
+        os.makedirs(partdir, exist_ok=True)
+
+    tasks = {}
+    for experiment in experiments:
+        numbers = experiment_sites(experiment, sites)
+        for kind, params in expand_models(models):
+            for i in range(0, len(numbers), site_chunk):
+                chunk = numbers[i : i + site_chunk]
+                task = (experiment, kind, params, chunk, time_periods, units)
+                tasks[_task_id(*task)] = task
+
+    frames, todo = [], {}
+    for task_id, task in tasks.items():
+        part = None if partdir is None else os.path.join(partdir, f"{task_id}.parquet")
+        if part is not None and os.path.exists(part):
+            frames.append(pd.read_parquet(part))
+        else:
+            todo[task_id] = task
+    console.log(f"{len(tasks)} tasks, {len(tasks) - len(todo)} already done")
+
+    def finish(task_id, table):
+        if partdir is not None:
+            part = os.path.join(partdir, f"{task_id}.parquet")
+            table.to_parquet(f"{part}.tmp", index=False)
+            os.replace(f"{part}.tmp", part)
+        frames.append(table)
+
+    failures = []
+
+    def record_failure(task, err):
+        experiment, kind, params, chunk, _, _ = task
+        failures.append(
+            dict(
+                experiment=experiment["name"],
+                model=kind,
+                params=json.dumps(params, sort_keys=True),
+                first_site=chunk[0],
+                last_site=chunk[-1],
+                error=f"{type(err).__name__}: {err}",
+            )
+        )
+
+    if workers == 1:
+        for task_id, task in todo.items():
+            try:
+                finish(task_id, run_task(*task))
+            except Exception as err:
+                record_failure(task, err)
+    else:
+        # spawn: forking a process that already runs dask/BLAS threads can deadlock
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            futures = {pool.submit(run_task, *task): task_id for task_id, task in todo.items()}
+            for future in as_completed(futures):
+                try:
+                    finish(futures[future], future.result())
+                except Exception as err:
+                    record_failure(tasks[futures[future]], err)
+    failures = pd.DataFrame(failures, columns=FAILURE_COLUMNS)
+    if len(failures) > 0:
+        console.log(f"{len(failures)}/{len(todo)} tasks failed:", style="bold red")
+        for _, row in failures.iterrows():
+            console.log(
+                f"  {row.experiment} {row.model} {row.params} sites "
+                f"{row.first_site}..{row.last_site}: {row.error}"
+            )
+
+    table = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=COLUMNS)
+    table = table.sort_values(
+        ["experiment", "model", "params", "site", "window", "variable"], ignore_index=True
+    )
+    if output is not None:
+        table.to_parquet(output, index=False)
+        failures.to_csv(os.path.splitext(output)[0] + ".failures.csv", index=False)
+    return table, failures
+
+
+def load_config(path: str) -> dict:
+    """!
+    Read a JSON experiment description with the keys experiments, models (a list of
+    [kind, grid]), time_periods and optionally sites, units and site_chunk.
+    """
+    with open(path) as fh:
+        config = json.load(fh)
+    config["models"] = [tuple(m) for m in config["models"]]
+    for experiment in config["experiments"]:
+        for key in ("forcing", "obs"):
+            experiment[key] = {k: tuple(v) for k, v in experiment[key].items()}
+    return config
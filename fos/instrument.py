@@ -0,0 +1,250 @@
+"""!
+Lightweight performance instrumentation: per-stage timers and counters, files and
+bytes read, a summary of the dask tasks run, and peak memory, written as a JSON or
+JSON-lines report.
+
+Instrumentation is off by default and then costs one flag check per call. Turn it on
+with `enable()`, FOS_INSTRUMENT=1, or `fos --report report.jsonl <subcommand>`:
+```
+from fos import instrument
+
+instrument.enable()
+data = util._wrfread_gcm(...)                 # timed as the "_wrfread_gcm" stage
+with instrument.stage("peaks"):
+    peaks = water_year_metrics(data).compute()
+instrument.write_report("run.jsonl")
+```
+Stages record wall and CPU seconds and the process I/O (/proc/self/io, Linux) while
+they ran. Readers only open files lazily, so the bytes pulled by dask show up in the
+stage that computes, and in the dask task summary (count and seconds per task
+prefix, local schedulers only).
+"""
+
+import contextlib
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+from dask.callbacks import Callback
+
+## bump when the report layout changes
+REPORT_VERSION = 1
+
+_state = dict(enabled=False)
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def _io():
+    """Bytes read and written by this process so far, zeros where unsupported."""
+    try:
+        with open("/proc/self/io") as fh:
+            io = dict(line.split(": ") for line in fh.read().splitlines())
+        return dict(
+            rchar=int(io["rchar"]),
+            read_bytes=int(io["read_bytes"]),
+            wchar=int(io["wchar"]),
+        )
+    except (OSError, KeyError, ValueError):
+        return dict(rchar=0, read_bytes=0, wchar=0)
+
+
+def peak_rss() -> int:
+    """Peak resident memory of this process (and finished children) in bytes."""
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * scale
+
+
+class _TaskStats(Callback):
+    """dask callback counting tasks and their seconds per key prefix."""
+
+    def __init__(self):
+        super().__init__()
+        self.tasks = {}
+        self._began = {}
+
+    def _pretask(self, key, dsk, state):
+        self._began[key] = time.perf_counter()
+
+    def _posttask(self, key, result, dsk, state, worker_id):
+        seconds = time.perf_counter() - self._began.pop(key, time.perf_counter())
+        name = key[0] if isinstance(key, tuple) else key
+        prefix = str(name).rsplit("-", 1)[0]
+        with _lock:
+            count, total = self.tasks.get(prefix, (0, 0.0))
+            self.tasks[prefix] = (count + 1, total + seconds)
+
+
+class Recorder:
+    """Collected stage records and counters of one process."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.records = []
+        self.counters = {}
+        self.tasks = _TaskStats()
+
+    def summary(self) -> dict:
+        """Totals per stage name, the counters, dask tasks, I/O and peak memory."""
+        stages = {}
+        for record in self.records:
+            total = stages.setdefault(
+                record["stage"], dict(calls=0, seconds=0.0, cpu_seconds=0.0, rchar=0)
+            )
+            total["calls"] += 1
+            total["seconds"] += record["seconds"]
+            total["cpu_seconds"] += record["cpu_seconds"]
+            total["rchar"] += record["rchar"]
+        tasks = {
+            prefix: dict(count=count, seconds=round(seconds, 6))
+            for prefix, (count, seconds) in sorted(self.tasks.tasks.items())
+        }
+        return dict(
+            version=REPORT_VERSION,
+            started=self.started,
+            seconds=round(time.time() - self.started, 6),
+            argv=sys.argv,
+            stages=stages,
+            counters=dict(self.counters),
+            dask_tasks=tasks,
+            io=_io(),
+            peak_rss=peak_rss(),
+        )
+
+
+_recorder = Recorder()
+
+
+def enable():
+    """Start recording, and collect dask task statistics."""
+    if not _state["enabled"]:
+        _state["enabled"] = True
+        _recorder.tasks.register()
+
+
+def disable():
+    """Stop recording, the collected records are kept until `reset`."""
+    if _state["enabled"]:
+        _state["enabled"] = False
+        _recorder.tasks.unregister()
+
+
+def enabled() -> bool:
+    return _state["enabled"]
+
+
+def reset():
+    """Drop every record and counter."""
+    was = enabled()
+    disable()
+    _recorder.reset()
+    if was:
+        enable()
+
+
+def count(name: str, value=1):
+    """Add `value` to the counter `name` (also to the current stage's counters)."""
+    if not _state["enabled"]:
+        return
+    with _lock:
+        _recorder.counters[name] = _recorder.counters.get(name, 0) + value
+    for frame in getattr(_local, "stack", []):
+        frame[name] = frame.get(name, 0) + value
+
+
+@contextlib.contextmanager
+def stage(name: str, **info):
+    """!
+    Time a block as one record of stage `name`.
+    @param info: extra JSON-serializable fields stored with the record.
+    """
+    if not _state["enabled"]:
+        yield
+        return
+    stack = _local.__dict__.setdefault("stack", [])
+    counters = {"__stage__": name}
+    stack.append(counters)
+    io0, wall0, cpu0 = _io(), time.perf_counter(), time.process_time()
+    error = None
+    try:
+        yield
+    except BaseException as err:
+        error = type(err).__name__
+        raise
+    finally:
+        stack.pop()
+        io1 = _io()
+        record = dict(
+            stage=name,
+            parent=stack[-1].get("__stage__") if stack else None,
+            start=time.time() - (time.perf_counter() - wall0),
+            seconds=round(time.perf_counter() - wall0, 6),
+            cpu_seconds=round(time.process_time() - cpu0, 6),
+            **{key: io1[key] - io0[key] for key in io1},
+            counters={k: v for k, v in counters.items() if k != "__stage__"},
+            peak_rss=peak_rss(),
+            **info,
+        )
+        if error is not None:
+            record["error"] = error
+        with _lock:
+            _recorder.records.append(record)
+
+
+def timed(func=None, *, name: str = None):
+    """Decorator recording every call of `func` as a stage, see `stage`."""
+    if func is None:
+        return functools.partial(timed, name=name)
+    label = name or func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _state["enabled"]:
+            return func(*args, **kwargs)
+        with stage(label):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def report() -> dict:
+    """The summary plus every stage record."""
+    return dict(_recorder.summary(), records=list(_recorder.records))
+
+
+def write_report(path: str) -> str:
+    """!
+    Write the report. A `.jsonl` path gets one line per stage record followed by one
+    summary line, appended so successive runs can be compared; any other path gets
+    the whole report as one JSON document.
+    @return path
+    """
+    path = os.path.expanduser(path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    if path.endswith(".jsonl"):
+        summary = _recorder.summary()
+        run = f"{os.getpid()}-{summary['started']}"
+        with open(path, "a") as fh:
+            for record in _recorder.records:
+                fh.write(json.dumps(dict(record, type="stage", run=run), default=str) + "\n")
+            fh.write(json.dumps(dict(summary, type="summary", run=run), default=str) + "\n")
+    else:
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as fh:
+            json.dump(report(), fh, indent=1, default=str)
+        os.replace(tmp, path)
+    return path
+
+
+if os.environ.get("FOS_INSTRUMENT", "").lower() in ("1", "true", "yes"):
+    enable()
@@ -0,0 +1,188 @@
+"""!
+Skill metrics of simulated against observed series.
+
+Every metric takes xarray objects (numpy or dask backed) and reduces over one
+dimension, `dim` (default "date"), so a single call scores every site, model, window
+or ensemble member held in the other dimensions. Days where either series is NaN are
+left out pairwise.
+
+For series too long to hold in memory, `SkillAccumulator` collects the sufficient
+statistics one time chunk at a time and gives the same values (except peak timing).
+Means, squared deviations and the co-moment are merged pairwise, which stays accurate
+for series with a large offset relative to their spread.
+"""
+
+import numpy as np
+import xarray as xr
+
+from fos.snowmetrics import water_year_metrics
+
+## metrics computed by `skill` and `SkillAccumulator.result`
+METRICS = ["nse", "kge", "r", "alpha", "beta", "rmse", "mae", "bias"]
+
+
+def _paired(obs, sim):
+    """obs and sim with every day that is missing in either set to NaN in both."""
+    valid = obs.notnull() & sim.notnull()
+    return obs.where(valid), sim.where(valid)
+
+
+def nse(obs: xr.DataArray, sim: xr.DataArray, dim: str = "date") -> xr.DataArray:
+    """Nash-Sutcliffe efficiency, 1 - sum((sim - obs)^2) / sum((obs - mean(obs))^2)."""
+    obs, sim = _paired(obs, sim)
+    numerator = ((sim - obs) ** 2).sum(dim)
+    denominator = ((obs - obs.mean(dim)) ** 2).sum(dim)
+    return 1 - numerator / denominator
+
+
+def kge_components(obs: xr.DataArray, sim: xr.DataArray, dim: str = "date") -> xr.Dataset:
+    """!
+    Kling-Gupta efficiency and its components.
+    @return xr.Dataset with kge, r (pearson correlation), alpha (std(sim) / std(obs)) and
+        beta (mean(sim) / mean(obs)).
+    """
+    obs, sim = _paired(obs, sim)
+    mean_obs, mean_sim = obs.mean(dim), sim.mean(dim)
+    std_obs, std_sim = obs.std(dim), sim.std(dim)
+    r = ((obs - mean_obs) * (sim - mean_sim)).mean(dim) / (std_obs * std_sim)
+    alpha = std_sim / std_obs
+    beta = mean_sim / mean_obs
+    kge = 1 - np.sqrt((r - 1) ** 2 + (alpha - 1) ** 2 + (beta - 1) ** 2)
+    return xr.Dataset(dict(kge=kge, r=r, alpha=alpha, beta=beta))
+
+
+def kge(obs: xr.DataArray, sim: xr.DataArray, dim: str = "date") -> xr.DataArray:
+    """Kling-Gupta efficiency, see `kge_components`."""
+    return kge_components(obs, sim, dim).kge
+
+
+def rmse(obs: xr.DataArray, sim: xr.DataArray, dim: str = "date") -> xr.DataArray:
+    """Root mean squared error."""
+    obs, sim = _paired(obs, sim)
+    return np.sqrt(((sim - obs) ** 2).mean(dim))
+
+
+def mae(obs: xr.DataArray, sim: xr.DataArray, dim: str = "date") -> xr.DataArray:
+    """Mean absolute error."""
+    obs, sim = _paired(obs, sim)
+    return abs(sim - obs).mean(dim)
+
+
+def bias(obs: xr.DataArray, sim: xr.DataArray, dim: str = "date") -> xr.DataArray:
+    """Mean error, mean(sim - obs), positive when the simulation is too high."""
+    obs, sim = _paired(obs, sim)
+    return (sim - obs).mean(dim)
+
+
+def peak_timing(
+    obs: xr.DataArray, sim: xr.DataArray, dim: str = "date", absolute: bool = True
+) -> xr.DataArray:
+    """!
+    Error in the day of the annual peak, averaged over water years.
+    The peaks come from `snowmetrics.water_year_metrics` on the paired series.
+    @param absolute [bool]: mean absolute difference in days, else the mean signed
+        difference (positive when the simulated peak is late).
+    """
+    obs, sim = _paired(obs, sim)
+    diff = (
+        water_year_metrics(sim, dim=dim).peak_dowy - water_year_metrics(obs, dim=dim).peak_dowy
+    )
+    return (abs(diff) if absolute else diff).mean("water_year")
+
+
+def skill(obs: xr.DataArray, sim: xr.DataArray, dim: str = "date") -> xr.Dataset:
+    """All of METRICS in one Dataset."""
+    out = kge_components(obs, sim, dim)
+    out["nse"] = nse(obs, sim, dim)
+    out["rmse"] = rmse(obs, sim, dim)
+    out["mae"] = mae(obs, sim, dim)
+    out["bias"] = bias(obs, sim, dim)
+    return out[METRICS]
+
+
+class SkillAccumulator:
+    """!
+    Streaming version of `skill`: feed time chunks with `update` and read the metrics
+    with `result`. Only running sums over the non-time dimensions are kept.
+    ```
+    acc = SkillAccumulator(dim="date")
+    for start in range(0, ntime, 3650):
+        chunk = slice(start, start + 3650)
+        acc.update(obs.isel(date=chunk), sim.isel(date=chunk))
+    scores = acc.result()
+    ```
+    """
+
+    ## count, means, squared deviations and co-moment (merged pairwise), and plain sums
+    _SUMS = ["n", "mean_obs", "mean_sim", "m2_obs", "m2_sim", "comoment", "sse", "abs"]
+
+    def __init__(self, dim: str = "date"):
+        self.dim = dim
+        self.sums = None
+
+    def update(self, obs: xr.DataArray, sim: xr.DataArray):
+        """Add one time chunk."""
+        obs, sim = _paired(obs, sim)
+        # one chunk is held in memory, so memory stays bounded by the chunk
+        obs, sim = obs.astype(np.float64).compute(), sim.astype(np.float64).compute()
+        # deviations from the chunk's own means, 0 where a series has no valid day
+        mean_obs, mean_sim = obs.mean(self.dim).fillna(0), sim.mean(self.dim).fillna(0)
+        dev_obs, dev_sim = obs - mean_obs, sim - mean_sim
+        sums = dict(
+            n=obs.notnull().sum(self.dim),
+            mean_obs=mean_obs,
+            mean_sim=mean_sim,
+            m2_obs=(dev_obs**2).sum(self.dim),
+            m2_sim=(dev_sim**2).sum(self.dim),
+            comoment=(dev_obs * dev_sim).sum(self.dim),
+            sse=((sim - obs) ** 2).sum(self.dim),
+            abs=abs(sim - obs).sum(self.dim),
+        )
+        self.sums = sums if self.sums is None else self._merge(self.sums, sums)
+        return self
+
+    @staticmethod
+    def _merge(a: dict, b: dict) -> dict:
+        """!
+        Combine the statistics of two sets of days (Chan et al.'s pairwise update), so
+        the variances never come from differences of large raw sums.
+        """
+        n = a["n"] + b["n"]
+        safe = n.where(n > 0)
+        weight = (b["n"] / safe).fillna(0)
+        cross = (a["n"] * b["n"] / safe).fillna(0)
+        delta_obs = b["mean_obs"] - a["mean_obs"]
+        delta_sim = b["mean_sim"] - a["mean_sim"]
+        return dict(
+            n=n,
+            mean_obs=a["mean_obs"] + delta_obs * weight,
+            mean_sim=a["mean_sim"] + delta_sim * weight,
+            m2_obs=a["m2_obs"] + b["m2_obs"] + delta_obs**2 * cross,
+            m2_sim=a["m2_sim"] + b["m2_sim"] + delta_sim**2 * cross,
+            comoment=a["comoment"] + b["comoment"] + delta_obs * delta_sim * cross,
+            sse=a["sse"] + b["sse"],
+            abs=a["abs"] + b["abs"],
+        )
+
+    def result(self) -> xr.Dataset:
+        """METRICS from the accumulated statistics."""
+        n = self.sums["n"].where(self.sums["n"] > 0)
+        mean_obs, mean_sim = self.sums["mean_obs"], self.sums["mean_sim"]
+        m2_obs, m2_sim = self.sums["m2_obs"], self.sums["m2_sim"]
+        sse = self.sums["sse"]
+        r = self.sums["comoment"] / np.sqrt(m2_obs * m2_sim)
+        alpha = np.sqrt(m2_sim / m2_obs)
+        beta = mean_sim / mean_obs
+        out = xr.Dataset(
+            dict(
+                nse=1 - sse / m2_obs,
+                kge=1 - np.sqrt((r - 1) ** 2 + (alpha - 1) ** 2 + (beta - 1) ** 2),
+                r=r,
+                alpha=alpha,
+                beta=beta.where(n > 0),
+                rmse=np.sqrt(sse / n),
+                mae=self.sums["abs"] / n,
+                bias=(mean_sim - mean_obs).where(n > 0),
+            )
+        )
+        return out[METRICS]
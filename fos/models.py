@@ -2,7 +2,7 @@ import numpy as np
 from fos.util import partition_dataframe, make_time_lists
 from xarray.core.dataarray import DataArray
 from xarray.core.dataset import Dataset
-from fos.util import create_xarray_data_vars
+from fos.util import create_model_output, model_output_view
 
 def snotel_value(forcing_split: dict, obs_split: dict, dates_lists: dict, model_params: dict = {'vars': ['SWE'], 'fvars': ['SNOTEL_SWE']}):
     """ 
@@ -10,25 +10,17 @@ def snotel_value(forcing_split: dict, obs_split: dict, dates_lists: dict, model_
     """
     model_name = 'snotel_value'
     vars = model_params['vars']
-    fvars = model_params['fvars']
-    nvars = len(fvars)
     # train the model
     # (no training needed)
     model = lambda f: f['SNOTEL_SWE'].values
-    # apply the model
-    y = []
-    y_hat = []
-    dates = []
-    for j,window in enumerate(dates_lists.keys()):
-        for i, var in enumerate(vars):
-            y.append(obs_split[window][var].values)
-            dates.append(forcing_split[window]['SNOTEL_SWE'].index)
+    # apply the model, writing into views of the preallocated output
+    model_out = create_model_output(vars, dates_lists, model_params.get('site'))
+    for window in dates_lists.keys():
+        for var in vars:
+            model_output_view(model_out, 'obs', var, window)[0] = obs_split[window][var].values
             forcing = forcing_split[window]
-            y_hat.append(model(forcing))
-    y = np.concatenate(y, axis = 0).reshape(-1,nvars)
-    y_hat = np.concatenate(y_hat, axis = 0).reshape(-1, nvars)
-    
-    model_out = create_xarray_data_vars(vars, y = y, y_hat = y_hat, dates_lists= dates_lists)
+            sim = model(forcing)
+            model_output_view(model_out, 'sim', var, window)[0] = np.asarray(sim)
 
     return model_out, model_name
 
@@ -38,28 +30,19 @@ def snotel_with_offset(forcing_split: dict, obs_split: dict, dates_lists: dict,
     """
     model_name = 'snotel_with_offset'
     vars = model_params['vars']
-    fvars = model_params['fvars']
-    nvars = len(fvars)
     # train the model
     offset = float(obs_split['train'].mean()- forcing_split['train']['SNOTEL_SWE'].mean())
 
     model = lambda f: (f['SNOTEL_SWE'] + offset)
 
-    # apply the model
-    y = []
-    y_hat = []
-    dates = []
-    for j,window in enumerate(dates_lists.keys()):
-        for i, var in enumerate(vars):
-            y.append(obs_split[window][var].values)
-            dates.append(forcing_split[window]['SNOTEL_SWE'].index)
+    # apply the model, writing into views of the preallocated output
+    model_out = create_model_output(vars, dates_lists, model_params.get('site'))
+    for window in dates_lists.keys():
+        for var in vars:
+            model_output_view(model_out, 'obs', var, window)[0] = obs_split[window][var].values
             forcing = forcing_split[window]
             sim = model(forcing)
-            y_hat.append(sim)
-    y = np.concatenate(y, axis = 0).reshape(-1,nvars)
-    y_hat = np.concatenate(y_hat, axis = 0).reshape(-1, nvars)
-        
-    model_out = create_xarray_data_vars(vars, y = y, y_hat = y_hat, dates_lists= dates_lists)
+            model_output_view(model_out, 'sim', var, window)[0] = np.asarray(sim)
         
     return model_out, model_name
 
@@ -70,28 +53,18 @@ def training_mean(forcing_split: dict, obs_split: dict, dates_lists: dict, model
     model_name = 'snotel_with_offset'
     vars = model_params['vars']
     # train the model
-    fvars = model_params['fvars']
-
-    nvars = len(fvars)
     train_mean = float(forcing_split['train']['SNOTEL_SWE'].mean())
 
     model = lambda f: f['SNOTEL_SWE'] - f['SNOTEL_SWE'] + train_mean
 
-    # apply the model
-    y = []
-    y_hat = []
-    dates = []
-    for j,window in enumerate(dates_lists.keys()):
-        for i, var in enumerate(vars):
-            y.append(obs_split[window][var].values)
-            dates.append(forcing_split[window]['SNOTEL_SWE'].index)
+    # apply the model, writing into views of the preallocated output
+    model_out = create_model_output(vars, dates_lists, model_params.get('site'))
+    for window in dates_lists.keys():
+        for var in vars:
+            model_output_view(model_out, 'obs', var, window)[0] = obs_split[window][var].values
             forcing = forcing_split[window]
             sim = model(forcing)
-            y_hat.append(sim)
-    y = np.concatenate(y, axis = 0).reshape(-1,nvars)
-    y_hat = np.concatenate(y_hat, axis = 0).reshape(-1, nvars)
-        
-    model_out = create_xarray_data_vars(vars, y = y, y_hat = y_hat, dates_lists= dates_lists)
+            model_output_view(model_out, 'sim', var, window)[0] = np.asarray(sim)
         
     return model_out, model_name
 
@@ -114,21 +87,14 @@ def lin_reg(forcing_split: dict, obs_split: dict, dates_lists: dict, model_param
     df = pd.merge(forcing_split['train'], obs_split['train'], left_index=True, right_index=True)
     res = LinearRegression().fit(df[fvars].values.reshape(-1,nvars), df[['SWE']].values)
 
-    # apply the model
-    y = []
-    y_hat = []
-    dates = []
-    for j,window in enumerate(dates_lists.keys()):
-        for i, var in enumerate(vars):
-            y.append(obs_split[window][var].values)
-            dates.append(forcing_split[window]['SNOTEL_SWE'].index)
+    # apply the model, writing into views of the preallocated output
+    model_out = create_model_output(vars, dates_lists, model_params.get('site'))
+    for window in dates_lists.keys():
+        for var in vars:
+            model_output_view(model_out, 'obs', var, window)[0] = obs_split[window][var].values
             forcing = forcing_split[window][fvars].values.reshape(-1,nvars)
             sim = res.predict(forcing).flatten()
-            y_hat.append(sim)
-    y = np.concatenate(y, axis = 0).reshape(-1,nvars)
-    y_hat = np.concatenate(y_hat, axis = 0).reshape(-1, nvars)
-        
-    model_out = create_xarray_data_vars(vars, y = y, y_hat = y_hat, dates_lists= dates_lists)
+            model_output_view(model_out, 'sim', var, window)[0] = np.asarray(sim)
         
     return model_out, model_name
 
@@ -159,20 +125,134 @@ def poly_reg(forcing_split: dict, obs_split: dict, dates_lists: dict, model_para
     y = obs_split['train'][vars]
     res = model.fit(x, y)
 
-    # apply the model
-    y = []
-    y_hat = []
-    dates = []
-    for j,window in enumerate(dates_lists.keys()):
-        for i, var in enumerate(vars):
-            y.append(obs_split[window][var].values)
-            dates.append(forcing_split[window]['SNOTEL_SWE'].index)
+    # apply the model, writing into views of the preallocated output
+    model_out = create_model_output(vars, dates_lists, model_params.get('site'))
+    for window in dates_lists.keys():
+        for var in vars:
+            model_output_view(model_out, 'obs', var, window)[0] = obs_split[window][var].values
             forcing = forcing_split[window][fvars].values.reshape(-1,nvars)
             sim = res.predict(forcing).flatten()
-            y_hat.append(sim)
-    y = np.concatenate(y, axis = 0).reshape(-1,nvars)
-    y_hat = np.concatenate(y_hat, axis = 0).reshape(-1, nvars)
-        
-    model_out = create_xarray_data_vars(vars, y = y, y_hat = y_hat, dates_lists= dates_lists)
+            model_output_view(model_out, 'sim', var, window)[0] = np.asarray(sim)
     return model_out, model_name
         
+
+
+## batched engine: every site of a (site, date) stack fit at once
+
+import xarray as xr
+
+BATCHED_KINDS = ('value', 'offset', 'mean', 'linear', 'poly')
+
+
+def _poly_powers(nfeat: int, degree: int) -> np.ndarray:
+    """Exponents of each PolynomialFeatures column, same order as sklearn."""
+    return PolynomialFeatures(degree=degree).fit(np.zeros((1, nfeat))).powers_
+
+
+def design_matrix(x: np.ndarray, kind: str, degree: int = 3) -> np.ndarray:
+    """!
+    Regression design for x of shape (site, time, feature).
+    linear: [1, x...] (LinearRegression with an intercept), poly: the PolynomialFeatures
+    columns, bias first (the poly_reg pipeline has fit_intercept=False).
+    @return (site, time, coef)
+    """
+    if kind == 'linear':
+        return np.concatenate([np.ones(x.shape[:-1] + (1,)), x], axis=-1)
+    powers = _poly_powers(x.shape[-1], degree)
+    return np.prod(x[..., None, :] ** powers, axis=-1)
+
+
+def fit_batched(kind: str, x: np.ndarray, y: np.ndarray, degree: int = 3) -> np.ndarray:
+    """!
+    Fit one model per site for all sites at once.
+    value/offset/mean use NaN-skipping means like the pandas per-site versions; the
+    regressions solve the least-squares problem of every site in one batched SVD
+    (`np.linalg.pinv` over the site axis) on the days where x and y are all finite.
+    @param kind [str]: one of BATCHED_KINDS.
+    @param x [np.ndarray]: training forcing, (site, time, feature), or (site, time).
+    @param y [np.ndarray]: training observations, (site, time).
+    @param degree [int]: polynomial degree for kind='poly'.
+    @return (site, coef) parameters for `predict_batched`.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    x = x[..., None] if x.ndim == 2 else x
+    y = np.asarray(y, dtype=np.float64)
+    nsite = x.shape[0]
+    if kind == 'value':
+        return np.zeros((nsite, 0))
+    if kind == 'offset':
+        # mean(obs) - mean(forcing), each over its own valid days
+        return (np.nanmean(y, axis=1) - np.nanmean(x[..., 0], axis=1))[:, None]
+    if kind == 'mean':
+        return np.nanmean(x[..., 0], axis=1)[:, None]
+    if kind not in ('linear', 'poly'):
+        raise ValueError(f"Unknown batched model kind {kind!r}, use one of {BATCHED_KINDS}")
+
+    valid = np.isfinite(x).all(axis=-1) & np.isfinite(y)
+    design = design_matrix(np.where(valid[..., None], x, 0.0), kind, degree)
+    # rows of missing days are zeroed so they drop out of every site's problem
+    design = np.where(valid[..., None], design, 0.0)
+    target = np.where(valid, y, 0.0)
+    return np.einsum('sct,st->sc', np.linalg.pinv(design), target)
+
+
+def predict_batched(kind: str, params: np.ndarray, x: np.ndarray, degree: int = 3) -> np.ndarray:
+    """!
+    Apply the per-site parameters from `fit_batched` to forcing of shape
+    (site, time, feature) or (site, time).
+    @return (site, time) predictions, NaN where the forcing is NaN.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    x = x[..., None] if x.ndim == 2 else x
+    if kind == 'value':
+        return x[..., 0].copy()
+    if kind == 'offset':
+        return x[..., 0] + params
+    if kind == 'mean':
+        return x[..., 0] - x[..., 0] + params
+    return np.einsum('stc,sc->st', design_matrix(x, kind, degree), params)
+
+
+def _stack_forcing(forcing: xr.Dataset, fvars, dates) -> np.ndarray:
+    """(site, time, feature) values of the `fvars` of `forcing` on `dates`."""
+    sub = forcing[list(fvars)].reindex(date=dates)
+    return np.stack([sub[v].transpose('site', 'date').values for v in fvars], axis=-1)
+
+
+def run_batched(
+    kind: str, forcing: xr.Dataset, obs: xr.Dataset, dates_lists: dict, model_params: dict
+):
+    """!
+    Batched counterpart of snotel_value, snotel_with_offset, training_mean, lin_reg and
+    poly_reg: fit on the 'train' window and predict every window, for all sites at once.
+    @param kind [str]: 'value', 'offset', 'mean', 'linear' or 'poly'.
+    @param forcing [xr.Dataset]: forcing variables (e.g. SNOTEL_SWE) over (site, date).
+    @param obs [xr.Dataset]: observed variables (e.g. SWE) over (site, date).
+    @param dates_lists [dict]: {window: dates}, see util.make_time_lists.
+    @param model_params [dict]: 'vars', optional 'fvars' (default ['SNOTEL_SWE']) and
+        'degree' for poly.
+    @return (model_out, model_name): model_out from util.create_model_output, with the
+        forcing's sites along `site`.
+    """
+    vars = model_params['vars']
+    fvars = model_params.get('fvars', ['SNOTEL_SWE'])
+    degree = model_params.get('degree', 3)
+    model_name = f'batched {kind}' if kind != 'poly' else f'batched polynomial {degree} regression'
+
+    windows = list(dates_lists.keys())
+    # all windows are predicted in a single pass over the concatenated dates
+    all_dates = pd.DatetimeIndex(np.concatenate([dates_lists[w].values for w in windows]))
+    bounds = np.cumsum([0] + [len(dates_lists[w]) for w in windows])
+    x_all = _stack_forcing(forcing, fvars, all_dates)
+    x_train = _stack_forcing(forcing, fvars, dates_lists['train'])
+
+    model_out = create_model_output(vars, dates_lists, forcing['site'].values)
+    for var in vars:
+        y_train = obs[var].reindex(date=dates_lists['train']).transpose('site', 'date').values
+        params = fit_batched(kind, x_train, y_train, degree)
+        y_hat = predict_batched(kind, params, x_all, degree)
+        for w, start, stop in zip(windows, bounds[:-1], bounds[1:]):
+            y = obs[var].reindex(date=dates_lists[w]).transpose('site', 'date').values
+            model_output_view(model_out, 'obs', var, w)[:] = y
+            model_output_view(model_out, 'sim', var, w)[:] = y_hat[:, start:stop]
+    return model_out, model_name
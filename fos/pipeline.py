@@ -0,0 +1,483 @@
+"""!
+Resumable, incremental pipeline of the fos processing stages.
+
+A `Stage` declares the files it reads and writes and the stages it depends on. A run
+of the `Pipeline` walks the stages in dependency order, runs independent stages
+concurrently and skips every stage that is up to date:
+- a plain stage runs when an output is missing, an input is newer than its outputs or
+  its last run failed,
+- a partitioned stage (e.g. one partition per site) compares the state of every
+  partition's input files with the manifest of the last run and is called with the
+  changed partitions only, so a new SNOTEL CSV recomputes and merges just that site.
+Every run updates `{workdir}/manifest.json` (the state of each stage) and appends a
+record to `{workdir}/runs.jsonl`.
+
+`fos_pipeline(config)` builds the standard chain catalog -> converted stores ->
+SNOTEL/WRF site stores -> site metrics -> model sweep, see `fos pipeline --help`.
+"""
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import joblib
+
+from fos import catalog, convert, sitestore
+from fos.cache import input_state
+
+MANIFEST = "manifest.json"
+RUNS = "runs.jsonl"
+## statuses that block the dependent stages
+BROKEN = ("failed", "blocked")
+## bump when the manifest layout changes
+MANIFEST_VERSION = 1
+
+
+def _newest(path):
+    """Newest mtime of a file or of any file below a directory, None if missing."""
+    if not os.path.exists(path):
+        return None
+    if not os.path.isdir(path):
+        return os.stat(path).st_mtime_ns
+    mtimes = [os.stat(path).st_mtime_ns]
+    for root, _, filenames in os.walk(path):
+        mtimes.extend(os.stat(os.path.join(root, f)).st_mtime_ns for f in filenames)
+    return max(mtimes)
+
+
+class Stage:
+    """!
+    One step of a pipeline.
+    @param name [str]: unique stage name.
+    @param func: called as `func()`, or `func(changed)` with the list of changed
+        partition keys when `partitions` is given.
+    @param inputs [list or callable]: paths read by the stage, or a function returning
+        them (evaluated when the stage is considered, after its dependencies ran).
+    @param outputs [list]: paths written by the stage.
+    @param deps [list]: names of the stages that must finish first.
+    @param partitions [callable]: optional, returns {key: [input paths]}.
+    @param always [bool]: run on every pipeline run, e.g. cheap refresh steps.
+    """
+
+    def __init__(
+        self, name, func, inputs=(), outputs=(), deps=(), partitions=None, always=False
+    ):
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self.partitions = partitions
+        self.always = always
+
+    def input_paths(self) -> list:
+        return list(self.inputs() if callable(self.inputs) else self.inputs)
+
+    def __repr__(self):
+        return f"Stage({self.name!r}, deps={self.deps})"
+
+
+class Pipeline:
+    """!
+    A set of stages and the manifest of their last runs, see the module docstring.
+    @param stages [list]: Stage objects.
+    @param workdir [str]: directory of the manifest and the run log.
+    """
+
+    def __init__(self, stages, workdir: str):
+        self.stages = {stage.name: stage for stage in stages}
+        if len(self.stages) != len(stages):
+            raise ValueError("Stage names must be unique")
+        for stage in stages:
+            missing = set(stage.deps) - set(self.stages)
+            if missing:
+                raise ValueError(f"{stage.name} depends on unknown stages {sorted(missing)}")
+        self.order = self._toposort()
+        self.workdir = os.path.expanduser(workdir)
+        self.manifest = self._read_manifest()
+        self._lock = threading.Lock()
+
+    def _toposort(self):
+        order, state = [], {}
+
+        def visit(name, path):
+            if state.get(name) == "done":
+                return
+            if state.get(name) == "visiting":
+                raise ValueError(f"Cycle in the pipeline: {' -> '.join(path + [name])}")
+            state[name] = "visiting"
+            for dep in self.stages[name].deps:
+                visit(dep, path + [name])
+            state[name] = "done"
+            order.append(name)
+
+        for name in self.stages:
+            visit(name, [])
+        return order
+
+    # --- manifest --------------------------------------------------------------------
+
+    def _manifest_path(self):
+        return os.path.join(self.workdir, MANIFEST)
+
+    def _read_manifest(self):
+        try:
+            with open(self._manifest_path()) as fh:
+                manifest = json.load(fh)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {"version": MANIFEST_VERSION, "stages": {}}
+        if manifest.get("version") != MANIFEST_VERSION:
+            return {"version": MANIFEST_VERSION, "stages": {}}
+        return manifest
+
+    def _write_manifest(self):
+        os.makedirs(self.workdir, exist_ok=True)
+        tmp = f"{self._manifest_path()}.{os.getpid()}.tmp"
+        with open(tmp, "w") as fh:
+            json.dump(self.manifest, fh, indent=1, sort_keys=True)
+        os.replace(tmp, self._manifest_path())
+
+    # --- planning --------------------------------------------------------------------
+
+    def _partition_states(self, stage):
+        """{key: state hash} of every partition, keys as returned by `partitions`."""
+        return {
+            key: joblib.hash([input_state(p) for p in paths if os.path.exists(p)])
+            for key, paths in stage.partitions().items()
+        }
+
+    def plan(self, stage: Stage, force: bool = False):
+        """!
+        Decide whether a stage has to run.
+        @return (reason or None when up to date, changed partition keys or None for
+            all, partition states to record, keyed on str(key) as in the manifest).
+        """
+        outputs_exist = all(os.path.exists(p) for p in stage.outputs)
+        if stage.partitions is not None:
+            current = self._partition_states(stage)
+            states = {str(key): state for key, state in current.items()}
+            previous = self.manifest["stages"].get(stage.name, {}).get("partitions", {})
+            if force or not outputs_exist:
+                return ("forced" if force else "missing outputs"), None, states
+            changed = [key for key, state in current.items() if previous.get(str(key)) != state]
+            if changed:
+                return f"{len(changed)} changed partitions", changed, states
+            return None, [], states
+        if force:
+            return "forced", None, None
+        if stage.always:
+            return "always", None, None
+        if self.manifest["stages"].get(stage.name, {}).get("status") == "failed":
+            # the outputs of a failed run may be partial, e.g. a table without its
+            # failed tasks
+            return "failed last run", None, None
+        if not outputs_exist:
+            return "missing outputs", None, None
+        inputs = [_newest(p) for p in stage.input_paths()]
+        newest_input = max([m for m in inputs if m is not None], default=None)
+        oldest_output = min((_newest(p) for p in stage.outputs), default=None)
+        if newest_input is not None and oldest_output is not None and newest_input > oldest_output:
+            return "inputs changed", None, None
+        return None, None, None
+
+    # --- running ---------------------------------------------------------------------
+
+    def _run_stage(self, stage: Stage, force: bool, log):
+        started = time.time()
+        record = dict(started=started)
+        try:
+            reason, changed, states = self.plan(stage, force)
+            if reason is None:
+                record.update(status="skipped")
+            else:
+                log(f"{stage.name}: running ({reason})")
+                if stage.partitions is not None:
+                    stage.func(changed)
+                else:
+                    stage.func()
+                record.update(status="done", reason=reason)
+                if changed is not None:
+                    record["changed"] = len(changed)
+            if states is not None:
+                record["partitions"] = states
+        except Exception as err:
+            record.update(status="failed", error=f"{type(err).__name__}: {err}")
+        record["seconds"] = round(time.time() - started, 3)
+        with self._lock:
+            previous = self.manifest["stages"].get(stage.name, {})
+            done = record["status"] == "done"
+            record["last_done"] = started if done else previous.get("last_done")
+            if record["status"] == "failed" and "partitions" in previous:
+                # keep the last good partition states so the next run retries
+                record["partitions"] = previous["partitions"]
+            self.manifest["stages"][stage.name] = record
+            self._write_manifest()
+        return record
+
+    def run(self, targets=None, force: bool = False, workers: int = 4, log=print) -> dict:
+        """!
+        Run the pipeline.
+        @param targets [list]: stage names to bring up to date together with their
+            dependencies, default every stage.
+        @param force [bool]: rerun the selected stages even if they are up to date.
+        @param workers [int]: stages run concurrently.
+        @param log: called with progress messages.
+        @return {stage name: record} of this run, status done/skipped/failed/blocked.
+        """
+        selected = self._closure(targets)
+        started = time.time()
+        records, running = {}, {}
+        pending = [name for name in self.order if name in selected]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while pending or running:
+                for name in list(pending):
+                    deps = self.stages[name].deps
+                    failed = [d for d in deps if records.get(d, {}).get("status") in BROKEN]
+                    if failed:
+                        records[name] = dict(status="blocked")
+                        pending.remove(name)
+                        log(f"{name}: blocked by a failed dependency")
+                    elif all(d in records for d in deps):
+                        running[pool.submit(self._run_stage, self.stages[name], force, log)] = name
+                        pending.remove(name)
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    records[name] = future.result()
+                    if records[name]["status"] == "failed":
+                        log(f"{name}: failed, {records[name]['error']}")
+
+        run = dict(
+            started=started,
+            seconds=round(time.time() - started, 3),
+            force=force,
+            stages={
+                name: {k: v for k, v in record.items() if k != "partitions"}
+                for name, record in records.items()
+            },
+        )
+        os.makedirs(self.workdir, exist_ok=True)
+        with open(os.path.join(self.workdir, RUNS), "a") as fh:
+            fh.write(json.dumps(run) + "\n")
+        return records
+
+    def _closure(self, targets):
+        if targets is None:
+            return set(self.stages)
+        selected, todo = set(), list(targets)
+        while todo:
+            name = todo.pop()
+            if name not in self.stages:
+                raise ValueError(f"Unknown stage {name!r}, use one of {self.order}")
+            if name not in selected:
+                selected.add(name)
+                todo.extend(self.stages[name].deps)
+        return selected
+
+
+def fos_pipeline(config: dict) -> Pipeline:
+    """!
+    The standard fos processing chain, from a JSON-style config:
+    ```
+    {
+      "workdir": "fos_pipeline",                   # manifest and outputs
+      "wrfdir": "/glade/campaign/.../postprocess",  # for "convert"
+      "convert": [{"model": "ukesm1-0-ll", "variant": "r2i1p1f2", "var": "snow"}],
+      "snoteldir": "~/fos-data/snoteldata",
+      "wrfts": {"ukesm1-0-ll_bc": "~/fos-data/wrfts/ukesm1-0-ll_bc"},
+      "extract": {"ukesm1-0-ll_bc": {"model": "ukesm1-0-ll", "variant": "r2i1p1f2",
+                                     "coorddir": "~/fos-data/wrf_coordinates"}},
+      "site_metrics": "ukesm1-0-ll_bc",             # a run of "wrfts"
+      "run_models": "experiments.json"              # see fos.experiments.load_config
+    }
+    ```
+    Every key but workdir is optional and adds its stages:
+    - catalog, convert:{model}_{variant}_{var}: refresh the file catalog and convert
+      the runs; a new ssp370 year file is appended to the converted store.
+    - extract:{run}: write the .npy series of a "wrfts" run from the converted stores
+      of a "convert" entry (sitestore.extract_wrfts), so a new year file reaches the
+      stages below. Optional var, domain and level (huc6) keys.
+    - snotel-store, wrfts-store:{run}: site x day stores, updated per changed file.
+    - site-metrics: peak metrics per site, only sites whose CSV or series changed are
+      recomputed and merged into `{workdir}/site_metrics.parquet`.
+    - run-models: the model sweep into `{workdir}/model_results.parquet`, resumable.
+    ValueError if a key refers to a run or a directory that is not configured.
+    """
+    wrfts = {run: os.path.expanduser(path) for run, path in config.get("wrfts", {}).items()}
+    snoteldir = config.get("snoteldir")
+    run = config.get("site_metrics")
+    if run is not None and run not in wrfts:
+        raise ValueError(f"site_metrics is {run!r}, which is not a run of wrfts {sorted(wrfts)}")
+    if run is not None and snoteldir is None:
+        raise ValueError("site_metrics needs snoteldir")
+    for name in config.get("extract", {}):
+        if name not in wrfts:
+            raise ValueError(f"extract run {name!r} is not a run of wrfts {sorted(wrfts)}")
+
+    workdir = os.path.expanduser(config.get("workdir", "fos_pipeline"))
+    storedir = os.path.join(workdir, "stores")
+    stages = []
+
+    wrfdir = config.get("wrfdir")
+    if wrfdir is not None:
+        wrfdir = os.path.expanduser(wrfdir)
+        stages.append(
+            Stage("catalog", lambda: catalog.get_catalog(wrfdir, refresh=True), always=True)
+        )
+        for spec in config.get("convert", []):
+            var, domain = spec.get("var", "snow"), spec.get("domain", "d02")
+            experiments = spec.get("experiments", ["historical", "ssp370"])
+            runs = [f"{spec['model']}_{spec['variant']}_{exp}_bc" for exp in experiments]
+
+            def files(runs=runs, var=var, domain=domain):
+                cat = catalog.get_catalog(wrfdir, refresh=False)
+                return [f for run in runs for f in cat.files(run, var, domain)]
+
+            def run_convert(spec=spec, var=var, domain=domain, experiments=experiments):
+                model, variant = spec["model"], spec["variant"]
+                convert.convert_run(
+                    wrfdir, model, variant, var, domain, experiments=experiments, storedir=storedir
+                )
+
+            stages.append(
+                Stage(
+                    f"convert:{spec['model']}_{spec['variant']}_{var}",
+                    run_convert,
+                    inputs=files,
+                    outputs=[convert.store_path(run, var, domain, storedir) for run in runs],
+                    deps=["catalog"],
+                )
+            )
+
+    for name, spec in config.get("extract", {}).items():
+        stages.append(_extract_stage(name, spec, wrfts[name], stages))
+
+    snotel_store = sitestore.snotel_store_path(storedir)
+    if snoteldir is not None:
+        snoteldir = os.path.expanduser(snoteldir)
+        stages.append(
+            Stage(
+                "snotel-store",
+                lambda: sitestore.build_snotel_store(snoteldir, snotel_store),
+                inputs=[snoteldir],
+                outputs=[snotel_store],
+            )
+        )
+
+    names = {s.name for s in stages}
+    for name, datadir in wrfts.items():
+        path = sitestore.wrfts_store_path(name, storedir)
+        stages.append(
+            Stage(
+                f"wrfts-store:{name}",
+                lambda datadir=datadir, path=path: sitestore.build_wrfts_store(
+                    datadir, _sites(), path
+                ),
+                inputs=[datadir],
+                outputs=[path],
+                deps=[f"extract:{name}"] if f"extract:{name}" in names else [],
+            )
+        )
+
+    if run is not None:
+        deps = [s.name for s in stages if s.name in ("snotel-store", f"wrfts-store:{run}")]
+        stages.append(_site_metrics_stage(run, wrfts[run], snoteldir, storedir, workdir, deps))
+
+    experiments = config.get("run_models")
+    if experiments is not None:
+        experiments = os.path.expanduser(experiments)
+        output = os.path.join(workdir, "model_results.parquet")
+        stores = [s for s in stages if s.name.startswith(("snotel-store", "wrfts-store"))]
+
+        def run_models():
+            from fos.experiments import SITE_CHUNK, load_config, run_experiments
+
+            spec = load_config(experiments)
+            _, failures = run_experiments(
+                spec["experiments"],
+                spec["models"],
+                spec["time_periods"],
+                sites=spec.get("sites"),
+                output=output,
+                workers=config.get("workers", 4),
+                site_chunk=spec.get("site_chunk", SITE_CHUNK),
+                units=spec.get("units"),
+            )
+            if len(failures) > 0:
+                raise RuntimeError(f"{len(failures)} run-models tasks failed, see {output}")
+
+        stages.append(
+            Stage(
+                "run-models",
+                run_models,
+                inputs=[experiments] + [p for s in stores for p in s.outputs],
+                outputs=[output],
+                deps=[s.name for s in stores],
+            )
+        )
+    return Pipeline(stages, workdir)
+
+
+def _sites():
+    from fos.data import snotel_no_ak
+
+    return snotel_no_ak
+
+
+def _extract_stage(run, spec, datadir, stages):
+    """extract:{run}, after the convert stage of the same model, variant and variable."""
+    var, domain = spec.get("var", "snow"), spec.get("domain", "d02")
+    convert_name = f"convert:{spec['model']}_{spec['variant']}_{var}"
+    converter = next((s for s in stages if s.name == convert_name), None)
+    if converter is None:
+        raise ValueError(f"extract run {run!r} needs a convert entry for {convert_name}")
+    coorddir = os.path.expanduser(spec["coorddir"])
+
+    def run_extract():
+        data = [convert.open_store(path, var) for path in converter.outputs]
+        sitestore.extract_wrfts(
+            data, _sites(), datadir, coorddir, domain=domain, level=spec.get("level", "huc6")
+        )
+
+    return Stage(
+        f"extract:{run}",
+        run_extract,
+        inputs=list(converter.outputs),
+        outputs=[datadir],
+        deps=[convert_name],
+    )
+
+
+def _site_metrics_stage(run, datadir, snoteldir, storedir, workdir, deps):
+    """site-metrics partitioned per site: the SNOTEL CSV and the two .npy series."""
+    output = os.path.join(workdir, "site_metrics.parquet")
+    wrfstore = sitestore.wrfts_store_path(run, storedir)
+
+    def partitions():
+        sites = _sites()
+        return {
+            int(number): [os.path.join(snoteldir, f"snotel{number}.csv")]
+            + [
+                os.path.join(datadir, f"{source}_{sitestore.site_name_key(name)}.npy")
+                for source in sitestore.WRF_SOURCES
+            ]
+            for number, name in zip(sites.site_number, sites.site_name)
+        }
+
+    def run_metrics(changed):
+        from fos.sitemetrics import build_site_metrics
+
+        sites = _sites()
+        if changed is not None:
+            sites = sites[sites.site_number.isin(changed)]
+        build_site_metrics(
+            sites, datadir, snoteldir, output=output, wrfstore=wrfstore, update=True
+        )
+
+    return Stage(
+        "site-metrics", run_metrics, outputs=[output], deps=deps, partitions=partitions
+    )
@@ -1,17 +1,21 @@
 import matplotlib.pyplot as plt
-from metrics import nse
 
-def plot_single_sample_model_out(model_out, dates_lists, var = 'SWE', error = 'NSE'):
+from fos.metrics import nse
+from fos.util import model_output_window
+
+def plot_single_sample_model_out(model_out, dates_lists, var = 'SWE', error = 'NSE', site = None):
+    """Observed and simulated `var` of every window, model_out from util.create_model_output."""
     obskw = {'linestyle': 'solid', 'color':'darkgrey'}
     simkw = {'linestyle': 'dashed'} 
+    site = model_out['site'].values[0] if site is None else site
     fig,ax = plt.subplots(1,1, figsize=(10,5))
-    for i,val in enumerate(dates_lists.keys()):
-        data = model_out[i]
-        date =data['date']
-        ax.plot(date,data[f'{val}_{var}_obs'], label=f'{val} obs', **obskw)
-        ax.plot(date,data[f'{val}_{var}_sim'], label=f'{val} sim', **simkw)
-    test_err = nse(obs =model_out[-1][f'test_{var}_obs'], sim = model_out[-1][f'test_{var}_sim'])
-    ax.set_title(('test NSE = ', test_err))
+    for val in dates_lists.keys():
+        data = model_output_window(model_out, val).sel(variable=var, site=site)
+        ax.plot(data['date'],data.sel(kind='obs'), label=f'{val} obs', **obskw)
+        ax.plot(data['date'],data.sel(kind='sim'), label=f'{val} sim', **simkw)
+    test = model_output_window(model_out, 'test').sel(variable=var, site=site)
+    test_err = float(nse(obs = test.sel(kind='obs'), sim = test.sel(kind='sim')))
+    ax.set_title(f'test NSE = {test_err:.3f}')
     plt.legend()
     plt.show()
-    return
\ No newline at end of file
+    return
@@ -0,0 +1,179 @@
+"""!
+Per-site peak SWE metrics for the WRF point, WRF basin and SNOTEL series, as a flat
+long-format table (one row per site x source x water year) written to parquet.
+
+This is the parallel replacement for `util.create_wrf_df`: sites are fanned out over
+a process pool and sites that are missing inputs or fail are reported instead of
+being skipped silently.
+"""
+
+import functools
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from fos import dirs
+from fos.constants import CONVERSIONS
+from fos.sitestore import WRF_SOURCES, WRF_START, SiteDayStore, site_name_key
+from fos.timeaxis import daily_index
+from fos.util import MM_TO_IN, console, get_peak_date_amt
+
+SOURCES = WRF_SOURCES + ("snotel",)
+COLUMNS = ["site_number", "site_name", "source", "water_year", "maxval", "maxdate", "maxarg"]
+
+
+@functools.lru_cache(maxsize=None)
+def _open_store(path):
+    # one memory map per process and store
+    return SiteDayStore(path)
+
+
+def load_site_series(
+    site_number,
+    site_name,
+    datadir,
+    snoteldir,
+    start=WRF_START,
+    wrfstore: str = None,
+    units: str = "in",
+) -> dict:
+    """!
+    Load the three SWE series of one site, SNOTEL in inches.
+    @param wrfstore [str]: optional store written by `sitestore.build_wrfts_store`, read
+        instead of the .npy files in `datadir`.
+    @param units [str]: units of the WRF series, "in" like SNOTEL, or "mm" as stored
+        (no converted copies).
+    @return {source: pd.DataFrame with a SWE column and a daily DatetimeIndex}
+    """
+    series = {}
+    if wrfstore is not None:
+        store = _open_store(wrfstore)
+        if site_number not in store:
+            raise FileNotFoundError(f"Site {site_number} is not in {wrfstore}")
+        for source in WRF_SOURCES:
+            swe = store.series(source, site_number, units=units)
+            series[source] = swe.rename("SWE").to_frame()
+    else:
+        name = site_name_key(site_name)
+        factor = 1.0 if units == "mm" else CONVERSIONS[("mm", units)]
+        for source in WRF_SOURCES:
+            values = np.load(os.path.join(datadir, f"{source}_{name}.npy"))
+            if factor != 1.0:
+                values = values * factor
+            series[source] = pd.DataFrame(
+                values, columns=["SWE"], index=daily_index(start, len(values))
+            )
+    series["snotel"] = pd.read_csv(
+        os.path.join(snoteldir, f"snotel{site_number}.csv"), index_col=0, parse_dates=True
+    )
+    return series
+
+
+def site_metrics(site_number, site_name, datadir, snoteldir, wrfstore=None) -> pd.DataFrame:
+    """Peak metrics of every source of one site, in the long table layout."""
+    frames = []
+    # WRF in mm, only the peaks are converted to inches
+    series = load_site_series(
+        site_number, site_name, datadir, snoteldir, wrfstore=wrfstore, units="mm"
+    )
+    for source, data in series.items():
+        peaks = get_peak_date_amt(data, factor=MM_TO_IN if source in WRF_SOURCES else 1.0)
+        frames.append(
+            pd.DataFrame(
+                {
+                    "site_number": site_number,
+                    "site_name": site_name,
+                    "source": source,
+                    "water_year": peaks.index.values,
+                    "maxval": peaks.maxval.values,
+                    "maxdate": pd.to_datetime(peaks.maxdate.values),
+                    "maxarg": peaks.maxarg.values,
+                }
+            )
+        )
+    return pd.concat(frames, ignore_index=True)
+
+
+def build_site_metrics(
+    sites,
+    datadir: str = None,
+    snoteldir: str = None,
+    output: str = None,
+    workers: int = 4,
+    wrfstore: str = None,
+    update: bool = False,
+):
+    """!
+    Compute peak metrics for many sites in parallel.
+    @param sites [pd.DataFrame]: with site_number and site_name columns, e.g.
+        `fos.data.snotel_no_ak`.
+    @param datadir [str]: directory of the wrfpoint_/wrfbasin_ .npy files.
+    @param snoteldir [str]: directory of the snotel{num}.csv files.
+    @param output [str]: optional parquet path for the table, failures are written
+        next to it as `{output stem}.failures.csv`.
+    @param workers [int]: number of processes, 1 runs in this process.
+    @param wrfstore [str]: optional wrfpoint/wrfbasin store read instead of `datadir`.
+    @param update [bool]: only (re)compute `sites` and keep the rows of every other
+        site of an existing `output` table.
+    @return (table, failures): the long metrics table and a DataFrame of the sites
+        that failed with their error.
+    """
+    datadir = datadir or os.path.join(dirs.projectdir, "wrfts", "ukesm1-0-ll_bc")
+    snoteldir = snoteldir or dirs.snoteldir
+    todo = list(zip(sites.site_number, sites.site_name))
+
+    frames, failures = [], []
+
+    def record_failure(site, err):
+        error = f"{type(err).__name__}: {err}"
+        failures.append(dict(site_number=site[0], site_name=site[1], error=error))
+
+    if workers == 1:
+        for site in todo:
+            try:
+                frames.append(site_metrics(*site, datadir, snoteldir, wrfstore))
+            except Exception as err:
+                record_failure(site, err)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                pool.submit(site_metrics, *site, datadir, snoteldir, wrfstore): site
+                for site in todo
+            }
+            for future in as_completed(futures):
+                try:
+                    frames.append(future.result())
+                except Exception as err:
+                    record_failure(futures[future], err)
+
+    if update and output is not None and os.path.exists(output):
+        kept = pd.read_parquet(output)
+        frames.append(kept[~kept.site_number.isin([site[0] for site in todo])])
+    table = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=COLUMNS)
+    table = table.sort_values(["site_number", "source", "water_year"], ignore_index=True)
+    failures = pd.DataFrame(failures, columns=["site_number", "site_name", "error"])
+    if len(failures) > 0:
+        console.log(f"{len(failures)}/{len(todo)} sites failed:", style="bold red")
+        for _, row in failures.iterrows():
+            console.log(f"  {row.site_number} {row.site_name}: {row.error}")
+    if output is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        table.to_parquet(output, index=False)
+        failures.to_csv(os.path.splitext(output)[0] + ".failures.csv", index=False)
+    return table, failures
+
+
+def read_site_metrics(path: str, sites=None, sources=None) -> pd.DataFrame:
+    """!
+    Read (part of) a table written by `build_site_metrics`.
+    @param sites [list]: optional site numbers to keep.
+    @param sources [list]: optional sources to keep, see SOURCES.
+    """
+    filters = []
+    if sites is not None:
+        filters.append(("site_number", "in", list(sites)))
+    if sources is not None:
+        filters.append(("source", "in", list(sources)))
+    return pd.read_parquet(path, filters=filters or None)
@@ -0,0 +1,456 @@
+"""!
+Memory-mapped site x day stores.
+
+A store is a directory holding one dense `{variable}.npy` matrix (sites x days,
+missing days NaN) per variable plus `header.json` with the site index, the first
+date, the units of each variable and the mtime/size of every source file it was
+built from. The matrices are opened with `np.load(mmap_mode="r")`, so slicing a
+site or a contiguous range of sites and days is a zero-copy view of the file.
+
+`build_snotel_store` consolidates the per-site `snotel{num}.csv` files and
+`build_wrfts_store` the wrfpoint_/wrfbasin_ .npy series extracted for a model run,
+which `extract_wrfts` writes from a converted store.
+Values are stored in their source units and converted on access, e.g.
+`store.series("wrfpoint", 1000, units="in")`.
+"""
+
+import datetime
+import glob
+import json
+import os
+import re
+
+import dask.array as dsa
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from fos import dirs
+from fos.constants import CONVERSIONS, MM_TO_IN  # noqa: F401, re-exported
+from fos.timeaxis import daily_index
+
+HEADER = "header.json"
+## bump when the header layout changes
+STORE_VERSION = 1
+## first day of the extracted wrfpoint/wrfbasin series
+WRF_START = datetime.datetime(year=1980, month=9, day=1)
+WRF_SOURCES = ("wrfpoint", "wrfbasin")
+
+
+class SiteDayStore:
+    """!
+    Read access to a site x day store, see the module docstring for the layout.
+    ```
+    store = SiteDayStore(path)
+    swe = store.values("SWE", sites=[1000, 1001], start="2000-10-01", end="2001-09-30")
+    ```
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, HEADER)) as fh:
+            self.header = json.load(fh)
+        self.sites = np.asarray(self.header["sites"])
+        self.start = pd.Timestamp(self.header["start"])
+        self.ndays = self.header["ndays"]
+        self._site_pos = {site: i for i, site in enumerate(self.sites.tolist())}
+        self._arrays = {}
+
+    def __contains__(self, site) -> bool:
+        """True if the store has a row for site number `site`."""
+        return site in self._site_pos
+
+    @property
+    def variables(self) -> list:
+        return list(self.header["units"])
+
+    @property
+    def dates(self) -> pd.DatetimeIndex:
+        return pd.date_range(self.start, periods=self.ndays, freq="D")
+
+    def units(self, var: str) -> str:
+        return self.header["units"][var]
+
+    def array(self, var: str) -> np.ndarray:
+        """The full (site, day) memory map of one variable."""
+        if var not in self._arrays:
+            self._arrays[var] = np.load(os.path.join(self.path, f"{var}.npy"), mmap_mode="r")
+        return self._arrays[var]
+
+    def site_index(self, sites):
+        """!
+        Row selector for `sites`: a slice (so indexing is a view) when the sites are
+        contiguous in the store, else an integer array.
+        """
+        if sites is None:
+            return slice(None)
+        pos = np.array([self._site_pos[s] for s in np.atleast_1d(sites)], dtype=np.intp)
+        if len(pos) > 0 and np.all(np.diff(pos) == 1):
+            return slice(pos[0], pos[-1] + 1)
+        return pos
+
+    def day_index(self, start=None, end=None) -> slice:
+        """Column slice for the inclusive date range [start, end]."""
+        first = 0 if start is None else (pd.Timestamp(start) - self.start).days
+        last = self.ndays if end is None else (pd.Timestamp(end) - self.start).days + 1
+        return slice(max(first, 0), min(max(last, 0), self.ndays))
+
+    def factor(self, var: str, units: str = None) -> float:
+        """Multiplier converting `var` to `units` (1 when units is None or the stored units)."""
+        if units is None or units == self.units(var):
+            return 1.0
+        try:
+            return CONVERSIONS[(self.units(var), units)]
+        except KeyError:
+            raise ValueError(f"Cannot convert {var} from {self.units(var)} to {units}") from None
+
+    def values(self, var: str, sites=None, start=None, end=None, units: str = None):
+        """!
+        (site, day) values of `var`.
+        In the stored units this is a view of the memory map (unless `sites` is scattered);
+        other units are converted on the returned selection only.
+        """
+        values = self.array(var)[self.site_index(sites), self.day_index(start, end)]
+        factor = self.factor(var, units)
+        return values if factor == 1.0 else values * factor
+
+    def series(self, var: str, site, start=None, end=None, units: str = None) -> pd.Series:
+        """One site as a daily pd.Series (backed by the memory map in the stored units)."""
+        days = self.day_index(start, end)
+        values = self.array(var)[self._site_pos[site], days]
+        factor = self.factor(var, units)
+        if factor != 1.0:
+            values = values * factor
+        return pd.Series(values, index=self.dates[days], name=var, copy=False)
+
+    def to_xarray(self, var: str, sites=None, start=None, end=None, units: str = None):
+        """!
+        (site, day) DataArray with units in attrs, backed by the memory map. Converting
+        to other units wraps the map in a dask array, so nothing is computed until used.
+        """
+        rows, days = self.site_index(sites), self.day_index(start, end)
+        values = self.array(var)[rows, days]
+        factor = self.factor(var, units)
+        if factor != 1.0:
+            values = dsa.from_array(values, chunks=(-1, 3650)) * factor
+        return xr.DataArray(
+            values,
+            dims=("site", "day"),
+            coords={"site": self.sites[rows], "day": self.dates[days]},
+            name=var,
+            attrs={"units": units or self.units(var)},
+        )
+
+
+def snotel_store_path(storedir: str = None) -> str:
+    """Default location of the consolidated SNOTEL store."""
+    return os.path.join(storedir or dirs.storedir, "snotel")
+
+
+def wrfts_store_path(run: str, storedir: str = None) -> str:
+    """Default location of the wrfpoint/wrfbasin store of a run, e.g. ukesm1-0-ll_bc."""
+    return os.path.join(storedir or dirs.storedir, "wrfts", run)
+
+
+def _file_stamp(path):
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _write_header(path, header):
+    tmp = os.path.join(path, f"{HEADER}.tmp")
+    with open(tmp, "w") as fh:
+        json.dump(header, fh)
+    os.replace(tmp, os.path.join(path, HEADER))
+
+
+def write_store(
+    path: str, sites, start, ndays: int, units: dict, sources: dict = None, dtype="f8"
+):
+    """!
+    Create an empty (all NaN) store and return it opened for writing.
+    @param units [dict]: {variable: units} of every matrix in the store.
+    @param sources [dict]: {site: [mtime_ns, size]} of the files the rows come from.
+    @return (header, {variable: writable memmap})
+    """
+    os.makedirs(path, exist_ok=True)
+    arrays = {}
+    for var in units:
+        arr = np.lib.format.open_memmap(
+            os.path.join(path, f"{var}.npy"), mode="w+", dtype=dtype, shape=(len(sites), ndays)
+        )
+        arr[:] = np.nan
+        arrays[var] = arr
+    header = dict(
+        version=STORE_VERSION,
+        sites=list(sites),
+        start=str(pd.Timestamp(start).date()),
+        ndays=int(ndays),
+        units=units,
+        sources=sources or {},
+    )
+    return header, arrays
+
+
+def site_name_key(site_name: str) -> str:
+    """The name used in the wrfpoint_/wrfbasin_ filenames."""
+    return site_name.replace(" ", "").replace("(", "").replace(")", "")
+
+
+def ingest(
+    path: str, files: dict, read, units: dict, refresh: bool = True, dtype="f8"
+) -> SiteDayStore:
+    """!
+    Build or refresh a store from per-site source files.
+    When the store exists and `refresh` is set, only sites whose files changed (mtime
+    or size) or are new are read again. The matrices are rewritten only when the site
+    list or the date range has to grow, otherwise rows are updated in place.
+    @param files [dict]: {site: [source paths]}, the stamps of these decide what is stale.
+    @param read [callable]: read(site) -> pd.DataFrame with a daily DatetimeIndex and one
+        column per variable of `units`.
+    @param units [dict]: {variable: units} of the stored matrices.
+    @param dtype: of the matrices, "f4" halves the store and the pages read (see
+        fos.compact), a different dtype than the existing store's rewrites it.
+    @return SiteDayStore, ValueError if the files hold no dated value at all.
+    """
+    columns = list(units)
+    stamps = {site: [_file_stamp(p) for p in paths] for site, paths in files.items()}
+    try:
+        old = SiteDayStore(path)
+        if (
+            old.header.get("version") != STORE_VERSION
+            or old.header["units"] != units
+            or old.array(columns[0]).dtype != np.dtype(dtype)
+        ):
+            old = None
+    except FileNotFoundError:
+        old = None
+    if old is not None and not refresh:
+        return old
+
+    old_sources = {} if old is None else {int(k): v for k, v in old.header["sources"].items()}
+    changed = [s for s in sorted(files) if old_sources.get(s) != stamps[s]]
+    if old is not None and not changed and set(old_sources) == set(files):
+        return old
+    parsed = {site: read(site) for site in changed}
+
+    # date range and site list of the new store
+    firsts = [d.index.min() for d in parsed.values() if len(d)]
+    lasts = [d.index.max() for d in parsed.values() if len(d)]
+    if old is not None:
+        firsts.append(old.start)
+        lasts.append(old.dates[-1])
+    if not firsts:
+        raise ValueError(f"No dated values in the {len(files)} source files of {path}")
+    start, end = min(firsts), max(lasts)
+    ndays = (end - start).days + 1
+    sites = sorted(files)
+
+    same_shape = (
+        old is not None
+        and old.sites.tolist() == sites
+        and old.start == start
+        and old.ndays == ndays
+    )
+    if same_shape:
+        header = old.header
+        arrays = {
+            var: np.load(os.path.join(path, f"{var}.npy"), mmap_mode="r+") for var in columns
+        }
+    else:
+        tmp = f"{path}.tmp"
+        header, arrays = write_store(tmp, sites, start, ndays, units, dtype=dtype)
+        if old is not None:
+            # carry over the rows that did not change
+            offset = (old.start - start).days
+            for site in sites:
+                if site in parsed or site not in old._site_pos:
+                    continue
+                row = sites.index(site)
+                for var in columns:
+                    values = old.array(var)[old._site_pos[site]]
+                    arrays[var][row, offset : offset + old.ndays] = values
+
+    for site, data in parsed.items():
+        row = sites.index(site)
+        cols = (data.index - start).days.to_numpy()
+        for var in columns:
+            arrays[var][row] = np.nan
+            arrays[var][row, cols] = data[var].to_numpy(dtype=np.float64)
+    for arr in arrays.values():
+        arr.flush()
+    header["sources"] = {str(site): stamps[site] for site in sites}
+
+    if same_shape:
+        _write_header(path, header)
+    else:
+        _write_header(tmp, header)
+        del arrays
+        if os.path.exists(path):
+            old_dir = f"{path}.old"
+            os.replace(path, old_dir)
+            os.replace(tmp, path)
+            for fname in os.listdir(old_dir):
+                os.remove(os.path.join(old_dir, fname))
+            os.rmdir(old_dir)
+        else:
+            os.replace(tmp, path)
+    return SiteDayStore(path)
+
+
+def build_snotel_store(
+    snoteldir: str,
+    path: str,
+    columns=("SWE",),
+    units: str = "in",
+    refresh: bool = True,
+    dtype="f8",
+) -> SiteDayStore:
+    """!
+    Consolidate all `snotel{num}.csv` files into one site x day store, see `ingest`.
+    @param snoteldir [str]: directory of the snotel CSVs.
+    @param path [str]: store directory.
+    @param columns [tuple]: CSV columns to store, one matrix each.
+    @param units [str]: units of the stored columns (SNOTEL SWE is in inches).
+    @param dtype: of the stored matrices, e.g. "f4", see `ingest`.
+    @return SiteDayStore, FileNotFoundError if `snoteldir` has no snotel CSV.
+    """
+    csvs = {}
+    for csv in glob.glob(os.path.join(snoteldir, "snotel*.csv")):
+        match = re.fullmatch(r"snotel(\d+)\.csv", os.path.basename(csv))
+        if match is not None:
+            csvs[int(match.group(1))] = csv
+
+    def read(site):
+        data = pd.read_csv(csvs[site], index_col=0)
+        data.index = pd.to_datetime(data.index)
+        return data[list(columns)]
+
+    if not csvs:
+        raise FileNotFoundError(f"No snotel{{num}}.csv files in {snoteldir}")
+    files = {site: [csv] for site, csv in csvs.items()}
+    return ingest(path, files, read, {c: units for c in columns}, refresh=refresh, dtype=dtype)
+
+
+def build_wrfts_store(
+    datadir: str,
+    sites,
+    path: str,
+    start=WRF_START,
+    units: str = "mm",
+    refresh: bool = True,
+    dtype="f8",
+) -> SiteDayStore:
+    """!
+    Consolidate the extracted `wrfpoint_{name}.npy` and `wrfbasin_{name}.npy` series of
+    one model run into a store with `wrfpoint` and `wrfbasin` matrices indexed by site
+    number. Sites without both files are left out.
+    @param datadir [str]: directory of the .npy series, e.g. projectdir/wrfts/ukesm1-0-ll_bc.
+    @param sites [pd.DataFrame]: with site_number and site_name columns.
+    @param path [str]: store directory.
+    @param start [datetime]: date of the first value of every series.
+    @param units [str]: units of the .npy values (WRF SWE is in mm).
+    @param dtype: of the stored matrices, e.g. "f4", see `ingest`.
+    @return SiteDayStore, FileNotFoundError if no site has both files in `datadir`.
+    """
+    files = {}
+    for number, name in zip(sites.site_number, sites.site_name):
+        paths = [
+            os.path.join(datadir, f"{source}_{site_name_key(name)}.npy") for source in WRF_SOURCES
+        ]
+        if all(os.path.exists(p) for p in paths):
+            files[int(number)] = paths
+    if not files:
+        raise FileNotFoundError(
+            f"No wrfpoint_/wrfbasin_ .npy pairs of the {len(sites)} sites in {datadir}"
+        )
+
+    def read(site):
+        series = [
+            pd.Series(values, index=daily_index(start, len(values)), name=source)
+            for source, values in zip(WRF_SOURCES, map(np.load, files[site]))
+        ]
+        return pd.concat(series, axis=1)
+
+    units = {source: units for source in WRF_SOURCES}
+    return ingest(path, files, read, units, refresh=refresh, dtype=dtype)
+
+
+def _save_if_changed(path, values) -> bool:
+    """Atomically write a .npy file unless it already holds `values`, keeping its mtime."""
+    try:
+        if np.array_equal(np.load(path), values, equal_nan=True):
+            return False
+    except (FileNotFoundError, ValueError, OSError):
+        pass
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as fh:
+        np.save(fh, values)
+    os.replace(tmp, path)
+    return True
+
+
+def extract_wrfts(
+    data,
+    sites,
+    datadir: str,
+    coorddir: str,
+    domain: str = "d02",
+    level: str = "huc6",
+    start=WRF_START,
+) -> list:
+    """!
+    Write the `wrfpoint_{name}.npy` and `wrfbasin_{name}.npy` series of every site from
+    a converted field, the inputs of `build_wrfts_store`. wrfpoint is the grid cell of
+    the site (elevation-aware, see spatial.GridLocator), wrfbasin the area-weighted
+    mean of the HUC6 (or HUC8) basin containing the site, see zonal.huc_weights.
+    Files whose values did not change are not rewritten, so their mtimes stay.
+    @param data [xr.DataArray or list]: (day, lat2d, lon2d) field, e.g. from
+        convert.open_store, or a list of fields (historical and ssp370) concatenated.
+    @param sites [gpd.GeoDataFrame]: with site_number, site_name, elev and point
+        geometries, e.g. data.snotel_no_ak.
+    @param coorddir [str]: directory of `wrfinput_{domain}`.
+    @param level [str]: "huc6" or "huc8", the basin of the wrfbasin series.
+    @param start [datetime]: first day of every series, NaN before the field begins.
+    @return paths of the files written.
+    """
+    from fos import data as fosdata
+    from fos.spatial import extract_sites
+    from fos.util import get_cell_area, get_grid_locator
+    from fos.zonal import huc_weights
+
+    if isinstance(data, (list, tuple)):
+        data = xr.concat(list(data), dim="day")
+    data = data.sel(day=slice(pd.Timestamp(start), None))
+    days = pd.date_range(start, pd.Timestamp(data["day"].values[-1]))
+
+    locator = get_grid_locator(coorddir, domain)
+    j, k, _ = locator.query_gdf(sites, elev_col="elev")
+    weights = huc_weights(level, locator.lat2d, locator.lon2d, area=get_cell_area(coorddir, domain))
+    membership = getattr(fosdata, {"huc6": "in6s", "huc8": "in8s"}[level])
+    hucs = membership.reindex(sites.site_number.to_numpy()).to_numpy()
+    needed = sorted(set(hucs[pd.notna(hucs)]) & set(weights.ids))
+    # one pass over the field for all sites and basins, not one per site
+    point = extract_sites(data, j, k).values
+    basin = weights.reduce(data).sel(basin=needed).values
+    rows = {huc: i for i, huc in enumerate(needed)}
+
+    def full(values):
+        return pd.Series(values, index=data["day"].values).reindex(days).to_numpy()
+
+    os.makedirs(datadir, exist_ok=True)
+    written = []
+    for i, name in enumerate(sites.site_name):
+        series = {
+            "wrfpoint": full(point[i]),
+            "wrfbasin": full(basin[rows[hucs[i]]])
+            if hucs[i] in rows
+            else np.full(len(days), np.nan),
+        }
+        for source, values in series.items():
+            path = os.path.join(datadir, f"{source}_{site_name_key(name)}.npy")
+            if _save_if_changed(path, values):
+                written.append(path)
+    # the directory mtime records the extraction, see pipeline.Pipeline.plan
+    os.utime(datadir)
+    return written
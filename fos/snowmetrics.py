@@ -0,0 +1,275 @@
+"""!
+Per-water-year snow metrics for xarray/dask fields with any leading dimensions
+(sites, grid cells, ensemble members, ...).
+
+For every water year (Oct 1 to Sep 30) and every series this computes, in one pass
+over each time chunk:
+- peak: the maximum value, and its position, day of water year and date
+- onset: the first day above `threshold`
+- meltout: the first day after the peak at or below `threshold`
+- snow_days: the number of days above `threshold`
+
+`water_year_stats` gives the generic per-water-year reductions (count, sum, mean, min,
+max and days above/below thresholds) of any field, e.g. the whole WRF grid, and
+`write_water_year_stats` streams them chunk by chunk into a zarr store.
+"""
+
+import dask.array as dsa
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from fos.compact import unpack
+from fos.timeaxis import day_of_water_year, water_year
+
+## order of the metrics along the last axis of the block kernel
+METRICS = ["peak", "peak_index", "peak_dowy", "onset_dowy", "meltout_dowy", "snow_days"]
+## default bound of a float64 copy of one dask block, the kernels hold a few of these
+BLOCK_BYTES = 256 * 2**20
+
+
+def _segments(wy):
+    """Start offset of each water year in a sorted water-year vector."""
+    return np.flatnonzero(np.r_[True, wy[1:] != wy[:-1]])
+
+
+def _year_metrics(values, dowy, threshold):
+    """(..., days of one water year) float64 block -> (..., len(METRICS))."""
+    valid = ~np.isnan(values)
+    anyvalid = valid.any(axis=-1)
+    ipeak = np.where(valid, values, -np.inf).argmax(axis=-1)
+    peak = np.take_along_axis(values, ipeak[..., None], axis=-1)[..., 0]
+
+    snow = valid & (values > threshold)
+    has_snow = snow.any(axis=-1)
+    ionset = snow.argmax(axis=-1)
+    melted = valid & ~snow & (np.arange(values.shape[-1]) > ipeak[..., None])
+    has_melt = has_snow & melted.any(axis=-1)
+    imelt = melted.argmax(axis=-1)
+
+    out = np.stack(
+        [
+            peak,
+            ipeak,
+            dowy[ipeak],
+            np.where(has_snow, dowy[ionset], np.nan),
+            np.where(has_melt, dowy[imelt], np.nan),
+            snow.sum(axis=-1),
+        ],
+        axis=-1,
+    ).astype(np.float64)
+    out[~anyvalid] = np.nan
+    return out
+
+
+def _block_metrics(values, wy, dowy, threshold):
+    """!
+    Metrics for a (..., time) block that holds whole water years.
+    One water year is processed at a time, so the temporaries are (..., 366) at most
+    instead of a copy of the block per intermediate.
+    @return (..., n water years, len(METRICS)) float64 array.
+    """
+    bounds = np.r_[_segments(wy), len(wy)]
+    out = np.empty(values.shape[:-1] + (len(bounds) - 1, len(METRICS)))
+    for i, (a, b) in enumerate(zip(bounds[:-1], bounds[1:])):
+        year = np.asarray(values[..., a:b], dtype=np.float64)
+        out[..., i, :] = _year_metrics(year, np.asarray(dowy[a:b]), threshold)
+    return out
+
+
+def _water_year_chunks(arr, starts, ntime, years_per_chunk, block_bytes):
+    """!
+    Rechunk a (..., time) dask array on water-year boundaries, `years_per_chunk` per
+    chunk, and split the other dims so a float64 copy of a block fits `block_bytes`.
+    """
+    bounds = np.r_[starts[::years_per_chunk], ntime]
+    time_chunks = tuple(np.diff(bounds))
+    series = max(1, block_bytes // (8 * max(time_chunks)))
+    if np.prod([max(c) for c in arr.chunks[:-1]]) <= series:
+        return arr.rechunk(arr.chunks[:-1] + (time_chunks,)), bounds
+    # "auto" chunks of the other dims, the limit is in the array's own itemsize
+    limit = series * max(time_chunks) * arr.dtype.itemsize
+    return arr.rechunk(("auto",) * (arr.ndim - 1) + (time_chunks,), block_size_limit=limit), bounds
+
+
+def _dowy_to_date(wy, dowy):
+    """Date of a (float, NaN for missing) day of water year."""
+    starts = ((wy - 1971) * 12 + 9).astype("datetime64[M]").astype("datetime64[ns]")
+    start = xr.DataArray(starts, dims=["water_year"], coords={"water_year": wy})
+    return start + dowy * np.timedelta64(1, "D")
+
+
+def water_year_metrics(
+    data: xr.DataArray,
+    threshold: float = 0.0,
+    dim: str = "day",
+    years_per_chunk: int = 10,
+    block_bytes: int = BLOCK_BYTES,
+) -> xr.Dataset:
+    """!
+    Peak, onset, melt-out and snow-covered days for every water year of every series.
+    Dask-backed input stays lazy: the time axis is rechunked on water-year boundaries
+    (`years_per_chunk` water years per chunk), leading dims are split when a block
+    would exceed `block_bytes`, and each chunk is reduced independently.
+    @param data [xr.DataArray]: with a datetime `dim` and any other dimensions.
+    @param threshold [float]: values above this count as snow covered (data units).
+    @param dim [str]: the time dimension.
+    @param years_per_chunk [int]: water years per time chunk.
+    @param block_bytes [int]: bound of a float64 block of the dask input.
+    @return xr.Dataset over (other dims..., water_year) with peak, peak_index (position
+        in the water year), peak_dowy, peak_date, onset_dowy, onset_date,
+        meltout_dowy, meltout_date and snow_days.
+    """
+    # int16-packed input (fos.compact) is decoded block by block, the kernel is float64
+    data = unpack(data)
+    if not data.indexes[dim].is_monotonic_increasing:
+        data = data.sortby(dim)
+    dates = pd.DatetimeIndex(data[dim].values)
+    wy, dowy = water_year(dates), day_of_water_year(dates)
+    starts = _segments(wy)
+    wys = wy[starts]
+
+    data = data.transpose(..., dim)
+    other = data.dims[:-1]
+    arr = data.data
+    if isinstance(arr, dsa.Array):
+        arr, bounds = _water_year_chunks(arr, starts, len(wy), years_per_chunk, block_bytes)
+        block_starts = np.r_[0, np.cumsum(arr.chunks[-1])]
+
+        def kernel(block, block_id=None):
+            # block_id also counts the new metric axis, so index the time axis explicitly
+            i = block_id[arr.ndim - 1]
+            sl = slice(block_starts[i], block_starts[i + 1])
+            return _block_metrics(block, wy[sl], dowy[sl], threshold)
+
+        wy_chunks = tuple(len(_segments(wy[a:b])) for a, b in zip(bounds[:-1], bounds[1:]))
+        out = arr.map_blocks(
+            kernel,
+            dtype=np.float64,
+            chunks=arr.chunks[:-1] + (wy_chunks, (len(METRICS),)),
+            new_axis=arr.ndim,
+        )
+    else:
+        out = _block_metrics(np.asarray(arr, dtype=np.float64), wy, dowy, threshold)
+
+    coords = {name: c for name, c in data.coords.items() if dim not in c.dims}
+    coords["water_year"] = wys
+    ds = xr.Dataset(
+        {name: (other + ("water_year",), out[..., i]) for i, name in enumerate(METRICS)},
+        coords=coords,
+    )
+    for name in ["peak", "onset", "meltout"]:
+        ds[f"{name}_date"] = _dowy_to_date(wys, ds[f"{name}_dowy"])
+    return ds
+
+
+## statistics of water_year_stats without thresholds, in kernel order
+STATS = ["count", "sum", "mean", "min", "max"]
+
+
+def _block_stats(values, wy, thresholds):
+    """!
+    Per-water-year reductions of a (..., time) block that holds whole water years.
+    @return (..., n water years, len(STATS) + 2 * len(thresholds)) float64 array: STATS,
+        then the days above each threshold, then the days below each threshold.
+    """
+    starts = _segments(wy)
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    count = np.add.reduceat(valid, starts, axis=-1).astype(np.float64)
+    total = np.add.reduceat(np.where(valid, values, 0.0), starts, axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = total / count
+    out = [
+        count,
+        total,
+        mean,
+        np.fmin.reduceat(values, starts, axis=-1),
+        np.fmax.reduceat(values, starts, axis=-1),
+    ]
+    for compare in (np.greater, np.less):
+        for threshold in thresholds:
+            hits = valid & compare(values, threshold, where=valid, out=np.zeros_like(valid))
+            out.append(np.add.reduceat(hits, starts, axis=-1).astype(np.float64))
+    out = np.stack(out, axis=-1)
+    # water years without any valid day
+    out[count == 0, 1:5] = np.nan
+    return out
+
+
+def water_year_stats(
+    data: xr.DataArray,
+    thresholds=(),
+    dim: str = "day",
+    years_per_chunk: int = 10,
+    block_bytes: int = BLOCK_BYTES,
+) -> xr.Dataset:
+    """!
+    Per-water-year count of valid days, sum, mean, min, max and threshold exceedance of
+    a field with any other dimensions (e.g. the full lat2d x lon2d grid).
+    Like `water_year_metrics`, dask input stays lazy: the time axis is rechunked on
+    water-year boundaries and every chunk is reduced independently (in parallel), so
+    the daily cube is never held in memory. Write the result with
+    `write_water_year_stats` to stream it to disk.
+    @param data [xr.DataArray]: with a datetime `dim`.
+    @param thresholds [sequence]: values for the exceedance counts.
+    @param dim [str]: the time dimension.
+    @param years_per_chunk [int]: water years per time chunk.
+    @param block_bytes [int]: bound of a float64 block of the dask input.
+    @return xr.Dataset over (other dims..., water_year) with count, sum, mean, min, max,
+        and over (other dims..., water_year, threshold) days_above (> threshold),
+        days_below (< threshold) and fraction_above (days_above / count).
+    """
+    thresholds = np.atleast_1d(np.asarray(thresholds, dtype=np.float64))
+    data = unpack(data)
+    if not data.indexes[dim].is_monotonic_increasing:
+        data = data.sortby(dim)
+    dates = pd.DatetimeIndex(data[dim].values)
+    wy = water_year(dates)
+    starts = _segments(wy)
+    nstat = len(STATS) + 2 * len(thresholds)
+
+    data = data.transpose(..., dim)
+    other = data.dims[:-1]
+    arr = data.data
+    if isinstance(arr, dsa.Array):
+        arr, bounds = _water_year_chunks(arr, starts, len(wy), years_per_chunk, block_bytes)
+        block_starts = np.r_[0, np.cumsum(arr.chunks[-1])]
+
+        def kernel(block, block_id=None):
+            i = block_id[arr.ndim - 1]
+            return _block_stats(block, wy[block_starts[i] : block_starts[i + 1]], thresholds)
+
+        wy_chunks = tuple(len(_segments(wy[a:b])) for a, b in zip(bounds[:-1], bounds[1:]))
+        out = arr.map_blocks(
+            kernel,
+            dtype=np.float64,
+            chunks=arr.chunks[:-1] + (wy_chunks, (nstat,)),
+            new_axis=arr.ndim,
+        )
+    else:
+        out = _block_stats(arr, wy, thresholds)
+
+    coords = {name: c for name, c in data.coords.items() if dim not in c.dims}
+    coords["water_year"] = wy[starts]
+    coords["threshold"] = thresholds
+    dims = other + ("water_year",)
+    ds = xr.Dataset({name: (dims, out[..., i]) for i, name in enumerate(STATS)}, coords=coords)
+    n = len(thresholds)
+    ds["days_above"] = (dims + ("threshold",), out[..., len(STATS) : len(STATS) + n])
+    ds["days_below"] = (dims + ("threshold",), out[..., len(STATS) + n :])
+    ds["fraction_above"] = ds["days_above"] / ds["count"].where(ds["count"] > 0)
+    return ds
+
+
+def write_water_year_stats(data: xr.DataArray, path: str, group: str = None, **kwargs) -> str:
+    """!
+    Compute `water_year_stats` chunk by chunk straight into a zarr store, e.g. one group
+    per scenario: `write_water_year_stats(swe_ssp370, "wy_stats.zarr", group="ssp370")`.
+    @param kwargs: passed to water_year_stats (thresholds, dim, years_per_chunk,
+        block_bytes).
+    @return path
+    """
+    stats = water_year_stats(data, **kwargs)
+    stats.to_zarr(path, group=group, mode="w")
+    return path
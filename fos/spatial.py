@@ -0,0 +1,333 @@
+"""!
+Spatial helpers for the WRF grid: locating sites on the curvilinear lat2d/lon2d grid,
+and pulling many sites or whole basins out of a (day, lat2d, lon2d) field without
+computing the full domain.
+
+`subset_window` turns a region name, a lat/lon box, a (HUC) polygon or a set of site
+points into an index window on lat2d/lon2d, which the WRF readers apply at open time
+(`subset=` of `util._wrfread_gcm` / `util.get_wrf_data`) so only that hyperslab is read.
+"""
+
+import numpy as np
+import shapely
+import xarray as xr
+from scipy.spatial import cKDTree
+
+from fos.compact import PACKED_ATTRS, unpack
+
+## mean earth radius in km
+EARTH_RADIUS_KM = 6371.0
+## analysis subregions as (lat_min, lat_max, lon_min, lon_max), bounds inclusive
+REGIONS = {
+    "SW": (35.0, 42.0, -121.0, -114.0),
+    "SCR": (35.0, 42.0, -114.0, -105.0),
+    "NCR": (42.0, 49.0, -117.0, -107.0),
+    "PNW": (42.0, 49.0, -125.0, -117.0),
+    "ALL": (35.0, 49.0, -125.0, -105.0),
+}
+
+
+def region_mask(lat2d, lon2d, region) -> np.ndarray:
+    """!
+    Cells of the grid inside a named region (see REGIONS) or a
+    (lat_min, lat_max, lon_min, lon_max) box, bounds inclusive.
+    """
+    lat_min, lat_max, lon_min, lon_max = REGIONS[region] if isinstance(region, str) else region
+    lat2d, lon2d = np.asarray(lat2d), np.asarray(lon2d)
+    return (lat2d >= lat_min) & (lat2d <= lat_max) & (lon2d >= lon_min) & (lon2d <= lon_max)
+
+
+def _to_xyz(lat, lon):
+    """Unit-sphere cartesian coordinates, chord distance is monotonic in arc length."""
+    lat, lon = np.deg2rad(lat), np.deg2rad(lon)
+    return np.stack(
+        [np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1
+    )
+
+
+class GridLocator:
+    """!
+    KD-tree index over the cell centers of a WRF grid.
+
+    By default distances are euclidean in degrees, which matches the brute-force
+    `np.sqrt((lat_2d - lat)**2 + (lon_2d - lon)**2)` search used in the notebooks.
+    With `great_circle=True` the tree is built on the unit sphere instead.
+    """
+
+    def __init__(self, lat2d, lon2d, hgt=None, great_circle: bool = False):
+        self.lat2d = np.asarray(lat2d, dtype=np.float64)
+        self.lon2d = np.asarray(lon2d, dtype=np.float64)
+        self.shape = self.lat2d.shape
+        self.hgt = None if hgt is None else np.asarray(hgt, dtype=np.float64).ravel()
+        self.great_circle = great_circle
+        if great_circle:
+            pts = _to_xyz(self.lat2d.ravel(), self.lon2d.ravel())
+        else:
+            pts = np.column_stack([self.lat2d.ravel(), self.lon2d.ravel()])
+        self.tree = cKDTree(pts)
+
+    def _points(self, lat, lon):
+        if self.great_circle:
+            return _to_xyz(lat, lon)
+        return np.column_stack([lat, lon])
+
+    def _distance(self, dist):
+        if self.great_circle:
+            # chord length on the unit sphere -> great-circle distance in km
+            return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(dist / 2, 0, 1))
+        return dist
+
+    def query(self, lat, lon, elev=None, candidates: int = 9):
+        """!
+        Find the grid cell of each site.
+        @param lat [array-like]: site latitudes.
+        @param lon [array-like]: site longitudes.
+        @param elev [array-like]: optional site elevations (same units as HGT). When given
+            and the locator has HGT, the cell closest in elevation among the
+            `candidates` nearest cells is chosen.
+        @param candidates [int]: neighbors considered for the elevation-aware choice.
+        @return (j, k, distance): lat2d and lon2d indices, and the distance to the
+            chosen cell center (degrees, or km when great_circle).
+        """
+        lat = np.atleast_1d(np.asarray(lat, dtype=np.float64))
+        lon = np.atleast_1d(np.asarray(lon, dtype=np.float64))
+        pts = self._points(lat, lon)
+        if elev is None or self.hgt is None:
+            dist, flat = self.tree.query(pts, k=1)
+        else:
+            elev = np.atleast_1d(np.asarray(elev, dtype=np.float64))
+            dists, flats = self.tree.query(pts, k=candidates)
+            best = np.argmin(np.abs(self.hgt[flats] - elev[:, None]), axis=1)
+            rows = np.arange(len(flats))
+            dist, flat = dists[rows, best], flats[rows, best]
+        j, k = np.unravel_index(flat, self.shape)
+        return j, k, self._distance(dist)
+
+    def query_gdf(self, gdf, elev_col: str = None, **kwargs):
+        """Locate the point geometries of a GeoDataFrame, see `query`."""
+        elev = None if elev_col is None else gdf[elev_col].to_numpy()
+        return self.query(gdf.geometry.y.to_numpy(), gdf.geometry.x.to_numpy(), elev, **kwargs)
+
+
+def extract_sites(data, j, k, time_chunk: int = 3650, dim: str = "day"):
+    """!
+    Pull many grid cells out of a (day, lat2d, lon2d) field in one pass.
+    Each time chunk is read once and all sites are taken from it with a single
+    pointwise (vectorized) index, instead of one `data[:, j, k]` per site.
+    @param data [xr.DataArray, xr.Dataset or list]: the field, a Dataset of fields
+        (e.g. from `util.read_wrf_vars`, all variables of a chunk are computed
+        together), or a list of fields (e.g. historical and ssp370) concatenated
+        along `dim`.
+    @param j [array-like]: lat2d index of each site.
+    @param k [array-like]: lon2d index of each site.
+    @param time_chunk [int]: days loaded per pass, bounds the memory used.
+    @return xr.DataArray (xr.Dataset for a Dataset) with dims (site, day).
+    """
+    if isinstance(data, (list, tuple)):
+        data = xr.concat(list(data), dim=dim)
+    j = np.atleast_1d(np.asarray(j, dtype=np.intp))
+    k = np.atleast_1d(np.asarray(k, dtype=np.intp))
+    points = dict(lat2d=xr.DataArray(j, dims="site"), lon2d=xr.DataArray(k, dims="site"))
+    ntime = data.sizes[dim]
+    fields = _fields(data)
+    out = {name: np.empty((len(j), ntime), dtype=field.dtype) for name, field in fields.items()}
+    for start in range(0, ntime, time_chunk):
+        stop = min(start + time_chunk, ntime)
+        block = data.isel({dim: slice(start, stop)}).isel(points).compute()
+        for name, field in _fields(block).items():
+            out[name][:, start:stop] = field.transpose("site", dim).values
+    coords = {dim: data[dim].values, "j": ("site", j), "k": ("site", k)}
+    return _like(data, out, ("site", dim), coords)
+
+
+def _fields(data) -> dict:
+    """{name: DataArray} of a Dataset's variables, {None: data} for a DataArray."""
+    if isinstance(data, xr.Dataset):
+        return {name: data[name] for name in data.data_vars}
+    return {None: data}
+
+
+def _like(data, values: dict, dims, coords, unpacked: bool = False):
+    """!
+    Wrap the arrays of `_fields(data)` back into the type of `data`, with their attrs.
+    @param unpacked [bool]: the values were decoded, drop the int16 packing attrs.
+    """
+
+    def attrs(field):
+        drop = PACKED_ATTRS if unpacked else ()
+        return {key: value for key, value in field.attrs.items() if key not in drop}
+
+    if isinstance(data, xr.Dataset):
+        return xr.Dataset(
+            {name: (dims, v, attrs(data[name])) for name, v in values.items()}, coords=coords
+        )
+    return xr.DataArray(values[None], dims=dims, coords=coords, name=data.name, attrs=attrs(data))
+
+
+def bbox_window(lat2d, lon2d, bounds):
+    """!
+    Smallest index window of the grid holding every cell strictly inside `bounds`.
+    @param bounds [sequence]: (minx, miny, maxx, maxy), i.e. (lon0, lat0, lon1, lat1).
+    @return (rows, cols) slices along lat2d and lon2d, or None if no cell is inside.
+    """
+    lat2d, lon2d = np.asarray(lat2d), np.asarray(lon2d)
+    mask = (lat2d > bounds[1]) & (lat2d < bounds[3]) & (lon2d > bounds[0]) & (lon2d < bounds[2])
+    rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        return None
+    return slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1)
+
+
+def _geometry(basin):
+    """Accept a shapely geometry or a (Geo)DataFrame/GeoSeries whose first row is used."""
+    if hasattr(basin, "geometry"):
+        return basin.geometry.values[0]
+    if hasattr(basin, "values"):
+        return basin.values[0]
+    return basin
+
+
+def basin_cells(basin, lat2d, lon2d):
+    """!
+    Cells of the grid inside a basin polygon, tested on cell centers.
+    The polygon test only runs on the basin's bounding-box window, vectorized.
+    @return (window, bboxmask, inside): the index window (or None), the cells of the
+        window strictly inside the bounding box, and which of those are in the polygon.
+    """
+    geom = _geometry(basin)
+    window = bbox_window(lat2d, lon2d, geom.bounds)
+    if window is None:
+        return None, None, None
+    lat_w, lon_w = np.asarray(lat2d)[window], np.asarray(lon2d)[window]
+    minx, miny, maxx, maxy = geom.bounds
+    bboxmask = (lat_w > miny) & (lat_w < maxy) & (lon_w > minx) & (lon_w < maxx)
+    inside = shapely.contains_xy(geom, lon_w[bboxmask], lat_w[bboxmask])
+    return window, bboxmask, inside
+
+
+def window_cells(data, window, cells, time_chunk, dim):
+    """!
+    Read the index window one time chunk at a time and keep only `cells` (2-D mask).
+    @return (cell, time) array, or {name: array} for a Dataset (every variable of a
+        chunk is computed at once).
+    """
+    rows, cols = window
+    # cells outside the basin become NaN, so int16-packed input is decoded
+    cropped = unpack(data.isel(lat2d=rows, lon2d=cols))
+    ntime = cropped.sizes[dim]
+    out = {
+        name: np.empty((int(cells.sum()), ntime), dtype=np.result_type(field.dtype, np.float32))
+        for name, field in _fields(cropped).items()
+    }
+    for start in range(0, ntime, time_chunk):
+        stop = min(start + time_chunk, ntime)
+        block = cropped.isel({dim: slice(start, stop)}).compute()
+        for name, field in _fields(block).items():
+            out[name][:, start:stop] = field.transpose(dim, "lat2d", "lon2d").values[:, cells].T
+    return out if isinstance(data, xr.Dataset) else out[None]
+
+
+def extract_basin(basin, lat2d, lon2d, data, time_chunk: int = 365, dim: str = "day"):
+    """!
+    Extract the cells of one basin as a compact (cell, day) array.
+    The field is cropped lazily to the basin's bounding-box index window before
+    anything is computed, and then streamed `time_chunk` days at a time, so memory
+    is bounded by time_chunk x window size rather than the full domain.
+    @param basin: shapely polygon, or GeoDataFrame whose first row is the basin.
+    @param lat2d, lon2d [array-like]: cell center coordinates of the grid.
+    @param data [xr.DataArray or xr.Dataset]: (day, lat2d, lon2d) field(s), usually
+        dask backed. All variables of a Dataset are read in the same pass.
+    @return xr.DataArray (xr.Dataset for a Dataset) with dims (cell, day) and j, k,
+        lat, lon cell coordinates.
+    """
+    window, bboxmask, inside = basin_cells(basin, lat2d, lon2d)
+    if window is None or not inside.any():
+        raise ValueError("No grid cell centers fall inside the basin")
+    cells = np.zeros(bboxmask.shape, dtype=bool)
+    cells[bboxmask] = inside
+    values = window_cells(data, window, cells, time_chunk, dim)
+    jj, kk = np.nonzero(cells)
+    j, k = jj + window[0].start, kk + window[1].start
+    coords = {
+        dim: data[dim].values,
+        "j": ("cell", j),
+        "k": ("cell", k),
+        "lat": ("cell", np.asarray(lat2d)[j, k]),
+        "lon": ("cell", np.asarray(lon2d)[j, k]),
+    }
+    if not isinstance(data, xr.Dataset):
+        values = {None: values}
+    return _like(data, values, ("cell", dim), coords, unpacked=True)
+
+
+def _is_box(subset):
+    return isinstance(subset, (tuple, list)) and len(subset) == 4 and np.isscalar(subset[0])
+
+
+def subset_mask(lat2d, lon2d, subset) -> np.ndarray:
+    """!
+    Cells of the grid selected by `subset`, see `subset_window`.
+    Polygons select every cell center inside their bounding box (bounds inclusive), a
+    superset of the cells `basin_cells` keeps; points select their nearest cell.
+    """
+    lat2d, lon2d = np.asarray(lat2d), np.asarray(lon2d)
+    if isinstance(subset, str) or _is_box(subset):
+        return region_mask(lat2d, lon2d, subset)
+    if isinstance(subset, shapely.Geometry):
+        geoms = [subset]
+    elif hasattr(subset, "geometry"):
+        geoms = list(subset.geometry.values)
+    else:
+        geoms = list(subset)
+    if all(g.geom_type == "Point" for g in geoms):
+        lats, lons = [g.y for g in geoms], [g.x for g in geoms]
+        j, k, _ = GridLocator(lat2d, lon2d).query(lats, lons)
+        mask = np.zeros(lat2d.shape, dtype=bool)
+        mask[j, k] = True
+        return mask
+    minx, miny, maxx, maxy = shapely.union_all(geoms).bounds
+    return region_mask(lat2d, lon2d, (miny, maxy, minx, maxx))
+
+
+def subset_window(lat2d, lon2d, subset, pad: int = 0):
+    """!
+    Smallest index window of the grid holding every cell selected by `subset`.
+    @param subset: a name from REGIONS, a (lat_min, lat_max, lon_min, lon_max) box, a
+        shapely geometry or GeoDataFrame/GeoSeries (e.g. HUC polygons, by their
+        bounding box), or point geometries / a GeoDataFrame of sites (their cells).
+    @param pad [int]: extra cells kept on every side, clipped to the grid.
+    @return (rows, cols) slices along lat2d and lon2d.
+    """
+    mask = subset_mask(lat2d, lon2d, subset)
+    rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        raise ValueError(f"No grid cell falls inside the subset {subset!r}")
+    nrows, ncols = mask.shape
+    return (
+        slice(max(rows[0] - pad, 0), min(rows[-1] + 1 + pad, nrows)),
+        slice(max(cols[0] - pad, 0), min(cols[-1] + 1 + pad, ncols)),
+    )
+
+
+def window_coords(window, lat2d=None, lon2d=None, dims=("lat2d", "lon2d")) -> dict:
+    """!
+    Coordinates of a cropped field: the global indices of the window as `j`/`k`, and
+    the cell centers as 2-D `lat`/`lon` when the grid is given, so the cropped field
+    can be passed on with `data.lat`, `data.lon` instead of the full-domain grid.
+    """
+    rows, cols = window
+    coords = {
+        "j": (dims[0], np.arange(rows.start, rows.stop)),
+        "k": (dims[1], np.arange(cols.start, cols.stop)),
+    }
+    if lat2d is not None:
+        coords["lat"] = (dims, np.asarray(lat2d)[rows, cols])
+        coords["lon"] = (dims, np.asarray(lon2d)[rows, cols])
+    return coords
+
+
+def crop(data, window, lat2d=None, lon2d=None, dims=("lat2d", "lon2d")):
+    """Lazily restrict a field to an index window, with `window_coords`."""
+    rows, cols = window
+    data = data.isel({dims[0]: rows, dims[1]: cols})
+    return data.assign_coords(window_coords(window, lat2d, lon2d, dims))
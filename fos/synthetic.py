@@ -0,0 +1,298 @@
+"""!
+Synthetic stand-ins for the WRF postprocess tree and the SNOTEL/HUC inputs, so the
+readers and analyses can be run and benchmarked off-cluster.
+
+`make_fake_tree(root)` writes, at a configurable scale,
+```
+{root}/postprocess/{model}_{variant}_{experiment}_bc/postprocess/d02/
+    {var}.daily.{model}_{hist|ssp370}_{variant}_d02_{year}.nc    # day codes, (day, lat2d, lon2d)
+{root}/postprocess/WRF-data/wrf_coordinates/wrfinput_d02       # XLAT, XLONG, HGT
+{root}/postprocess/WRF-data/wrf_coordinates/wrfinput_d02_coord.nc
+{root}/fos-data/snoteldata/snotel{num}.csv, snotelmeta.csv
+{root}/fos-data/spatialdata/huc6.shp, huc8.shp
+{root}/fos-data/wrfts/{model}_bc/wrfpoint_{name}.npy, wrfbasin_{name}.npy
+```
+SWE follows one seasonal cycle per water year scaled by terrain height and a random
+factor per year, so the same day and cell give the same value in every file.
+"""
+
+import itertools
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from fos.constants import MM_TO_IN
+from fos.sitestore import WRF_START, site_name_key
+from fos.spatial import REGIONS
+from fos.timeaxis import day_of_water_year, water_year
+
+## named sizes: grid shape, number of SNOTEL sites, HUC6 boxes per axis, years per
+## experiment
+SCALES = {
+    "tiny": dict(shape=(20, 25), nsites=8, nhuc6=2, years=2),
+    "small": dict(shape=(60, 80), nsites=40, nhuc6=3, years=4),
+    "medium": dict(shape=(170, 135), nsites=200, nhuc6=5, years=10),
+    "full": dict(shape=(340, 270), nsites=800, nhuc6=8, years=30),
+}
+## first year of the ssp370 runs, the historical runs end the year before
+FUTURE_START = 2014
+EXPERIMENT_FILES = {"historical": "hist", "ssp370": "ssp370"}
+STATES = ["CA", "NV", "OR", "WA", "ID", "MT", "WY", "UT", "CO", "AZ", "NM"]
+
+
+def make_grid(shape, seed: int = 0):
+    """!
+    Curvilinear lat/lon grid over spatial.REGIONS['ALL'] and a terrain height field.
+    @return (lat2d, lon2d, hgt) float arrays of `shape`.
+    """
+    lat_min, lat_max, lon_min, lon_max = REGIONS["ALL"]
+    lat, lon = np.meshgrid(
+        np.linspace(lat_min, lat_max, shape[0]),
+        np.linspace(lon_min, lon_max, shape[1]),
+        indexing="ij",
+    )
+    # slightly rotated like the WRF lambert grid
+    lat2d = lat + 0.15 * np.sin(np.deg2rad(lon - lon_min) * 4)
+    lon2d = lon + 0.15 * np.cos(np.deg2rad(lat - lat_min) * 4)
+    rng = np.random.default_rng(seed)
+    hgt = np.full(shape, 500.0)
+    for _ in range(12):
+        clat, clon = rng.uniform(lat_min, lat_max), rng.uniform(lon_min, lon_max)
+        height, width = rng.uniform(800, 2500), rng.uniform(0.8, 3.0)
+        hgt += height * np.exp(-((lat2d - clat) ** 2 + (lon2d - clon) ** 2) / (2 * width**2))
+    return lat2d, lon2d, hgt
+
+
+def swe(dates, hgt, seed: int = 0) -> np.ndarray:
+    """!
+    Synthetic daily SWE in mm for terrain heights `hgt` (any shape).
+    @return (len(dates), *hgt.shape) float32 array.
+    """
+    dates = pd.DatetimeIndex(dates)
+    dowy = day_of_water_year(dates)
+    # accumulate from November to early April, melt out by July
+    shape = np.clip((dowy - 30) / 150, 0, 1) * (dowy <= 180)
+    shape = shape + np.clip((270 - dowy) / 90, 0, 1) * (dowy > 180)
+    years, inverse = np.unique(water_year(dates), return_inverse=True)
+    factor = np.array([0.6 + 0.8 * np.random.default_rng((seed, int(y))).random() for y in years])
+    factor = factor[inverse]
+    amp = np.clip((np.asarray(hgt, dtype=np.float64) - 1000) / 2000, 0, 1) * 800
+    return ((shape * factor)[:, None] * amp.reshape(1, -1)).reshape(
+        (len(dates),) + np.shape(hgt)
+    ).astype(np.float32)
+
+
+def prec(dates, hgt, seed: int = 0) -> np.ndarray:
+    """!
+    Synthetic daily precipitation in mm, wetter in winter and with height.
+    @return (len(dates), *hgt.shape) float32 array.
+    """
+    dates = pd.DatetimeIndex(dates)
+    season = 1 + np.cos(2 * np.pi * day_of_water_year(dates) / 365 - 2.2)
+    # the same wet days everywhere, a fixed stream per day
+    epoch_days = dates.asi8 // (86400 * 10**9)
+    wet = np.array([np.random.default_rng((seed, int(d))).random() for d in epoch_days])
+    amp = 1 + np.asarray(hgt, dtype=np.float64) / 1000
+    values = (np.where(wet < 0.35, wet * 20, 0) * season)[:, None] * amp.reshape(1, -1)
+    return values.reshape((len(dates),) + np.shape(hgt)).astype(np.float32)
+
+
+def t2(dates, hgt, seed: int = 0) -> np.ndarray:
+    """!
+    Synthetic daily 2 m temperature in K: a seasonal cycle with a 6.5 K/km lapse rate.
+    @return (len(dates), *hgt.shape) float32 array.
+    """
+    dates = pd.DatetimeIndex(dates)
+    season = 283 - 12 * np.cos(2 * np.pi * (dates.dayofyear.values - 15) / 365)
+    lapse = -6.5e-3 * np.asarray(hgt, dtype=np.float64)
+    values = season[:, None] + lapse.reshape(1, -1)
+    return values.reshape((len(dates),) + np.shape(hgt)).astype(np.float32)
+
+
+## the variables make_fake_tree can write: generator and units
+FIELDS = {"snow": (swe, "mm"), "prec": (prec, "mm"), "t2": (t2, "K")}
+
+
+def _write_wrf(wrfdir, models, years_hist, years_future, hgt, seed, variables=("snow",)):
+    """Per-year daily files of every model x experiment x variable, the day as codes."""
+    files = []
+    for (model, variant), var in itertools.product(models, variables):
+        func, units = FIELDS[var]
+        for experiment, years in (("historical", years_hist), ("ssp370", years_future)):
+            run = f"{model}_{variant}_{experiment}_bc"
+            d02 = os.path.join(wrfdir, run, "postprocess", "d02")
+            os.makedirs(d02, exist_ok=True)
+            for year in years:
+                days = pd.date_range(f"{year}-01-01", f"{year}-12-31")
+                tag = EXPERIMENT_FILES[experiment]
+                fname = f"{var}.daily.{model}_{tag}_{variant}_d02_{year}.nc"
+                ds = xr.Dataset(
+                    {var: (("day", "lat2d", "lon2d"), func(days, hgt, seed))},
+                    coords={"day": days.strftime("%Y%m%d").astype(np.float64)},
+                )
+                ds[var].attrs["units"] = units
+                path = os.path.join(d02, fname)
+                ds.to_netcdf(path, encoding={var: {"zlib": True, "complevel": 1}})
+                files.append(path)
+    return files
+
+
+def _write_coords(coorddir, lat2d, lon2d, hgt):
+    os.makedirs(coorddir, exist_ok=True)
+    dims = ("Time", "south_north", "west_east")
+    # lambert conformal map factor, 1 on the true latitudes 30 and 60 N, DX = DY = 9 km
+    mapfac = 1 - 0.02 * np.cos(np.deg2rad(lat2d - 45) * 6)
+    xr.Dataset(
+        {
+            "XLAT": (dims, lat2d[None]),
+            "XLONG": (dims, lon2d[None]),
+            "HGT": (dims, hgt[None]),
+            "MAPFAC_M": (dims, mapfac[None]),
+        },
+        attrs={"DX": 9000.0, "DY": 9000.0},
+    ).to_netcdf(os.path.join(coorddir, "wrfinput_d02"))
+    xr.Dataset(
+        {"lat2d": (("lat", "lon"), lat2d), "lon2d": (("lat", "lon"), lon2d)}
+    ).to_netcdf(os.path.join(coorddir, "wrfinput_d02_coord.nc"))
+
+
+def _write_snotel(snoteldir, lat2d, lon2d, hgt, nsites, start, end, seed):
+    """Sites on the highest cells, their CSVs (SWE in inches, with gaps) and the meta table."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(snoteldir, exist_ok=True)
+    candidates = np.argsort(hgt.ravel())[::-1][: max(4 * nsites, nsites)]
+    cells = np.sort(rng.choice(candidates, size=nsites, replace=False))
+    j, k = np.unravel_index(cells, hgt.shape)
+    days = pd.date_range(start, end)
+    series = swe(days, hgt[j, k], seed)
+    rows = []
+    for i in range(nsites):
+        number = 300 + i
+        name = f"Fake Site {i}"
+        values = series[:, i] * MM_TO_IN * rng.uniform(0.8, 1.2)
+        values[rng.random(len(days)) < 0.02] = np.nan
+        pd.DataFrame({"SWE": values}, index=pd.Index(days, name="date")).to_csv(
+            os.path.join(snoteldir, f"snotel{number}.csv")
+        )
+        rows.append(
+            dict(
+                site_name=name,
+                elev=float(hgt[j[i], k[i]]),
+                site_number=number,
+                state=STATES[i % len(STATES)],
+                namestr=f"{name} ({number})",
+                startdt=str(days[0].date()),
+                lon=float(lon2d[j[i], k[i]]),
+                lat=float(lat2d[j[i], k[i]]),
+            )
+        )
+    meta = pd.DataFrame(rows)
+    meta.to_csv(os.path.join(snoteldir, "snotelmeta.csv"), index=False)
+    return meta, j, k
+
+
+def _write_hucs(spatialdir, nhuc6):
+    """HUC6 boxes tiling REGIONS['ALL'], each split in 2 x 2 HUC8 boxes."""
+    import geopandas as gpd
+    from shapely.geometry import box
+
+    os.makedirs(spatialdir, exist_ok=True)
+    lat_min, lat_max, lon_min, lon_max = REGIONS["ALL"]
+    lats = np.linspace(lat_min, lat_max, nhuc6 + 1)
+    lons = np.linspace(lon_min, lon_max, nhuc6 + 1)
+    huc6, huc8 = [], []
+    for a in range(nhuc6):
+        for b in range(nhuc6):
+            code = f"{10 + a:02d}{10 + b:02d}{a * nhuc6 + b:02d}"
+            bounds = (lons[b], lats[a], lons[b + 1], lats[a + 1])
+            huc6.append(dict(name=f"Basin {code}", huc6=code, geometry=box(*bounds)))
+            mlat, mlon = (lats[a] + lats[a + 1]) / 2, (lons[b] + lons[b + 1]) / 2
+            quads = [
+                (lons[b], lats[a], mlon, mlat),
+                (mlon, lats[a], lons[b + 1], mlat),
+                (lons[b], mlat, mlon, lats[a + 1]),
+                (mlon, mlat, lons[b + 1], lats[a + 1]),
+            ]
+            for q, bounds in enumerate(quads):
+                huc8.append(
+                    dict(name=f"Basin {code}{q:02d}", huc8=f"{code}{q:02d}", geometry=box(*bounds))
+                )
+    for name, rows in (("huc6", huc6), ("huc8", huc8)):
+        gpd.GeoDataFrame(rows, crs="epsg:4326").to_file(os.path.join(spatialdir, f"{name}.shp"))
+
+
+def _write_wrfts(wrftsdir, meta, j, k, hgt, end, seed):
+    """wrfpoint_/wrfbasin_ series of every site from WRF_START, in mm."""
+    os.makedirs(wrftsdir, exist_ok=True)
+    days = pd.date_range(WRF_START, end)
+    point = swe(days, hgt[j, k], seed)
+    # the basin series: the mean of the 3 x 3 neighborhood
+    for i, name in enumerate(meta.site_name):
+        jj = slice(max(j[i] - 1, 0), j[i] + 2)
+        kk = slice(max(k[i] - 1, 0), k[i] + 2)
+        basin = swe(days, hgt[jj, kk].ravel(), seed).mean(axis=1)
+        key = site_name_key(name)
+        np.save(os.path.join(wrftsdir, f"wrfpoint_{key}.npy"), point[:, i])
+        np.save(os.path.join(wrftsdir, f"wrfbasin_{key}.npy"), basin)
+
+
+def make_fake_tree(
+    root: str,
+    scale: str = "tiny",
+    models=(("cesm2", "r11i1p1f1"),),
+    seed: int = 0,
+    variables=("snow",),
+    **overrides,
+) -> dict:
+    """!
+    Write a synthetic WRF postprocess tree and SNOTEL/HUC inputs, see the module docstring.
+    @param root [str]: output directory.
+    @param scale [str]: a key of SCALES.
+    @param models [list]: (model, variant) pairs, each gets a historical and ssp370 run.
+    @param seed [int]: random seed of the terrain, sites and yearly SWE factors.
+    @param variables [list]: WRF variables written, keys of FIELDS.
+    @param overrides: replace entries of the scale, e.g. shape=(100, 100) or years=3.
+    @return dict of the paths (wrfdir, coorddir, projectdir, snoteldir, spatialdir,
+        wrftsdir per model as wrfts) and the scale parameters.
+    """
+    params = dict(SCALES[scale], **overrides)
+    root = os.path.abspath(os.path.expanduser(root))
+    wrfdir = os.path.join(root, "postprocess")
+    coorddir = os.path.join(wrfdir, "WRF-data", "wrf_coordinates")
+    projectdir = os.path.join(root, "fos-data")
+    snoteldir = os.path.join(projectdir, "snoteldata")
+    spatialdir = os.path.join(projectdir, "spatialdata")
+
+    nyears = params["years"]
+    years_hist = list(range(FUTURE_START - nyears, FUTURE_START))
+    years_future = list(range(FUTURE_START, FUTURE_START + nyears))
+    end = f"{years_future[-1]}-12-31"
+
+    lat2d, lon2d, hgt = make_grid(params["shape"], seed)
+    files = _write_wrf(wrfdir, models, years_hist, years_future, hgt, seed, variables)
+    _write_coords(coorddir, lat2d, lon2d, hgt)
+    meta, j, k = _write_snotel(
+        snoteldir, lat2d, lon2d, hgt, params["nsites"], f"{years_hist[0]}-01-01", end, seed
+    )
+    _write_hucs(spatialdir, params["nhuc6"])
+    wrfts = {}
+    for model, _ in models:
+        wrfts[model] = os.path.join(projectdir, "wrfts", f"{model}_bc")
+        _write_wrfts(wrfts[model], meta, j, k, hgt, end, seed)
+    return dict(
+        root=root,
+        wrfdir=wrfdir,
+        coorddir=coorddir,
+        projectdir=projectdir,
+        snoteldir=snoteldir,
+        spatialdir=spatialdir,
+        wrfts=wrfts,
+        files=files,
+        models=[list(m) for m in models],
+        variables=list(variables),
+        years_hist=years_hist,
+        years_future=years_future,
+        **params,
+    )
@@ -0,0 +1,88 @@
+"""!
+Vectorized calendar helpers for the WRF `day` axis.
+
+The postprocessed WRF files store `day` as YYYYMMDD codes (float or int). Some GCM
+calendars produce days that do not exist in the gregorian calendar (e.g. Feb 30 in a
+360-day calendar); those fall back to the 28th of the same month, as the original
+per-element strptime loop did.
+"""
+
+import numpy as np
+import pandas as pd
+
+## first month of the water year (Oct 1 to Sep 30)
+WY_START_MONTH = 10
+
+
+def decode_day(values) -> pd.DatetimeIndex:
+    """!
+    Decode YYYYMMDD day codes into a DatetimeIndex in one vectorized pass.
+    @param values [array-like]: float or int codes, e.g. 19800101.0
+    @return pd.DatetimeIndex, invalid days moved to the 28th of their month.
+    """
+    codes = np.asarray(values)
+    if codes.dtype.kind == "f":
+        codes = np.round(codes)
+    codes = codes.astype(np.int64)
+    year, month, day = codes // 10000, codes // 100 % 100, codes % 100
+    if np.any((month < 1) | (month > 12)):
+        bad = codes[(month < 1) | (month > 12)][0]
+        raise ValueError(f"Invalid month in day code {bad}")
+
+    month_start = ((year - 1970) * 12 + month - 1).astype("datetime64[M]")
+    first = month_start.astype("datetime64[D]")
+    ndays = ((month_start + 1).astype("datetime64[D]") - first).astype(np.int64)
+    # explicit fallback for days outside the gregorian month
+    day = np.where((day < 1) | (day > ndays), 28, day)
+    dates = first + (day - 1).astype("timedelta64[D]")
+    return pd.DatetimeIndex(dates.astype("datetime64[ns]"))
+
+
+def daily_index(start, periods: int) -> pd.DatetimeIndex:
+    """Daily DatetimeIndex of length `periods` beginning at `start`."""
+    return pd.date_range(start, periods=periods, freq="D")
+
+
+def water_year(dates) -> np.ndarray:
+    """Water year of each date, e.g. 2001-10-01 is in water year 2002."""
+    dates = pd.DatetimeIndex(dates)
+    return np.asarray(dates.year + (dates.month >= WY_START_MONTH), dtype=np.int32)
+
+
+def day_of_water_year(dates) -> np.ndarray:
+    """Zero-based day of the water year, Oct 1 is day 0."""
+    dates = pd.DatetimeIndex(dates)
+    wy = water_year(dates)
+    starts = ((wy - 1971) * 12 + WY_START_MONTH - 1).astype("datetime64[M]")
+    days = dates.values.astype("datetime64[D]") - starts.astype("datetime64[D]")
+    return days.astype(np.int32)
+
+
+def add_water_year_coords(data, dim: str = "day"):
+    """!
+    Attach `water_year` and `dowy` (day of water year) coordinates along `dim`.
+    @param data [xr.DataArray or xr.Dataset]: with a datetime `dim` coordinate.
+    @return the same object type with the new coordinates.
+    """
+    dates = pd.DatetimeIndex(data[dim].values)
+    return data.assign_coords(
+        water_year=(dim, water_year(dates)), dowy=(dim, day_of_water_year(dates))
+    )
+
+
+def window_mask(dates, date_start, date_end) -> np.ndarray:
+    """!
+    Boolean mask of the dates kept by `screen_times_wrf`.
+    The window is month-resolved: it starts at (year, month) of `date_start` and ends
+    before the month of `date_end`, i.e. [2013, 12, 31] drops December 2013.
+    @param date_start [list]: [year, month, day]
+    @param date_end [list]: [year, month, day]
+    @return np.ndarray of bool
+    """
+    dates = pd.DatetimeIndex(dates)
+    year, month = dates.year, dates.month
+    drop = (month < date_start[1]) & (year <= date_start[0])
+    drop |= year < date_start[0]
+    drop |= (month >= date_end[1]) & (year >= date_end[0])
+    drop |= year > date_end[0]
+    return ~np.asarray(drop)
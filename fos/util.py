@@ -4,12 +4,13 @@ This module contains common utility functions used throughout the package.
 """
 
 import datetime
-import glob
+import functools
 import os
 import seaborn as sns
 from matplotlib import pyplot as plt
 
 import dask
+import dask.array as dsa
 import geopandas as gpd
 import netCDF4 as nc
 import numpy as np
@@ -17,11 +18,30 @@ import pandas as pd
 import xarray as xr
 from rich.console import Console
 
+from fos import instrument
+from fos.catalog import get_catalog
+from fos.compact import compact as compact_array
+from fos.convert import read_store
+from fos.elevation import ElevationBands
+from fos.sitestore import SiteDayStore
+from fos.snowmetrics import water_year_metrics
+from fos.spatial import (
+    GridLocator,
+    basin_cells,
+    crop,
+    extract_sites,
+    subset_window,
+    window_cells,
+    window_coords,
+)
+from fos.timeaxis import add_water_year_coords, daily_index, decode_day, window_mask
+from fos.zonal import grid_cell_area
+
 ##! Shared logging console object # noqa: E265
 console = Console()
 
 # CONSTANTS
-MM_TO_IN = 0.03937008
+from fos.constants import MM_TO_IN  # noqa: E402
 
 # Keep global variables available to all modules
 ## define directories
@@ -33,10 +53,11 @@ wrfdir = '/glade/campaign/uwyo/wyom0112/postprocess/'
 coorddir = wrfdir + 'WRF-data/wrf_coordinates/' 
 domain = "d02"
 
-from joblib import Memory
-# caching directory - get from environment variable
-location = os.environ.get("FOS_CACHE_DIR", "~/.fos_cachedir")
-memory = Memory(location, verbose=1)
+from fos.cache import Cache
+from fos.dirs import cachedir
+# caching decorator, see fos.cache - location from FOS_CACHE_DIR, budget from FOS_CACHE_MAX_BYTES
+location = os.path.join(cachedir, "memory")
+memory = Cache(location, verbose=1)
 
 
 def setup(
@@ -60,94 +81,186 @@ def setup(
 
 
 
-def _wrfread_gcm(model, gcm, variant, datadir, var, domain):
-    datadir = os.path.join(datadir, domain)
-    all_files = sorted(os.listdir(datadir))
-    read_files = []
-
-    for ii in all_files:
-        if (
-            ii.startswith(var + ".")
-            and model in ii
-            # and gcm in ii
-            and variant in ii
-            and domain in ii
-        ):
-            if domain in ii:
-                read_files.append(os.path.join(datadir, str(ii)))
-    assert len(read_files) > 0, f"No matching files found in {datadir}"
+def _crop_file(ds, var, window):
+    """open_mfdataset preprocess: index the window on the last two dims of `var`."""
+    rows, cols = window
+    ydim, xdim = ds[var].dims[-2:]
+    return ds.isel({ydim: rows, xdim: cols})
 
-    del all_files
-    # nf = len(read_files)
 
-    data = xr.open_mfdataset(read_files, combine="by_coords")
+def get_subset_window(subset, coorddir, domain="d02", pad=0):
+    """!
+    Index window of `subset` on the WRF grid in `{coorddir}/wrfinput_{domain}`,
+    see spatial.subset_window.
+    @return (rows, cols, lat2d, lon2d): the window and the full-domain cell centers.
+    """
+    locator = get_grid_locator(coorddir, domain)
+    rows, cols = subset_window(locator.lat2d, locator.lon2d, subset, pad=pad)
+    return rows, cols, locator.lat2d, locator.lon2d
+
+
+def _run_window(datadir, subset, coorddir, domain):
+    """The wrfdir of a run's datadir ({wrfdir}/{gcm}/postprocess) and the subset window."""
+    wrfdir = os.path.dirname(os.path.dirname(os.path.normpath(datadir)))
+    if subset is None:
+        return wrfdir, None, None, None
+    if coorddir is None:
+        coorddir = os.path.join(wrfdir, "WRF-data", "wrf_coordinates")
+    rows, cols, lat2d, lon2d = get_subset_window(subset, coorddir, domain)
+    return wrfdir, (rows, cols), lat2d, lon2d
+
+
+@instrument.timed
+def _wrfread_gcm(
+    model, gcm, variant, datadir, var, domain, years=None, use_store=True, subset=None,
+    coorddir=None, compact=None,
+):
+    """!
+    Read a daily WRF variable of one run as (day, lat2d, lon2d).
+    @param subset: optional region name, (lat_min, lat_max, lon_min, lon_max) box, HUC
+        polygon(s) or site points, see spatial.subset_window. Only the matching index
+        window is read: it is applied to every file at open time (or to the store),
+        and the result gets j/k and 2-D lat/lon coordinates of the window.
+    @param coorddir [str]: directory of wrfinput_{domain}, default
+        {wrfdir}/WRF-data/wrf_coordinates.
+    @param compact [str]: None (native dtype), "float32" or "int16" (packed with a
+        scale/offset), see fos.compact. Units are kept in attrs for `compact.to_units`.
+    """
+    wrfdir, window, lat2d, lon2d = _run_window(datadir, subset, coorddir, domain)
+
+    # prefer a store written by `fos convert`, it is chunked for time series reads
+    if use_store:
+        var_read = read_store(
+            gcm, var, domain, years=years, packed=compact == "int16", wrfdir=wrfdir
+        )
+        if var_read is not None:
+            instrument.count("stores_opened")
+            if subset is not None:
+                var_read = crop(var_read, window, lat2d, lon2d)
+            return add_water_year_coords(compact_array(var_read, compact))
+
+    # the file list comes from the catalog (files within a run directory share one
+    # experiment, so `model` needs no filtering)
+    read_files = get_catalog(wrfdir).files(gcm, var, domain, years=years)
+    assert len(read_files) > 0, f"No matching files found in {os.path.join(datadir, domain)}"
+    if instrument.enabled():
+        instrument.count("files_opened", len(read_files))
+        instrument.count("file_bytes", sum(os.path.getsize(f) for f in read_files))
+
+    # crop each file before dask chunks it, so only the window is read and decompressed
+    preprocess = None if subset is None else functools.partial(_crop_file, var=var, window=window)
+    data = xr.open_mfdataset(read_files, combine="by_coords", preprocess=preprocess)
     var_read = data.variables[var]
-    # day = data.variables["day"].values
-    # nt = len(day)
-
-    # day1 = pd.to_datetime(str(int(day[0])), format='%Y-%m-%d')
-    # day2 = pd.to_datetime(str(int(day[nt-1])), format='%Y-%m-%d')
-    # dates = pd.date_range(day1,day2,freq="D")
-
-    dates = []
-    for val in data["day"].data:
-        try:
-            dates.append(datetime.datetime.strptime(str(val)[0:-2], "%Y%m%d").date())
-        except ValueError:
-            dates.append(datetime.datetime(int(str(val)[0:4]), int(str(val)[4:6]), 28))
 
     # Mask array setting leap years = True
     # is_leap_day = (dates.month == 2) & (dates.day == 29)
     # dates = dates[~is_leap_day]
 
     var_read = xr.DataArray(var_read, dims=["day", "lat2d", "lon2d"])
-    var_read["day"] = dates  # year doesn't matter here
+    var_read["day"] = decode_day(data["day"].values)  # year doesn't matter here
+    if subset is not None:
+        var_read = var_read.assign_coords(window_coords(window, lat2d, lon2d))
+
+    return add_water_year_coords(compact_array(var_read, compact))
+
+def _open_year_file(path, var, window=None):
+    """One per-year file of `var` as a lazy (day, lat2d, lon2d) array (with its attrs, e.g.
+    units) on its day codes."""
+    ds = xr.open_dataset(path, chunks={})
+    if window is not None:
+        ds = _crop_file(ds, var, window)
+    return xr.DataArray(
+        ds[var].variable, dims=["day", "lat2d", "lon2d"], coords={"day": ds["day"].values}
+    )
 
-    return var_read
 
+@instrument.timed
+def read_wrf_vars(
+    model, gcm, variant, datadir, variables, domain, years=None, use_store=True,
+    subset=None, coorddir=None, compact=None,
+) -> xr.Dataset:
+    """!
+    Read several daily WRF variables of one run (e.g. snow, prec and t2) as one
+    Dataset aligned on day. Unlike calling `_wrfread_gcm` per variable, the catalog
+    and subset window are looked up once, the per-year files of all variables are
+    opened in one pass and the day codes are decoded once, so
+    `screen_times_wrf` and `spatial.extract_sites`/`extract_basin` on the result
+    also run once for all variables. Other arguments are those of `_wrfread_gcm`.
+    @param variables [list]: variable names, e.g. ["snow", "prec", "t2"].
+    @return xr.Dataset of (day, lat2d, lon2d) variables over the days every variable
+        has, with water-year coordinates (and the window coordinates with a subset).
+    """
+    wrfdir, window, lat2d, lon2d = _run_window(datadir, subset, coorddir, domain)
+
+    stored, files = {}, {}
+    for var in variables:
+        data = None
+        if use_store:
+            data = read_store(
+                gcm, var, domain, years=years, packed=compact == "int16", wrfdir=wrfdir
+            )
+        if data is not None:
+            instrument.count("stores_opened")
+            stored[var] = data if subset is None else crop(data, window, lat2d, lon2d)
+            continue
+        files[var] = get_catalog(wrfdir).files(gcm, var, domain, years=years)
+        assert len(files[var]) > 0, f"No {var} files found in {os.path.join(datadir, domain)}"
+    if instrument.enabled():
+        paths = [path for paths in files.values() for path in paths]
+        instrument.count("files_opened", len(paths))
+        instrument.count("file_bytes", sum(os.path.getsize(f) for f in paths))
+
+    # serial: netCDF4/HDF5 opens are not thread-safe (concurrent opens fail with "NetCDF:
+    # HDF error", even of different files), and the open is nearly all of the work
+    opened = {
+        var: [_open_year_file(path, var, window) for path in paths]
+        for var, paths in files.items()
+    }
+
+    data = xr.Dataset()
+    if opened:
+        # align on the raw day codes and decode them once for all variables
+        fields = xr.align(*[xr.concat(opened[var], dim="day") for var in opened], join="inner")
+        data = xr.Dataset(dict(zip(opened, fields)))
+        data["day"] = decode_day(data["day"].values)
+        if subset is not None:
+            data = data.assign_coords(window_coords(window, lat2d, lon2d))
+    if stored:
+        data = xr.merge([data, *[v.rename(k) for k, v in stored.items()]], join="inner")
+    return add_water_year_coords(compact_array(data[list(variables)], compact))
+
+
+@instrument.timed
 def screen_times_wrf(data, date_start, date_end):
     # Dimensions should be "day"
     dask.config.set(**{"array.slicing.split_large_chunks": True})
 
-    datedata = pd.to_datetime(data.day)
-    data = data.sel(day=~((datedata.month < date_start[1]) & (datedata.year <= date_start[0])))
-
-    datedata = pd.to_datetime(data.day)
-    data = data.sel(day=~(datedata.year < date_start[0]))
+    # one mask over the whole axis and a single isel, see timeaxis.window_mask
+    keep = window_mask(pd.to_datetime(data["day"].values), date_start, date_end)
+    return data.isel(day=np.flatnonzero(keep))
 
-    datedata = pd.to_datetime(data.day)
-    data = data.sel(day=~((datedata.month >= date_end[1]) & (datedata.year >= date_end[0])))
 
-    datedata = pd.to_datetime(data.day)
-    data = data.sel(day=~(datedata.year > date_end[0]))
-
-    return data
-
-
-def get_peak_date_amt(data):
-    """Get peak date and amount for each water year (Oct 1 to Oct 1)."""
+def get_peak_date_amt(data, factor: float = 1.0):
+    """!
+    Get peak date and amount for each water year (Oct 1 to Oct 1).
+    @param factor [float]: unit conversion applied to the peak amounts only, e.g.
+        MM_TO_IN for series in mm, so the daily series need no converted copy.
+    """
     startyear = np.nanmin(data.index.year)
     endyear = np.nanmax(data.index.year)
-    maxvals = []
-    maxargs = []
-    maxdates = []
-    wys = []
-    for wy in range(startyear + 1, endyear):
-        startdate = datetime.date(year=wy - 1, month=10, day=1)
-        enddate = datetime.date(year=wy, month=10, day=1)
-        timemask = (data.index.date >= startdate) & (data.index.date < enddate)
-        wydata = data.SWE[timemask]
-        if len(wydata) == 0:
-            continue
-        maxval = np.nanmax(wydata)
-        maxarg = np.nanargmax(wydata)
-        maxdate = wydata.index[maxarg].date()
-        maxvals.append(maxval)
-        maxargs.append(maxarg)
-        maxdates.append(maxdate)
-        wys.append(wy)
+    swe = xr.DataArray(data.SWE.values, dims=["day"], coords={"day": data.index.values})
+    metrics = water_year_metrics(swe)
+    # water years startyear + 1 .. endyear - 1 that have data, as before
+    wys = metrics.water_year.values
+    keep = (wys > startyear) & (wys < endyear) & np.isfinite(metrics.peak.values)
+    metrics = metrics.isel(water_year=np.flatnonzero(keep))
     metrics = pd.DataFrame(
-        data={"maxval": maxvals, "maxdate": maxdates, "maxarg": maxargs}, index=wys
+        data={
+            "maxval": metrics.peak.values * factor,
+            "maxdate": pd.DatetimeIndex(metrics.peak_date.values).date,
+            "maxarg": metrics.peak_index.values.astype(int),
+        },
+        index=metrics.water_year.values,
     )
     return metrics
 
@@ -161,7 +274,8 @@ def _read_wrf_meta_data(dir_meta: str, domain: str):
     return (lat, lon, z, infile)
 
 
-# maybe a bug in this, or in the maxarg stuff above??
+# assumes a non-leap year, use the dowy coordinate (timeaxis.add_water_year_coords)
+# or snowmetrics.water_year_metrics(...).peak_dowy for exact days of water year
 def shift_to_dowy(doy):
     base = datetime.datetime(year=2002, month=1, day=1)
     targ = base + datetime.timedelta(days=doy)
@@ -207,20 +321,71 @@ def get_coords(coorddir):
     )
     return snotel_gdf, coords, huc6, huc8
 
-def get_wrf_from_shp(basin, lat_wrf, lon_wrf, data_wrf):
-    bounds = basin.bounds.values.flatten()
-    latmask = ((lat_wrf.data >bounds[1]) & (lat_wrf.data < bounds[3]))
-    lonmask = ((lon_wrf.data >bounds[0]) & (lon_wrf.data < bounds[2]))
-    basinmask = (latmask & lonmask)
-    pts = list(map(Point,  zip(lon_wrf[basinmask], lat_wrf[basinmask])))
-    polygon = basin[0:1].geometry.values[0]
-    inmask = list(map(polygon.contains,  pts))
-    inmask = np.array(inmask)
-    tmpdata = data_wrf[:,:,:].data.compute() ## this takes a minute... can we make it faster?
-    tmpdata[:,~basinmask] = np.nan
-    tmpdata2 = tmpdata[:,basinmask] 
-    tmpdata2[:,~inmask] = np.nan
-    return lon_wrf[basinmask], lat_wrf[basinmask], tmpdata2
+@functools.lru_cache(maxsize=None)
+def get_grid_locator(coorddir, domain="d02", great_circle=False):
+    """!
+    Cached KD-tree locator over the WRF grid in `{coorddir}/wrfinput_{domain}`.
+    The HGT field is included so sites can be matched elevation-aware, e.g.
+    `j, k, dist = get_grid_locator(coorddir).query(lat, lon, elev=elev)`
+    """
+    lat, lon, z, _ = _read_wrf_meta_data(coorddir, domain)
+    return GridLocator(lat[0].values, lon[0].values, z[0].values, great_circle=great_circle)
+
+def get_cell_area(coorddir, domain="d02") -> np.ndarray:
+    """!
+    Area in km^2 of every cell of the WRF grid, DX * DY / MAPFAC_M**2 from
+    `{coorddir}/wrfinput_{domain}`. Files without MAPFAC_M or DX/DY fall back to the
+    spherical approximation of zonal.grid_cell_area.
+    """
+    infile = os.path.join(coorddir, f"wrfinput_{domain}")
+    with xr.open_dataset(infile, engine="netcdf4") as data:
+        if "MAPFAC_M" in data and {"DX", "DY"} <= set(data.attrs):
+            mapfac = data["MAPFAC_M"][0].values.astype(np.float64)
+            return data.attrs["DX"] * data.attrs["DY"] / mapfac**2 / 1e6
+        return grid_cell_area(data["XLAT"][0].values, data["XLONG"][0].values)
+
+@functools.lru_cache(maxsize=None)
+def get_elevation_bands(coorddir, domain="d02", step=100.0, regions=None):
+    """!
+    Cached elevation bands x regions of the WRF grid from HGT in
+    `{coorddir}/wrfinput_{domain}`, e.g. `get_elevation_bands(coorddir).reduce(swe)`,
+    see elevation.ElevationBands. Cells are weighted by their area (`get_cell_area`),
+    which varies across the Lambert conformal grid.
+    @param regions [tuple]: names from spatial.REGIONS, default all of them.
+    """
+    lat, lon, z, _ = _read_wrf_meta_data(coorddir, domain)
+    return ElevationBands(
+        z[0].values,
+        lat[0].values,
+        lon[0].values,
+        step=step,
+        regions=regions,
+        area=get_cell_area(coorddir, domain),
+    )
+
+@instrument.timed
+def get_wrf_from_shp(basin, lat_wrf, lon_wrf, data_wrf, time_chunk=365):
+    """!
+    Cells in the basin's bounding box, as (lon, lat, data[time, cell]) with cells
+    outside the basin polygon set to NaN. The data is cropped to the bounding-box
+    window before it is computed and streamed in `time_chunk` days, see
+    `spatial.extract_basin` for the compact cell x time version. A Dataset (e.g. from
+    `read_wrf_vars`) is read in one pass and gives {var: data[time, cell]}.
+    """
+    lat_wrf, lon_wrf = np.asarray(lat_wrf), np.asarray(lon_wrf)
+    window, bboxmask, inmask = basin_cells(basin, lat_wrf, lon_wrf)
+    dataset = isinstance(data_wrf, xr.Dataset)
+    if window is None:
+        empty, none = np.array([]), np.empty((data_wrf.sizes["day"], 0))
+        return empty, empty, {name: none for name in data_wrf.data_vars} if dataset else none
+    values = window_cells(data_wrf, window, bboxmask, time_chunk, "day")
+    fields = values if dataset else {None: values}
+    for name, cells in fields.items():
+        fields[name] = cells.T
+        fields[name][:, ~inmask] = np.nan
+        instrument.count("cells_read", cells.size)
+    tmpdata = fields if dataset else fields[None]
+    return lon_wrf[window][bboxmask], lat_wrf[window][bboxmask], tmpdata
 
 def setup_plot_style():
     """
@@ -249,17 +414,32 @@ def get_wrf_avail(wrfdir):
     domain [str]: domain to read in, defaults to 'd02'
     """
     # log the bc models available
-    bc_glob = glob.glob(os.path.join(wrfdir, "*_bc"))
-    bcmodels = [val.split("/")[-1] for val in bc_glob]
+    bcmodels = get_catalog(wrfdir).runs(bc=True).run.tolist()
     assert len(bcmodels) > 0, f"No BC models found in {wrfdir}"
     console.log("Available BC Models:", bcmodels)
     console.log("run get_wrf_data(wrfdir,model) with the name of the model you want to load")
-    return
+    return bcmodels
 
-def get_wrf_data(wrfdir, model, variant):
+def get_wrf_data(wrfdir, model, variant, subset=None, variables=None, compact=None):
     """
     TODO - fix model variable assignment using a dictionary
+    subset: optional region/box/polygon/sites read instead of the full domain, see
+        _wrfread_gcm, e.g. get_wrf_data(wrfdir, model, variant, subset="SW")
+    variables: optional list of variables, e.g. ["snow", "prec", "t2"], read in one
+        pass as Datasets (see read_wrf_vars) instead of the snow DataArrays
+    compact: optional "float32" or "int16" in-memory representation, see fos.compact
     """
+
+    def read(model, gcm, modeldir, years):
+        if variables is not None:
+            return read_wrf_vars(
+                model, gcm, variant, modeldir, variables, domain, years=years, subset=subset,
+                compact=compact,
+            )
+        return _wrfread_gcm(
+            model, gcm, variant, modeldir, var, domain, years=years, subset=subset, compact=compact
+        )
+
     # change the model
     var = "snow"
     mod_historical = model +'_'+ variant + '_historical_bc'
@@ -269,7 +449,9 @@ def get_wrf_data(wrfdir, model, variant):
     model = "hist"
     modeldir = os.path.join(wrfdir, gcm , 'postprocess')
     print(modeldir)
-    var_wrf = _wrfread_gcm(model, gcm, variant, modeldir, var, domain)
+    # only open the year files the window needs (+1 in case a file holds a water year)
+    years = (date_start_pd[0], date_end_pd[0] + 1)
+    var_wrf = read(model, gcm, modeldir, years)
     var_wrf = screen_times_wrf(var_wrf, date_start_pd, date_end_pd)
 
     # future dates
@@ -277,48 +459,60 @@ def get_wrf_data(wrfdir, model, variant):
     gcm = mod_future
     modeldir = os.path.join(wrfdir, gcm ,'postprocess')
     model = "ssp370"
-    var_wrf_ssp370 = _wrfread_gcm(model, gcm, variant, modeldir, var, domain)
+    years = (date_start_pd[0], date_end_pd[0] + 1)
+    var_wrf_ssp370 = read(model, gcm, modeldir, years)
     var_wrf_ssp370 = screen_times_wrf(var_wrf_ssp370, date_start_pd, date_end_pd)
 
     return dict(var_wrf=var_wrf, var_wrf_ssp370=var_wrf_ssp370)
 
 
-def create_wrf_df(snotel_gdf: gpd.GeoDataFrame):
-    """! Create a dataframe of WRF data for each snotel site."""
+@instrument.timed
+def create_wrf_df(snotel_gdf: gpd.GeoDataFrame, wrfstore: str = None):
+    """!
+    Create a dataframe of WRF data for each snotel site.
+    See `sitemetrics.build_site_metrics` for the parallel version writing a flat table.
+    @param wrfstore [str]: optional store from `sitestore.build_wrfts_store`, read instead
+        of the per-site wrfpoint_/wrfbasin_ .npy files.
+    """
     snotel_no_ak = snotel_gdf[snotel_gdf.state != "AK"]
 
     day1 = datetime.datetime(year=1980, day=1, month=9)
-    days = []
-    for i in range(42960):  # hardcoded number of days TODO fix this hardcoding
-        days.append(day1 + datetime.timedelta(days=i))
 
     # hold the data for a dataframe
     snoteldir = os.path.join(projectdir, "snoteldata")
     entries = []
     datadir = os.path.join(projectdir, "wrfts", "ukesm1-0-ll_bc")
+    store = None if wrfstore is None else SiteDayStore(wrfstore)
     for i, entry in snotel_no_ak.iterrows():
         try:
             num = entry.site_number
             name = entry.site_name.replace(" ", "").replace("(", "").replace(")", "")
             pt = [entry.geometry.x, entry.geometry.y]
-            wrfpoint = np.load(os.path.join(datadir, f"wrfpoint_{name}.npy"))
-            wrfbasin = np.load(os.path.join(datadir, f"wrfbasin_{name}.npy"))
-            wrfpoint = pd.DataFrame(
-                wrfpoint * MM_TO_IN, columns=["SWE"], index=pd.to_datetime(days)
-            )
-            wrfbasin = pd.DataFrame(
-                wrfbasin * MM_TO_IN, columns=["SWE"], index=pd.to_datetime(days)
-            )
+            # the WRF series stay in mm (no converted copies), only the peaks are
+            # converted to inches
+            if store is not None:
+                if num not in store:
+                    continue
+                wrfpoint = store.series("wrfpoint", num, units="mm").rename("SWE").to_frame()
+                wrfbasin = store.series("wrfbasin", num, units="mm").rename("SWE").to_frame()
+            else:
+                wrfpoint = np.load(os.path.join(datadir, f"wrfpoint_{name}.npy"))
+                wrfbasin = np.load(os.path.join(datadir, f"wrfbasin_{name}.npy"))
+                days = daily_index(day1, len(wrfpoint))
+                wrfpoint = pd.DataFrame(wrfpoint, columns=["SWE"], index=days)
+                wrfbasin = pd.DataFrame(wrfbasin, columns=["SWE"], index=days)
             snotelpoint = pd.read_csv(
                 os.path.join(snoteldir, f"snotel{num}.csv"),
                 index_col=0,
                 parse_dates=True,
             )
-            wpt = get_peak_date_amt(wrfpoint)
-            wbas = get_peak_date_amt(wrfbasin)
+            wpt = get_peak_date_amt(wrfpoint, factor=MM_TO_IN)
+            wbas = get_peak_date_amt(wrfbasin, factor=MM_TO_IN)
             sm = get_peak_date_amt(snotelpoint)
             entries.append(dict(name=name, wpt=wpt, wbas=wbas, sm=sm, pt=pt))
+            instrument.count("sites_read")
         except FileNotFoundError:
+            instrument.count("sites_missing")
             continue
     res = gpd.GeoDataFrame(entries)
     return res
@@ -346,6 +540,9 @@ def partition_dataframe(df, periods):
 
 
 def get_wrf_data_points(wrfdata, j,k):
+    if np.ndim(j) > 0:
+        # many sites at once: one vectorized pass per time chunk, returns site x time
+        return extract_sites(list(wrfdata), j, k).values
     alldata = []
     for exp in wrfdata:
         alldata.append(exp[:,j,k])
@@ -355,38 +552,80 @@ def get_wrf_data_points(wrfdata, j,k):
 def make_time_lists(time_periods):
     dates_lists = {}
     for period, dates in time_periods.items():
-        start_date = datetime.datetime.strptime(dates[0], '%Y-%m-%d')
-        end_date = datetime.datetime.strptime(dates[1], '%Y-%m-%d')
-        delta = datetime.timedelta(days=1)
-        dates = []
-
-        while start_date <= end_date:
-            dates.append(start_date)
-            start_date += delta
-        dates_lists[period] = dates
+        dates_lists[period] = pd.date_range(dates[0], dates[1], freq="D")
 
     return dates_lists
 
 import numpy as np 
-## from neuralhydrology
-def create_xarray_data_vars(vars, y_hat: np.ndarray, y: np.ndarray, dates_lists: list):
-    outs = []
-    dstart = 0
-    dend = 0
-    for j, window in enumerate(dates_lists.keys()):
-        data = {}
-        dend += len(dates_lists[window])
-        for i, var in enumerate(vars):
-            data[f"{window}_{var}_obs"] = (('date'), y[dstart:dend, i])
-            data[f"{window}_{var}_sim"] = (('date'), y_hat[dstart:dend, i])
-            
-        coords = {
-        'date': dates_lists[window]}
-        
-        ds_out = xr.Dataset(data_vars=data, coords=coords)
-        outs.append(ds_out)
-        dstart += len(dates_lists[window])
-    return outs
+## model results: one Dataset over (kind, variable, window, site, step)
+MODEL_KINDS = ["obs", "sim"]
+
+
+def create_model_output(vars, dates_lists: dict, sites=None) -> xr.Dataset:
+    """!
+    Preallocated (NaN) model results, replacing the old per-window Dataset list.
+    `value` has dims (kind, variable, window, site, step) with kind obs/sim; windows of
+    different lengths share the step axis, padded with NaN, and the 2-D `date`
+    coordinate (window, step) is NaT on the padding. Models write their results into
+    views from `model_output_view`, so nothing is concatenated or copied.
+    @param vars [list]: model output variables, e.g. ['SWE'].
+    @param dates_lists [dict]: {window: dates}, see make_time_lists.
+    @param sites [array-like]: site labels, default a single site 0.
+    """
+    windows = list(dates_lists.keys())
+    sites = np.atleast_1d([0] if sites is None else sites)
+    nstep = max(len(d) for d in dates_lists.values())
+    dates = np.full((len(windows), nstep), np.datetime64("NaT"), dtype="datetime64[ns]")
+    for i, window in enumerate(windows):
+        dates[i, : len(dates_lists[window])] = dates_lists[window].values
+    values = np.full((len(MODEL_KINDS), len(vars), len(windows), len(sites), nstep), np.nan)
+    return xr.Dataset(
+        {"value": (("kind", "variable", "window", "site", "step"), values)},
+        coords={
+            "kind": MODEL_KINDS,
+            "variable": list(vars),
+            "window": windows,
+            "site": sites,
+            "date": (("window", "step"), dates),
+            "ndays": ("window", [len(dates_lists[w]) for w in windows]),
+        },
+    )
+
+
+def model_output_view(out: xr.Dataset, kind: str, var: str, window: str) -> np.ndarray:
+    """Writable (site, day) view of one kind/variable/window of `create_model_output`."""
+    k = MODEL_KINDS.index(kind)
+    v = list(out.indexes["variable"]).index(var)
+    w = list(out.indexes["window"]).index(window)
+    return out["value"].data[k, v, w, :, : int(out["ndays"].values[w])]
+
+
+def model_output_window(out: xr.Dataset, window: str) -> xr.DataArray:
+    """The `value` of one window over (kind, variable, site, date), padding dropped."""
+    sel = out["value"].sel(window=window)
+    sel = sel.isel(step=slice(0, int(out["ndays"].sel(window=window))))
+    return sel.swap_dims(step="date").drop_vars("step", errors="ignore")
+
+
+def init_model_output_store(path: str, vars, dates_lists: dict, sites, site_chunk: int = 100):
+    """!
+    Create an empty zarr store laid out like `create_model_output` for large sweeps,
+    chunked by `site_chunk` sites. Fill it block by block with `write_model_output`.
+    """
+    template = create_model_output(vars, dates_lists, sites)
+    template["value"] = template["value"].copy(
+        data=dsa.full(template["value"].shape, np.nan, chunks=-1)
+    ).chunk({"site": site_chunk, "kind": 1, "variable": 1, "window": 1})
+    template.to_zarr(path, mode="w", compute=False)
+
+
+def write_model_output(out: xr.Dataset, path: str, site_start: int):
+    """Write the results of a block of sites (from `create_model_output`) into a store."""
+    region = {"site": slice(site_start, site_start + out.sizes["site"])}
+    out[["value"]].drop_vars(["kind", "variable", "window", "date", "ndays"]).to_zarr(
+        path, region=region
+    )
+
 
 ## wrf stuff
 """!
@@ -395,7 +634,6 @@ This module contains common utility functions used throughout the package.
 """
 
 import datetime
-import glob
 import os
 
 import dask
@@ -418,55 +656,19 @@ coorddir = wrfdir + 'WRF-data/wrf_coordinates/'
 domain = "d02"
 
 
-def wrfread(datadir, exp, variant, domain, var):
-    modeldir = datadir + f'_{variant}_{exp}_bc'
-    all_files = sorted(os.listdir(modeldir))
-    read_files = []
-    for ii in all_files:
-        if (
-            ii.startswith(var + ".")
-            and model in ii
-            and variant in ii
-            and domain in ii
-        ):
-            if domain in ii:
-                read_files.append(os.path.join(datadir, str(ii)))
-    assert len(read_files) > 0, f"No matching files found in {datadir}"
-
-    del all_files
+def wrfread(datadir, exp, variant, domain, var, years=None):
+    # datadir is {wrfdir}/{model}, the file list comes from the catalog
+    wrfdir, model = os.path.split(os.path.normpath(datadir))
+    gcm = f'{model}_{variant}_{exp}_bc'
+    read_files = get_catalog(wrfdir).files(gcm, var, domain, years=years)
+    assert len(read_files) > 0, f"No matching files found for {gcm} in {wrfdir}"
 
     data = xr.open_mfdataset(read_files, combine="by_coords")
     var_read = data.variables[var]
 
-    dates = []
-    for val in data["day"].data:
-        try:
-            dates.append(datetime.datetime.strptime(str(val)[0:-2], "%Y%m%d").date())
-        except ValueError:
-            dates.append(datetime.datetime(int(str(val)[0:4]), int(str(val)[4:6]), 28))
-
-
     var_read = xr.DataArray(var_read, dims=["day", "lat2d", "lon2d"])
-    var_read["day"] = dates
-    return var_read
-
-def screen_times_wrf(data, date_start, date_end):
-    # Dimensions should be "day"
-    dask.config.set(**{"array.slicing.split_large_chunks": True})
-
-    datedata = pd.to_datetime(data.day)
-    data = data.sel(day=~((datedata.month < date_start[1]) & (datedata.year <= date_start[0])))
-
-    datedata = pd.to_datetime(data.day)
-    data = data.sel(day=~(datedata.year < date_start[0]))
-
-    datedata = pd.to_datetime(data.day)
-    data = data.sel(day=~((datedata.month >= date_end[1]) & (datedata.year >= date_end[0])))
-
-    datedata = pd.to_datetime(data.day)
-    data = data.sel(day=~(datedata.year > date_end[0]))
-
-    return data
+    var_read["day"] = decode_day(data["day"].values)
+    return add_water_year_coords(var_read)
 
 def _read_wrf_meta_data(dir_meta: str, domain: str):
     """Read wrf meta data from nc4 files, and return lat, lon, height, and the filename"""
@@ -496,21 +698,3 @@ def get_coords(coorddir):
     coords = nc.Dataset(os.path.join(coorddir, "wrfinput_d02_coord.nc"))
 
     return coords 
-
-
-
-def get_wrf_avail(wrfdir):
-    """!
-    Read in the wrf data - WIP.
-
-    basedir [str]: base directory for wrf data, defauls to perlmutter system,
-        use '/global/project/projectdirs/' for cori system
-    domain [str]: domain to read in, defaults to 'd02'
-    """
-    # log the bc models available
-    bc_glob = glob.glob(os.path.join(wrfdir, "*_bc"))
-    bcmodels = [val.split("/")[-1] for val in bc_glob]
-    assert len(bcmodels) > 0, f"No BC models found in {wrfdir}"
-    console.log("Available BC Models:", bcmodels)
-    console.log("run get_wrf_data(wrfdir,model) with the name of the model you want to load")
-    return
@@ -0,0 +1,255 @@
+"""!
+Basin-mean time series of gridded WRF fields for every HUC6/HUC8 basin at once.
+
+Each basin becomes a row of a sparse basin x cell matrix whose entries are the area of
+the basin overlapping each grid cell (fractional cell-area overlap, not cell-center
+membership as in `spatial.extract_basin`). A field is then reduced one time chunk at a
+time with one sparse product, the same pattern as `elevation.ElevationBands`, so all
+basins come out of a single streaming pass over the data.
+
+The weights only depend on the grid and the basin polygons, and are cached under
+FOS_CACHE_DIR/zonal keyed on both.
+```
+lat, lon, _, _ = util._read_wrf_meta_data(coorddir, "d02")
+weights = huc_weights("huc8", lat[0], lon[0])
+means = weights.reduce(swe)  # (basin, day), basin = names as in data.in8s
+```
+"""
+
+import hashlib
+import io
+import os
+
+import dask.array as dsa
+import numpy as np
+import shapely
+import xarray as xr
+from scipy import sparse
+
+from fos import dirs
+from fos.compact import unpack
+from fos.spatial import EARTH_RADIUS_KM
+
+## bump when the cached weights layout changes
+ZONAL_VERSION = 1
+
+
+def cell_corners(center) -> np.ndarray:
+    """!
+    Corners of the cells of a curvilinear grid from its (ny, nx) cell centers: the mean
+    of the 4 surrounding centers, linearly extrapolated on the edges.
+    @return (ny + 1, nx + 1) array.
+    """
+    padded = np.pad(np.asarray(center, dtype=np.float64), 1, mode="reflect", reflect_type="odd")
+    return (padded[:-1, :-1] + padded[1:, :-1] + padded[:-1, 1:] + padded[1:, 1:]) / 4
+
+
+def cell_polygons(lat2d, lon2d) -> np.ndarray:
+    """Flat (ny * nx) array of the cell polygons of the grid, in lon/lat."""
+    lat, lon = cell_corners(lat2d), cell_corners(lon2d)
+    lo, hi = slice(None, -1), slice(1, None)
+    # counterclockwise from the (j, k) corner, closed
+    ring = [(lo, lo), (lo, hi), (hi, hi), (hi, lo), (lo, lo)]
+    coords = np.stack([np.stack([lon[r, c], lat[r, c]], axis=-1) for r, c in ring], axis=-2)
+    return shapely.polygons(coords.reshape(-1, len(ring), 2))
+
+
+def grid_cell_area(lat2d, lon2d) -> np.ndarray:
+    """!
+    Approximate area of every cell in km^2: the lon/lat area of its polygon (see
+    `cell_polygons`) times cos(lat), on a sphere of EARTH_RADIUS_KM. Use the exact
+    dx * dy / MAPFAC_M**2 of wrfinput when it is available.
+    """
+    lat2d = np.asarray(lat2d, dtype=np.float64)
+    degrees = shapely.area(cell_polygons(lat2d, lon2d)).reshape(lat2d.shape)
+    return degrees * np.cos(np.deg2rad(lat2d)) * np.deg2rad(EARTH_RADIUS_KM) ** 2
+
+
+def _basin_table(basins, key):
+    """(ids, geometries) of a GeoDataFrame (in lon/lat) or a {id: polygon} mapping."""
+    if hasattr(basins, "geometry"):
+        if basins.crs is not None and not basins.crs.equals("epsg:4326"):
+            basins = basins.to_crs("epsg:4326")
+        ids = basins[key].to_numpy() if key in basins else basins.index.to_numpy()
+        geoms = basins.geometry.to_numpy()
+    else:
+        ids, geoms = list(basins), list(basins.values())
+    return np.asarray(ids).astype(str), shapely.make_valid(np.asarray(geoms, dtype=object))
+
+
+class BasinWeights:
+    """!
+    Sparse basin x cell overlap weights of a WRF grid, see the module docstring.
+    Build them with `BasinWeights.build` or, cached on disk, `basin_weights`.
+    @param weights [scipy.sparse matrix]: (basin, cell) overlap areas, cells flattened
+        from the (lat2d, lon2d) grid in C order.
+    @param ids [array-like]: basin names, the `basin` coordinate of the results.
+    @param shape [tuple]: (lat2d, lon2d) shape of the grid.
+    @param coverage [array-like]: fraction of each basin's area covered by the grid.
+    """
+
+    def __init__(self, weights, ids, shape, coverage=None):
+        self.weights = sparse.csr_matrix(weights)
+        self.ids = np.asarray(ids)
+        self.shape = tuple(int(n) for n in shape)
+        self.coverage = np.ones(len(self.ids)) if coverage is None else np.asarray(coverage)
+
+    @classmethod
+    def build(cls, basins, lat2d, lon2d, key: str = "name", area=None) -> "BasinWeights":
+        """!
+        Overlap weights of `basins` on the grid.
+        @param basins: GeoDataFrame (e.g. data.huc8) or {id: shapely polygon} in lon/lat.
+        @param lat2d, lon2d [array-like]: cell center coordinates.
+        @param key [str]: column of the basin ids, the index if it is missing.
+        @param area [array-like]: optional (lat2d, lon2d) cell areas, e.g.
+            dx * dy / MAPFAC_M**2 (see util.get_cell_area). By default
+            `grid_cell_area`, in km^2.
+        """
+        return cls._from_table(*_basin_table(basins, key), lat2d, lon2d, area)
+
+    @classmethod
+    def _from_table(cls, ids, geoms, lat2d, lon2d, area) -> "BasinWeights":
+        lat2d, lon2d = np.asarray(lat2d, dtype=np.float64), np.asarray(lon2d, dtype=np.float64)
+        cells = cell_polygons(lat2d, lon2d)
+        # every (basin, cell) pair whose polygons intersect, then their overlap in deg^2
+        basin_idx, cell_idx = shapely.STRtree(cells).query(geoms, predicate="intersects")
+        overlap = shapely.area(shapely.intersection(geoms[basin_idx], cells[cell_idx]))
+        area = grid_cell_area(lat2d, lon2d) if area is None else np.asarray(area, np.float64)
+        # the overlapping fraction of every cell times its area
+        values = overlap / shapely.area(cells[cell_idx]) * area.ravel()[cell_idx]
+        weights = sparse.csr_matrix((values, (basin_idx, cell_idx)), shape=(len(ids), lat2d.size))
+        covered = np.bincount(basin_idx, weights=overlap, minlength=len(ids))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            coverage = covered / shapely.area(geoms)
+        return cls(weights, ids, lat2d.shape, coverage)
+
+    def save(self, path: str) -> str:
+        """Write the weights to a .npz file, atomically."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        buf = io.BytesIO()
+        np.savez(
+            buf,
+            version=ZONAL_VERSION,
+            data=self.weights.data,
+            indices=self.weights.indices,
+            indptr=self.weights.indptr,
+            nbasins=len(self.ids),
+            ids=self.ids.astype(str),
+            shape=np.asarray(self.shape),
+            coverage=self.coverage,
+        )
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as fh:
+            fh.write(buf.getvalue())
+        os.replace(tmp, path)
+        return path
+
+    @classmethod
+    def load(cls, path: str) -> "BasinWeights":
+        """Weights written by `save`, ValueError if the layout is outdated."""
+        with np.load(path, allow_pickle=False) as npz:
+            if int(npz["version"]) != ZONAL_VERSION:
+                raise ValueError(f"{path} has zonal layout {int(npz['version'])}")
+            shape = tuple(npz["shape"])
+            weights = sparse.csr_matrix(
+                (npz["data"], npz["indices"], npz["indptr"]),
+                shape=(int(npz["nbasins"]), int(np.prod(shape))),
+            )
+            return cls(weights, npz["ids"], shape, npz["coverage"])
+
+    def _kernel(self, block):
+        """(time, lat2d, lon2d) block -> (time, basin) means over the valid cells."""
+        flat = block.reshape(block.shape[0], -1).astype(np.float64)
+        valid = np.isfinite(flat)
+        # (basin, cell) x (cell, time), the sums and the valid area
+        sums = self.weights.dot(np.where(valid, flat, 0.0).T)
+        area = self.weights.dot(valid.T.astype(np.float64))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return (sums / np.where(area > 0, area, np.nan)).T
+
+    def reduce(self, data, dim: str = "day", time_chunk: int = 365):
+        """!
+        Area-weighted mean of `data` over every basin, per time step. Cells that are
+        NaN at a step are left out of that step's mean.
+        Dask input stays lazy; it is rechunked to `time_chunk` steps over the whole grid
+        and every chunk is one sparse product, so time chunks run in parallel.
+        @param data [xr.DataArray or xr.Dataset]: (dim, lat2d, lon2d) field(s) on the
+            grid of the weights, or (lat2d, lon2d) maps. int16-packed data is decoded
+            block by block, means are float64.
+        @return the same type with dims (basin[, dim]) and a coverage coordinate.
+        """
+        if isinstance(data, xr.Dataset):
+            return data.map(self.reduce, keep_attrs=True, dim=dim, time_chunk=time_chunk)
+        data = unpack(data)
+        grid = (data.sizes.get("lat2d"), data.sizes.get("lon2d"))
+        if grid != self.shape:
+            raise ValueError(f"{data.name} is on a {grid} grid, the weights on {self.shape}")
+        squeeze = dim not in data.dims
+        if squeeze:
+            data = data.expand_dims(dim)
+        data = data.transpose(dim, "lat2d", "lon2d")
+        arr = data.data
+        if isinstance(arr, dsa.Array):
+            arr = arr.rechunk({0: time_chunk, 1: -1, 2: -1})
+            out = arr.map_blocks(
+                self._kernel,
+                dtype=np.float64,
+                drop_axis=2,
+                chunks=(arr.chunks[0], (len(self.ids),)),
+            )
+        else:
+            out = self._kernel(np.asarray(arr))
+        coords = {
+            dim: data[dim].values if dim in data.coords else np.arange(data.sizes[dim]),
+            "basin": self.ids,
+            "coverage": ("basin", self.coverage),
+        }
+        out = xr.DataArray(
+            out, dims=(dim, "basin"), coords=coords, name=data.name, attrs=data.attrs
+        ).transpose("basin", dim)
+        return out.isel({dim: 0}, drop=True) if squeeze else out
+
+
+def _fingerprint(ids, geoms, lat2d, lon2d, area) -> str:
+    digest = hashlib.sha256(str(ZONAL_VERSION).encode())
+    for arr in (lat2d, lon2d, area):
+        if arr is not None:
+            digest.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+    digest.update("\0".join(ids).encode())
+    for wkb in shapely.to_wkb(geoms):
+        digest.update(wkb)
+    return digest.hexdigest()[:24]
+
+
+def basin_weights(
+    basins, lat2d, lon2d, key: str = "name", area=None, cachedir: str = None
+) -> BasinWeights:
+    """!
+    `BasinWeights.build`, cached on disk: the weights are built once per grid and set
+    of basin polygons and loaded from {cachedir}/zonal afterwards.
+    @param cachedir [str]: default FOS_CACHE_DIR.
+    """
+    lat2d, lon2d = np.asarray(lat2d, dtype=np.float64), np.asarray(lon2d, dtype=np.float64)
+    ids, geoms = _basin_table(basins, key)
+    fingerprint = _fingerprint(ids, geoms, lat2d, lon2d, area)
+    path = os.path.join(cachedir or dirs.cachedir, "zonal", f"weights_{fingerprint}.npz")
+    try:
+        return BasinWeights.load(path)
+    except (FileNotFoundError, ValueError, KeyError, OSError):
+        pass
+    weights = BasinWeights._from_table(ids, geoms, lat2d, lon2d, area)
+    weights.save(path)
+    return weights
+
+
+def huc_weights(level: str, lat2d, lon2d, area=None, cachedir: str = None) -> BasinWeights:
+    """!
+    Cached weights of every basin of `data.huc6` or `data.huc8`, identified by name so
+    `data.in6s` / `data.in8s` select a site's basin in the results.
+    @param level [str]: "huc6" or "huc8".
+    """
+    from fos import data
+
+    if level not in ("huc6", "huc8"):
+        raise ValueError(f"Unknown HUC level {level!r}, use huc6 or huc8")
+    return basin_weights(getattr(data, level), lat2d, lon2d, area=area, cachedir=cachedir)
@@ -0,0 +1,57 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from fos import synthetic
+from fos.benchmark import BENCHMARKS, compare, run_benchmarks
+from fos.catalog import WrfCatalog
+from fos.util import _wrfread_gcm
+
+
+def test_fake_tree_matches_the_readers(tmp_path):
+    tree = synthetic.make_fake_tree(tmp_path / "tree", scale="tiny")
+    assert len(tree["files"]) == 2 * tree["years"]
+
+    cat = WrfCatalog(tree["wrfdir"], path=str(tmp_path / "catalog.pkl"))
+    cat.refresh()
+    assert sorted(cat.table.experiment.unique()) == ["historical", "ssp370"]
+    assert sorted(cat.table.year) == tree["years_hist"] + tree["years_future"]
+
+    run = "cesm2_r11i1p1f1_historical_bc"
+    datadir = os.path.join(tree["wrfdir"], run, "postprocess")
+    data = _wrfread_gcm("hist", run, "r11i1p1f1", datadir, "snow", "d02", use_store=False)
+    first, last = tree["years_hist"][0], tree["years_hist"][-1]
+    days = pd.date_range(f"{first}-01-01", f"{last}-12-31")
+    assert data.shape == (len(days), *tree["shape"])
+    assert (pd.DatetimeIndex(data.day.values) == days).all()
+    # the same day gives the same values in every file and reader
+    day = pd.date_range(data.day.values[40], periods=1)
+    _, _, height = synthetic.make_grid(tree["shape"])
+    np.testing.assert_allclose(data.isel(day=40).values, synthetic.swe(day, height)[0])
+
+    meta = pd.read_csv(os.path.join(tree["snoteldir"], "snotelmeta.csv"))
+    assert len(meta) == tree["nsites"]
+    assert {"site_number", "site_name", "lat", "lon", "elev"} <= set(meta.columns)
+
+
+def test_run_benchmarks_appends_and_compares(tmp_path):
+    output = tmp_path / "bench.jsonl"
+    root = str(tmp_path / "tree")
+    table = run_benchmarks(root=root, scale="tiny", output=str(output))
+    assert table.benchmark.tolist() == BENCHMARKS
+    assert (table.seconds > 0).all() and (table.peak_traced > 0).all()
+
+    # the tree is reused, only the selected benchmark is recorded
+    mtime = os.path.getmtime(os.path.join(root, "synthetic.json"))
+    run_benchmarks(root=root, scale="tiny", benchmarks=["extract_points"], output=str(output))
+    assert os.path.getmtime(os.path.join(root, "synthetic.json")) == mtime
+
+    with open(output) as fh:
+        rows = [json.loads(line) for line in fh]
+    assert len(rows) == len(BENCHMARKS) + 1
+    assert rows[-1]["benchmark"] == "extract_points"
+    ratios = compare(str(output))
+    assert ratios.index.tolist() == ["extract_points"]
+    assert np.isfinite(ratios.seconds_ratio).all()
@@ -0,0 +1,70 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from fos.cache import Cache
+
+
+def test_cache_tracks_inputs_and_budget(tmp_path):
+    memory = Cache(str(tmp_path / "cache"), max_bytes=10**6)
+    datadir = tmp_path / "data"
+    datadir.mkdir()
+    (datadir / "a.csv").write_text("1")
+    calls = []
+
+    @memory.cache(inputs=["dpath"])
+    def total(dpath, scale=1):
+        calls.append(dpath)
+        return scale * sum(int(open(os.path.join(dpath, f)).read()) for f in os.listdir(dpath))
+
+    assert total(str(datadir)) == 1
+    assert total(str(datadir)) == 1
+    assert len(calls) == 1
+    # a new file under the input directory invalidates the entry
+    (datadir / "b.csv").write_text("2")
+    assert total(str(datadir)) == 3
+    assert len(calls) == 2
+    # per-call overrides
+    assert total.refresh(str(datadir)) == 3
+    assert total.call(str(datadir), scale=2) == 6
+    assert len(calls) == 4
+
+    stats = memory.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 3, 2)
+    assert stats["bytes_written"] > 0 and stats["bytes_read"] > 0
+
+    # least recently used entries go first
+    assert memory.prune(max_bytes=stats["size_bytes"] - 1) == 1
+    assert total(str(datadir)) == 3
+    assert len(calls) == 4
+    memory.clear()
+    assert memory.stats()["entries"] == 0
+
+
+def test_cache_inputs_are_opt_in(tmp_path):
+    memory = Cache(str(tmp_path / "cache"))
+    datadir = tmp_path / "data"
+    datadir.mkdir()
+    calls = []
+
+    @memory.cache
+    def listing(dpath):
+        calls.append(dpath)
+        return sorted(os.listdir(dpath))
+
+    assert listing(str(datadir)) == []
+    # a string that names a directory is only a value, its content is not in the key
+    (datadir / "a.csv").write_text("1")
+    assert listing(str(datadir)) == []
+    assert len(calls) == 1
+
+
+def _hit(location):
+    for _ in range(25):
+        Cache(location)._update_stats(hits=1)
+
+
+def test_cache_stats_from_concurrent_processes(tmp_path):
+    location = str(tmp_path / "cache")
+    with ProcessPoolExecutor(max_workers=4) as pool:
+        list(pool.map(_hit, [location] * 8))
+    assert Cache(location).stats()["hits"] == 200
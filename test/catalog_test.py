@@ -0,0 +1,37 @@
+import os
+
+from fos import catalog
+
+
+def _touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "w").close()
+
+
+def test_catalog_parses_and_refreshes(tmp_path):
+    wrfdir = str(tmp_path / "postprocess")
+    run = "mpi-esm1-2-lr_r7i1p1f1_historical_bc"
+    d02 = os.path.join(wrfdir, run, "postprocess", "d02")
+    for year in range(1980, 1985):
+        _touch(os.path.join(d02, f"snow.daily.mpi-esm1-2-lr_hist_r7i1p1f1_d02_{year}.nc"))
+    _touch(os.path.join(d02, "README.txt"))
+
+    cat = catalog.WrfCatalog(wrfdir, path=str(tmp_path / "cat.pkl")).refresh()
+    assert len(cat.table) == 5
+    row = cat.table.iloc[0]
+    assert (row.model, row.variant, row.experiment, row.bc) == (
+        "mpi-esm1-2-lr",
+        "r7i1p1f1",
+        "historical",
+        True,
+    )
+    assert len(cat.files(run, "snow", "d02", years=(1981, 1982))) == 2
+    assert cat.runs(bc=True).run.tolist() == [run]
+
+    # a new file shows up after a refresh, and the table persists to disk
+    _touch(os.path.join(d02, "prec.daily.mpi-esm1-2-lr_hist_r7i1p1f1_d02_1980.nc"))
+    os.utime(d02, ns=(0, os.stat(d02).st_mtime_ns + 1))
+    cat.refresh()
+    assert len(cat.query(variable="prec")) == 1
+    reloaded = catalog.WrfCatalog(wrfdir, path=str(tmp_path / "cat.pkl"))
+    assert len(reloaded.table) == 6
@@ -0,0 +1,107 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from shapely.geometry import box
+
+from fos import sitestore
+from fos.compact import FILL, compact, is_packed, to_units, unpack
+from fos.constants import MM_TO_IN
+from fos.convert import convert_dataarray, open_store
+from fos.snowmetrics import water_year_metrics, water_year_stats
+from fos.spatial import extract_basin, extract_sites
+
+
+def _swe(chunks=None):
+    rng = np.random.default_rng(0)
+    days = pd.date_range("2000-10-01", "2002-09-30")
+    values = (rng.random((len(days), 6, 7)) * 900).astype(np.float32)
+    values[5, 1, 1] = np.nan
+    data = xr.DataArray(
+        values,
+        dims=("day", "lat2d", "lon2d"),
+        coords={"day": days},
+        name="snow",
+        attrs={"units": "mm"},
+    )
+    return data if chunks is None else data.chunk(chunks)
+
+
+def test_pack_unpack_and_lazy_units():
+    data = _swe({"day": 100})
+    packed = compact(data, "int16")
+    assert packed.dtype == np.int16 and is_packed(packed)
+    assert packed.attrs["units"] == "mm" and packed.chunks == data.chunks
+    assert packed.values[5, 1, 1] == FILL
+
+    decoded = unpack(packed)
+    assert decoded.dtype == np.float32 and decoded.attrs == {"units": "mm"}
+    np.testing.assert_allclose(decoded.values, data.values, atol=0.25)
+    assert np.isnan(decoded.values[5, 1, 1])
+
+    # units are converted in the consumer, lazily and in float32
+    inches = to_units(packed, "in")
+    assert inches.attrs["units"] == "in" and inches.dtype == np.float32
+    assert inches.chunks == data.chunks
+    np.testing.assert_allclose(inches.values, data.values * MM_TO_IN, atol=0.25 * MM_TO_IN)
+    with pytest.raises(ValueError):
+        to_units(data, "K")
+
+    assert compact(data.astype(np.float64), "float32").dtype == np.float32
+    with pytest.raises(ValueError):
+        compact(data * 100, "int16", scale=0.5).compute()
+
+    both = compact(xr.Dataset({"snow": data, "snow2": data}), "int16")
+    assert all(both[name].dtype == np.int16 for name in both.data_vars)
+
+
+def test_packed_reductions_match_float():
+    data = _swe()
+    packed = compact(data, "int16")
+    quantized = unpack(packed)
+
+    # the kernels unpack block by block and accumulate in float64
+    stats = water_year_stats(packed.chunk({"day": 200}), thresholds=[100.0]).compute()
+    expected = water_year_stats(quantized.astype(np.float64), thresholds=[100.0])
+    xr.testing.assert_allclose(stats, expected)
+    peaks = water_year_metrics(packed).peak
+    np.testing.assert_allclose(peaks, water_year_metrics(data).peak, atol=0.25)
+
+    # point extraction keeps the packing, basin extraction decodes
+    j, k = [0, 3], [2, 6]
+    sites = extract_sites(packed, j, k)
+    assert sites.dtype == np.int16 and is_packed(sites)
+    np.testing.assert_array_equal(unpack(sites).values, extract_sites(quantized, j, k).values)
+    lat, lon = np.meshgrid(np.arange(6.0), np.arange(7.0), indexing="ij")
+    basin = box(0.5, 0.5, 4.5, 3.5)
+    cells = extract_basin(basin, lat, lon, packed)
+    assert cells.dtype == np.float32 and not is_packed(cells)
+    np.testing.assert_array_equal(cells.values, extract_basin(basin, lat, lon, quantized).values)
+
+
+def test_compact_stores(tmp_path):
+    data = _swe({"day": 365})
+    for mode, atol in (("float32", 0), ("int16", 0.25)):
+        path = convert_dataarray(
+            data, str(tmp_path / f"{mode}.zarr"), time_chunk=365, tile=4, compact=mode
+        )
+        decoded = open_store(path, "snow")
+        assert decoded.dtype == np.float32
+        np.testing.assert_allclose(decoded.values, data.values, atol=atol)
+        raw = open_store(path, "snow", packed=True)
+        assert is_packed(raw) == (mode == "int16")
+    assert open_store(path, "snow", packed=True).dtype == np.int16
+
+    # float32 site stores, rebuilt when the dtype changes
+    snoteldir = tmp_path / "snotel"
+    os.makedirs(snoteldir)
+    days = pd.date_range("2000-01-01", periods=3)
+    pd.DataFrame({"SWE": [1.5, np.nan, 2.25]}, index=days).to_csv(snoteldir / "snotel1000.csv")
+    store = sitestore.build_snotel_store(str(snoteldir), str(tmp_path / "store"))
+    assert store.array("SWE").dtype == np.float64
+    store = sitestore.build_snotel_store(str(snoteldir), str(tmp_path / "store"), dtype="f4")
+    assert store.array("SWE").dtype == np.float32
+    assert store.values("SWE", units="mm").dtype == np.float32
+    np.testing.assert_allclose(store.values("SWE")[0], [1.5, np.nan, 2.25])
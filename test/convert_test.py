@@ -0,0 +1,98 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from fos import convert
+
+
+def test_convert_dataarray_resumes(tmp_path):
+    days = pd.date_range("2000-01-01", periods=50, freq="D")
+    data = xr.DataArray(
+        np.random.rand(50, 4, 5).astype("f4"),
+        dims=["day", "lat2d", "lon2d"],
+        coords={"day": days},
+        name="snow",
+    )
+    path = str(tmp_path / "snow_d02.zarr")
+    convert.convert_dataarray(data, path, time_chunk=20, tile=3, workers=2)
+    assert convert.store_complete(path)
+
+    # pretend the run died before the last block was written
+    progfile = os.path.join(path, convert.PROGRESS_FILE)
+    with open(progfile) as fh:
+        progress = json.load(fh)
+    progress.update(done=[0, 1], complete=False)
+    with open(progfile, "w") as fh:
+        json.dump(progress, fh)
+    assert not convert.store_complete(path)
+
+    convert.convert_dataarray(data, path, time_chunk=20, tile=3, workers=2)
+    stored = convert.open_store(path, "snow")
+    assert stored.chunks[0] == (20, 20, 10)
+    np.testing.assert_array_equal(stored.values, data.values)
+    assert (stored.day.values == days.values).all()
+
+
+def test_convert_dataarray_appends_new_files(tmp_path):
+    days = pd.date_range("2000-01-01", periods=70, freq="D")
+    data = xr.DataArray(
+        np.random.rand(70, 4, 5).astype("f4"),
+        dims=["day", "lat2d", "lon2d"],
+        coords={"day": days},
+        name="snow",
+    )
+    path = str(tmp_path / "snow_d02.zarr")
+    old = dict(files=["a.nc"], sizes=[1])
+    convert.convert_dataarray(data[:45], path, fingerprint=old, time_chunk=20, tile=3)
+    before = os.path.getmtime(os.path.join(path, "snow", "0.0.0"))
+
+    # a new trailing file only appends its days
+    new = dict(files=["a.nc", "b.nc"], sizes=[1, 1])
+    convert.convert_dataarray(data, path, fingerprint=new, time_chunk=20, tile=3)
+    assert convert.store_complete(path)
+    assert os.path.getmtime(os.path.join(path, "snow", "0.0.0")) == before
+    stored = convert.open_store(path, "snow")
+    np.testing.assert_array_equal(stored.values, data.values)
+    assert (stored.day.values == days.values).all()
+
+
+def test_stale_store_falls_back_to_the_files(tmp_path, monkeypatch):
+    import shutil
+
+    from fos import synthetic, util
+
+    tree = synthetic.make_fake_tree(tmp_path / "tree", scale="tiny")
+    monkeypatch.setattr(convert, "default_storedir", str(tmp_path / "stores"))
+    run = "cesm2_r11i1p1f1_historical_bc"
+    args = ("hist", run, "r11i1p1f1", os.path.join(tree["wrfdir"], run, "postprocess"))
+    convert.convert_run(tree["wrfdir"], "cesm2", "r11i1p1f1", experiments=["historical"])
+    assert convert.read_store(run, "snow", "d02", wrfdir=tree["wrfdir"]) is not None
+    # the store is one time chunk, the files one chunk per year
+    stored = util._wrfread_gcm(*args, "snow", "d02")
+    assert len(stored.chunks[0]) == 1
+
+    # the same files in another tree are not the store's sources
+    other = str(tmp_path / "other")
+    shutil.copytree(tree["wrfdir"], other)
+    assert convert.read_store(run, "snow", "d02", wrfdir=other) is None
+
+    # a replaced file makes the store stale, reads go back to the files
+    first = tree["files"][0]
+    ds = xr.open_dataset(first).load()
+    values = ds["snow"].values
+    ds["snow"] = ds["snow"] + 1
+    os.remove(first)
+    ds.to_netcdf(first)
+    assert convert.read_store(run, "snow", "d02", wrfdir=tree["wrfdir"]) is None
+    fresh = util._wrfread_gcm(*args, "snow", "d02")
+    assert len(fresh.chunks[0]) == len(tree["years_hist"])
+    np.testing.assert_allclose(fresh[: len(values)], values + 1, rtol=1e-6)
+    np.testing.assert_allclose(fresh[len(values):], stored[len(values):], rtol=1e-6)
+
+    # reconverting refreshes the store
+    convert.convert_run(tree["wrfdir"], "cesm2", "r11i1p1f1", experiments=["historical"])
+    again = convert.read_store(run, "snow", "d02", wrfdir=tree["wrfdir"])
+    np.testing.assert_allclose(again, fresh, rtol=1e-6)
@@ -0,0 +1,48 @@
+import os
+
+import geopandas as gpd
+import pandas as pd
+from shapely.geometry import box
+
+from fos import data, dirs
+
+
+def test_lazy_data_with_cached_huc_membership(tmp_path, monkeypatch):
+    snoteldir, projectdir = tmp_path / "snotel", tmp_path / "project"
+    os.makedirs(snoteldir)
+    os.makedirs(projectdir / "spatialdata")
+    monkeypatch.setattr(dirs, "snoteldir", str(snoteldir))
+    monkeypatch.setattr(dirs, "projectdir", str(projectdir))
+    monkeypatch.setattr(dirs, "cachedir", str(tmp_path / "cache"))
+    pd.DataFrame(
+        dict(
+            site_name=["a (1)", "b (2)", "c (3)"],
+            elev=[1000, 2000, 3000],
+            site_number=[1, 2, 3],
+            state=["CO", "AK", "WY"],
+            namestr=["a", "b", "c"],
+            startdt=["1980-01-01"] * 3,
+            lat=[39.5, 40.5, 43.5],
+            lon=[-106.5, -105.5, -108.5],
+        )
+    ).to_csv(snoteldir / "snotelmeta.csv", index=False)
+    for level, boxes in [("huc6", [(-107, 39, -105, 41), (-109, 43, -108, 44)]),
+                         ("huc8", [(-107, 39, -106, 40), (-106, 40, -105, 41), (-109, 43, -108, 44)])]:
+        gpd.GeoDataFrame(
+            dict(name=[f"{level}-{i}" for i in range(len(boxes))]),
+            geometry=[box(*b) for b in boxes],
+            crs="epsg:4326",
+        ).to_file(projectdir / "spatialdata" / f"{level}.shp")
+
+    data.reset()
+    assert data.in6s.to_dict() == {1: "huc6-0", 2: "huc6-0", 3: "huc6-1"}
+    assert data.in8s.to_dict() == {1: "huc8-0", 2: "huc8-1", 3: "huc8-2"}
+    assert len(data.snotel_no_ak) == 2
+
+    # a warm load comes from the cache and never opens the shapefiles
+    data.reset()
+    from fos.data import in8s
+
+    assert in8s.to_dict() == {1: "huc8-0", 2: "huc8-1", 3: "huc8-2"}
+    assert "huc6" not in data._loaded
+    data.reset()
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from fos import elevation
+
+
+def test_band_stats_match_broadcast_mask():
+    rng = np.random.default_rng(4)
+    lat2d, lon2d = np.meshgrid(np.linspace(36, 48, 12), np.linspace(-124, -106, 15), indexing="ij")
+    hgt = rng.uniform(500, 3500, lat2d.shape)
+    swe = rng.uniform(0, 50, (40,) + lat2d.shape)
+    swe[swe < 10] = 0
+    swe[:, 0, 0] = np.nan
+    area = rng.uniform(0.5, 1.5, lat2d.shape)
+    data = xr.DataArray(
+        swe, dims=("day", "lat2d", "lon2d"), coords={"day": pd.date_range("2000-01-01", periods=40)}
+    )
+
+    bands = elevation.ElevationBands(hgt, lat2d, lon2d, step=500, regions=["SW", "ALL"], area=area)
+    stats = bands.reduce(data.chunk({"day": 7}), threshold=0.0, time_chunk=7)
+    assert stats["mean"].dims == ("region", "band", "day")
+    stats = stats.compute()
+
+    # the broadcast-mask formulation from the elevation notebook, area weighted
+    edges = bands.edges
+    mask = (hgt >= edges[:-1, None, None]) & (hgt < edges[1:, None, None])
+    for region in ["SW", "ALL"]:
+        lat_min, lat_max, lon_min, lon_max = elevation.REGIONS[region]
+        inregion = (lat2d >= lat_min) & (lat2d <= lat_max) & (lon2d >= lon_min) & (lon2d <= lon_max)
+        m = mask & inregion
+        valid = np.isfinite(swe)
+        w = m[None] * area * valid[:, None]
+        total = np.nansum(np.where(valid, swe, 0)[:, None] * w, axis=(2, 3))
+        sel = stats.sel(region=region)
+        np.testing.assert_allclose(sel["sum"].values, total.T)
+        np.testing.assert_allclose(sel["area"].values, w.sum(axis=(2, 3)).T)
+        snow = np.nansum((swe > 0)[:, None] * w, axis=(2, 3))
+        np.testing.assert_allclose(sel["snow_fraction"].values, (snow / w.sum(axis=(2, 3))).T)
+
+    # a 2-D map reduces to (region, band)
+    peak = bands.reduce(data.max("day"))
+    assert peak["sum"].dims == ("region", "band")
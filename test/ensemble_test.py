@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from fos import ensemble
+
+
+def _write_run(wrfdir, run, fname, year, value):
+    d02 = wrfdir / run / "postprocess" / "d02"
+    d02.mkdir(parents=True, exist_ok=True)
+    days = pd.date_range(f"{year}-01-01", f"{year}-12-31")
+    xr.Dataset(
+        {"snow": (("day", "south_north", "west_east"), np.full((len(days), 3, 4), value, "f4"))},
+        coords={"day": days.strftime("%Y%m%d").astype(float)},
+    ).to_netcdf(d02 / f"snow.daily.{fname}_d02_{year}.nc")
+
+
+def test_open_ensemble_reports_failed_members(tmp_path):
+    wrfdir = tmp_path / "postprocess"
+    for i, model in enumerate(["cesm2", "mpi-esm1-2-lr"]):
+        _write_run(wrfdir, f"{model}_r1i1p1f1_historical_bc", f"{model}_hist_r1i1p1f1", 2013, i)
+        _write_run(wrfdir, f"{model}_r1i1p1f1_ssp370_bc", f"{model}_ssp370_r1i1p1f1", 2014, i + 10)
+    broken = wrfdir / "ukesm1-0-ll_r2i1p1f2_historical_bc" / "postprocess" / "d02"
+    broken.mkdir(parents=True)
+    (broken / "snow.daily.ukesm1-0-ll_hist_r2i1p1f2_d02_2013.nc").write_bytes(b"not netcdf")
+
+    members = ensemble.ensemble_members(str(wrfdir))
+    assert sorted(set(members.member)) == [
+        "cesm2_r1i1p1f1",
+        "mpi-esm1-2-lr_r1i1p1f1",
+        "ukesm1-0-ll_r2i1p1f2",
+    ]
+
+    ens, failed = ensemble.open_ensemble(str(wrfdir))
+    assert list(failed) == ["ukesm1-0-ll_r2i1p1f2"]
+    assert ens.snow.dims == ("member", "day", "lat2d", "lon2d")
+    assert ens.member.values.tolist() == ["cesm2_r1i1p1f1", "mpi-esm1-2-lr_r1i1p1f1"]
+    assert ens.model.values.tolist() == ["cesm2", "mpi-esm1-2-lr"]
+    # screen_times_wrf drops the month of the window end, December 2013
+    assert ens.snow.sizes["day"] == 365 * 2 - 31
+    assert "water_year" in ens.coords
+
+    def yearly(member):
+        return member.snow.groupby("day.year").mean(["day", "lat2d", "lon2d"])
+
+    with ensemble.local_scheduler(workers=2, memory_limit="1GiB") as client:
+        means, failed = ensemble.map_members(yearly, ens, client=client)
+    assert failed == {}
+    np.testing.assert_array_equal(means.values, [[0, 10], [1, 11]])
@@ -0,0 +1,60 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from fos import experiments, sitestore
+
+
+def test_run_experiments_resumes(tmp_path):
+    datadir = tmp_path / "wrfts"
+    datadir.mkdir()
+    rng = np.random.default_rng(3)
+    sites = pd.DataFrame({"site_number": [1, 2, 3], "site_name": ["A", "B", "C"]})
+    for name in sites.site_name:
+        point = np.abs(rng.normal(100, 30, 2000))
+        np.save(datadir / f"wrfpoint_{name}.npy", point)
+        np.save(datadir / f"wrfbasin_{name}.npy", 0.5 * point + rng.normal(0, 1, 2000))
+    store = str(tmp_path / "store")
+    sitestore.build_wrfts_store(str(datadir), sites, store)
+
+    exps = [
+        dict(
+            name="run",
+            forcing={"SNOTEL_SWE": (store, "wrfpoint")},
+            obs={"SWE": (store, "wrfbasin")},
+        )
+    ]
+    models = [("offset", {}), ("poly", {"degree": [1, 2]})]
+    periods = {"train": ("1980-09-01", "1983-08-31"), "test": ("1983-09-01", "1986-02-20")}
+    output = str(tmp_path / "results.parquet")
+    table, failures = experiments.run_experiments(
+        exps, models, periods, output=output, workers=1, site_chunk=2, units="in"
+    )
+    assert len(failures) == 0
+    assert list(table.columns) == experiments.COLUMNS
+    # 3 model configurations x 3 sites x 2 windows
+    assert len(table) == 18
+    poly = table[(table.model == "poly") & (table.window == "test")]
+    assert (poly.nse > 0.9).all()
+
+    parts = sorted(os.listdir(str(tmp_path / "results.parts")))
+    assert len(parts) == 6
+    os.remove(str(tmp_path / "results.parts" / parts[0]))
+    again, _ = experiments.run_experiments(
+        exps, models, periods, output=output, workers=2, site_chunk=2, units="in"
+    )
+    pd.testing.assert_frame_equal(again, table)
+
+    # a failing task is reported and written next to the table, not dropped silently
+    broken = dict(name="broken", forcing={"SNOTEL_SWE": (store, "nope")}, obs=exps[0]["obs"])
+    for workers in (1, 2):
+        partial, failures = experiments.run_experiments(
+            exps + [broken], models, periods, output=output, workers=workers, site_chunk=2
+        )
+        assert len(failures) == 6 and set(failures.experiment) == {"broken"}
+        assert failures.error.str.contains("nope").all()
+        assert sorted(failures.first_site.unique()) == [1, 3]
+        written = pd.read_csv(str(tmp_path / "results.failures.csv"))
+        assert len(written) == 6 and set(written.columns) == set(experiments.FAILURE_COLUMNS)
+        assert set(partial.experiment) == {"run"}
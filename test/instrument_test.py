@@ -0,0 +1,56 @@
+import json
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from click.testing import CliRunner
+
+from fos import instrument, util
+from fos.cli import cli
+
+
+def test_stages_counters_and_reports(tmp_path):
+    days = pd.date_range("2000-01-01", periods=400)
+    data = xr.DataArray(np.random.rand(400, 4, 5), dims=["day", "lat2d", "lon2d"])
+    data = data.assign_coords(day=days).chunk({"day": 100})
+
+    instrument.reset()
+    instrument.enable()
+    try:
+        with instrument.stage("analysis", model="test"):
+            screened = util.screen_times_wrf(data, [2000, 3, 1], [2000, 12, 31])
+            instrument.count("sites_read", 3)
+            screened.mean().compute()
+    finally:
+        instrument.disable()
+    util.screen_times_wrf(data, [2000, 3, 1], [2000, 12, 31])  # not recorded
+
+    report = instrument.report()
+    records = {r["stage"]: r for r in report["records"]}
+    assert set(records) == {"analysis", "screen_times_wrf"}
+    assert records["screen_times_wrf"]["parent"] == "analysis"
+    assert records["analysis"]["counters"] == {"sites_read": 3}
+    assert records["analysis"]["model"] == "test"
+    assert report["stages"]["screen_times_wrf"]["calls"] == 1
+    assert report["dask_tasks"] and report["peak_rss"] > 0
+
+    path = str(tmp_path / "report.jsonl")
+    instrument.write_report(path)
+    instrument.write_report(path)
+    with open(path) as fh:
+        lines = [json.loads(line) for line in fh]
+    assert [line["type"] for line in lines] == ["stage", "stage", "summary"] * 2
+    instrument.write_report(str(tmp_path / "report.json"))
+    with open(tmp_path / "report.json") as fh:
+        assert len(json.load(fh)["records"]) == 2
+    instrument.reset()
+
+    # the CLI wraps the subcommand in a stage
+    path = str(tmp_path / "cli.jsonl")
+    result = CliRunner().invoke(cli, ["--report", path, "cache", "stats"])
+    instrument.disable()
+    instrument.reset()
+    assert result.exit_code == 0, result.output
+    with open(path) as fh:
+        lines = [json.loads(line) for line in fh]
+    assert lines[0]["stage"] == "fos cache" and lines[-1]["type"] == "summary"
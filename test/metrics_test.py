@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from fos import metrics
+
+
+def _pair():
+    rng = np.random.default_rng(2)
+    dates = pd.date_range("2000-10-01", "2003-09-30")
+    doy = np.arange(len(dates)) % 365
+    obs = np.maximum(0, 50 * np.sin(np.pi * doy / 240))[None] + rng.uniform(0, 2, (3, len(dates)))
+    sim = 1.1 * np.roll(obs, 5, axis=1) + rng.normal(0, 1, obs.shape)
+    obs[0, 10:20] = np.nan
+    coords = {"site": [1, 2, 3], "date": dates}
+    return (
+        xr.DataArray(obs, dims=("site", "date"), coords=coords),
+        xr.DataArray(sim, dims=("site", "date"), coords=coords),
+    )
+
+
+def test_metrics_match_per_series_formulas():
+    obs, sim = _pair()
+    scores = metrics.skill(obs, sim)
+    for i in range(3):
+        o, s = obs.values[i], sim.values[i]
+        valid = np.isfinite(o) & np.isfinite(s)
+        o, s = o[valid], s[valid]
+        r = np.corrcoef(o, s)[0, 1]
+        alpha, beta = s.std() / o.std(), s.mean() / o.mean()
+        expected = dict(
+            nse=1 - ((s - o) ** 2).sum() / ((o - o.mean()) ** 2).sum(),
+            kge=1 - np.sqrt((r - 1) ** 2 + (alpha - 1) ** 2 + (beta - 1) ** 2),
+            r=r,
+            alpha=alpha,
+            beta=beta,
+            rmse=np.sqrt(((s - o) ** 2).mean()),
+            mae=np.abs(s - o).mean(),
+            bias=(s - o).mean(),
+        )
+        for name, value in expected.items():
+            np.testing.assert_allclose(scores[name].values[i], value, rtol=1e-10)
+
+    # dask-backed inputs stay lazy and give the same answer
+    lazy = metrics.skill(obs.chunk({"date": 100}), sim.chunk({"date": 100}))
+    assert lazy.nse.chunks is not None
+    xr.testing.assert_allclose(lazy.compute(), scores)
+
+    # a copy shifted by 5 days peaks 5 days late every water year
+    late = obs.copy(data=np.roll(obs.values, 5, axis=1))
+    np.testing.assert_allclose(metrics.peak_timing(obs, late).values, 5)
+    np.testing.assert_allclose(metrics.peak_timing(late, obs, absolute=False).values, -5)
+
+
+def test_streaming_matches_full():
+    obs, sim = _pair()
+    acc = metrics.SkillAccumulator()
+    for start in range(0, obs.sizes["date"], 200):
+        chunk = slice(start, start + 200)
+        acc.update(obs.isel(date=chunk), sim.isel(date=chunk))
+    xr.testing.assert_allclose(acc.result(), metrics.skill(obs, sim))
+
+
+def test_streaming_is_stable_with_a_large_offset():
+    obs, sim = _pair()
+    # a large constant offset: raw sums of squares would cancel catastrophically
+    obs, sim = obs + 1e8, sim + 1e8
+    acc = metrics.SkillAccumulator()
+    for start in range(0, obs.sizes["date"], 100):
+        chunk = slice(start, start + 100)
+        acc.update(obs.isel(date=chunk), sim.isel(date=chunk))
+    result = acc.result()
+    assert np.isfinite(result.r).all() and np.isfinite(result.alpha).all()
+    np.testing.assert_allclose(result.nse, metrics.nse(obs, sim), rtol=1e-6)
+    np.testing.assert_allclose(result.kge, metrics.kge(obs, sim), rtol=1e-6)
+    full = metrics.kge_components(obs, sim)
+    np.testing.assert_allclose(result.r, full.r, rtol=1e-6)
+    np.testing.assert_allclose(result.alpha, full.alpha, rtol=1e-6)
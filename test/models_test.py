@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from fos import models
+from fos import util
+from fos.util import make_time_lists, partition_dataframe
+
+TIME_PERIODS = {
+    "train": ("1990-01-01", "1991-12-31"),
+    "validation": ("1992-01-01", "1992-06-30"),
+    "test": ("1992-07-01", "1993-12-31"),
+}
+
+
+def _sites(nsite=4):
+    rng = np.random.default_rng(1)
+    dates = pd.date_range("1990-01-01", "1993-12-31")
+    forcing = np.abs(rng.normal(10, 5, (nsite, len(dates))))
+    obs = 0.8 * forcing + 0.01 * forcing**2 + rng.normal(0, 1, forcing.shape) + 2
+    forcing_ds = xr.Dataset(
+        {"SNOTEL_SWE": (("site", "date"), forcing)}, coords={"site": np.arange(nsite), "date": dates}
+    )
+    obs_ds = xr.Dataset({"SWE": (("site", "date"), obs)}, coords=forcing_ds.coords)
+    return forcing_ds, obs_ds
+
+
+def test_batched_models_match_per_site():
+    forcing, obs = _sites()
+    dates_lists = make_time_lists(TIME_PERIODS)
+    cases = [
+        ("value", models.snotel_value, {"vars": ["SWE"], "fvars": ["SNOTEL_SWE"]}),
+        ("offset", models.snotel_with_offset, {"vars": ["SWE"], "fvars": ["SNOTEL_SWE"]}),
+        ("mean", models.training_mean, {"vars": ["SWE"], "fvars": ["SNOTEL_SWE"]}),
+        ("linear", models.lin_reg, {"vars": ["SWE"], "fvars": ["SNOTEL_SWE"]}),
+        ("poly", models.poly_reg, {"vars": ["SWE"], "fvars": ["SNOTEL_SWE"], "degree": 3}),
+    ]
+    for kind, per_site, params in cases:
+        batched, _ = models.run_batched(kind, forcing, obs, dates_lists, params)
+        for site in forcing.site.values:
+            f = forcing.sel(site=site).to_dataframe()[["SNOTEL_SWE"]]
+            o = obs.sel(site=site).to_dataframe()[["SWE"]]
+            single, _ = per_site(
+                partition_dataframe(f, TIME_PERIODS),
+                partition_dataframe(o, TIME_PERIODS),
+                dates_lists,
+                params,
+            )
+            np.testing.assert_allclose(
+                batched.value.sel(site=site).values,
+                single.value.isel(site=0).values,
+                rtol=1e-7,
+                atol=1e-8,
+            )
+
+
+def test_fit_batched_skips_missing_days():
+    x = np.tile(np.arange(10.0), (2, 1))
+    y = 3 * x + 1
+    y[1, :3] = np.nan
+    params = models.fit_batched("linear", x, y)
+    np.testing.assert_allclose(params, [[1, 3], [1, 3]])
+    np.testing.assert_allclose(models.predict_batched("linear", params, x), 3 * x + 1)
+
+
+def test_model_output_layout_and_store(tmp_path):
+    forcing, obs = _sites()
+    dates_lists = make_time_lists(TIME_PERIODS)
+    out, _ = models.run_batched("linear", forcing, obs, dates_lists, {"vars": ["SWE"]})
+    assert out.value.dims == ("kind", "variable", "window", "site", "step")
+    assert out.sizes["step"] == len(dates_lists["train"])
+    test = util.model_output_window(out, "test").sel(variable="SWE", kind="obs")
+    np.testing.assert_array_equal(
+        test.values, obs.SWE.sel(date=dates_lists["test"]).transpose("site", "date").values
+    )
+    # padding past the end of the shorter windows stays NaN
+    validation = out.value.sel(window="validation").values
+    assert np.isnan(validation[..., len(dates_lists["validation"]) :]).all()
+
+    path = str(tmp_path / "out.zarr")
+    util.init_model_output_store(path, ["SWE"], dates_lists, forcing.site.values, site_chunk=2)
+    for start in (0, 2):
+        block = out.isel(site=slice(start, start + 2))
+        util.write_model_output(block, path, start)
+    stored = xr.open_zarr(path)
+    np.testing.assert_array_equal(stored.value.values, out.value.values)
+    np.testing.assert_array_equal(stored.date.values, out.date.values)
@@ -0,0 +1,175 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fos import convert, data, dirs, synthetic, util
+from fos.pipeline import Pipeline, Stage, fos_pipeline
+from fos.sitestore import WRF_START, site_name_key
+
+
+def test_pipeline_skips_up_to_date_and_recomputes_changed_partitions(tmp_path):
+    src, parts = tmp_path / "src.txt", tmp_path / "parts"
+    parts.mkdir()
+    src.write_text("1")
+    for name in ("a", "b"):
+        (parts / f"{name}.csv").write_text(name)
+    copy, merged, final = tmp_path / "copy.txt", tmp_path / "merged.json", tmp_path / "final.txt"
+    calls = []
+
+    def copy_src():
+        calls.append("copy")
+        copy.write_text(src.read_text())
+
+    def merge(changed):
+        calls.append(("merge", sorted(changed) if changed is not None else None))
+        table = json.loads(merged.read_text()) if merged.exists() else {}
+        for key in changed if changed is not None else os.listdir(parts):
+            table[key] = (parts / key).read_text()
+        merged.write_text(json.dumps(table))
+
+    def combine():
+        calls.append("final")
+        final.write_text(copy.read_text() + merged.read_text())
+
+    def partitions():
+        return {name: [str(parts / name)] for name in sorted(os.listdir(parts))}
+
+    stages = [
+        Stage(
+            "final",
+            combine,
+            inputs=[str(copy), str(merged)],
+            outputs=[str(final)],
+            deps=["copy", "merge"],
+        ),
+        Stage("copy", copy_src, inputs=[str(src)], outputs=[str(copy)]),
+        Stage("merge", merge, outputs=[str(merged)], partitions=partitions),
+    ]
+    workdir = str(tmp_path / "work")
+    records = Pipeline(stages, workdir).run(workers=2, log=lambda msg: None)
+    assert {r["status"] for r in records.values()} == {"done"}
+    assert calls[-1] == "final" and ("merge", None) in calls and "copy" in calls
+
+    # nothing changed: everything is skipped, also from a fresh manifest read
+    calls.clear()
+    records = Pipeline(stages, workdir).run(log=lambda msg: None)
+    assert calls == []
+    assert {r["status"] for r in records.values()} == {"skipped"}
+
+    # a new partition only recomputes that partition, and the stages downstream
+    (parts / "c.csv").write_text("c")
+    records = Pipeline(stages, workdir).run(log=lambda msg: None)
+    assert calls == [("merge", ["c.csv"]), "final"]
+    assert records["copy"]["status"] == "skipped"
+    assert json.loads(merged.read_text()) == {"a.csv": "a", "b.csv": "b", "c.csv": "c"}
+
+    # a failing stage blocks its dependents and is retried on the next run
+    def broken():
+        raise RuntimeError("boom")
+
+    stages[1] = Stage("copy", broken, inputs=[str(src)], outputs=[str(copy)])
+    src.write_text("2")
+    os.utime(src, ns=(0, os.stat(copy).st_mtime_ns + 10**9))
+    records = Pipeline(stages, workdir).run(log=lambda msg: None)
+    assert records["copy"]["status"] == "failed"
+    assert records["final"]["status"] == "blocked"
+
+    with open(os.path.join(workdir, "runs.jsonl")) as fh:
+        assert len(fh.readlines()) == 4
+    with open(os.path.join(workdir, "manifest.json")) as fh:
+        manifest = json.load(fh)
+    assert set(manifest["stages"]["merge"]["partitions"]) == {"a.csv", "b.csv", "c.csv"}
+
+
+def test_fos_pipeline_new_year_file_reaches_site_metrics(tmp_path, monkeypatch):
+    tree = synthetic.make_fake_tree(
+        tmp_path / "tree", scale="tiny", models=(("ukesm1-0-ll", "r2i1p1f2"),)
+    )
+    monkeypatch.setattr(dirs, "snoteldir", tree["snoteldir"])
+    monkeypatch.setattr(dirs, "projectdir", tree["projectdir"])
+    monkeypatch.setattr(dirs, "cachedir", str(tmp_path / "cache"))
+    data.reset()
+    # hold back the last ssp370 year, it shows up between the runs
+    newest = tree["files"][-1]
+    held = str(tmp_path / os.path.basename(newest))
+    os.replace(newest, held)
+
+    datadir = str(tmp_path / "wrfts")
+    config = dict(
+        workdir=str(tmp_path / "work"),
+        wrfdir=tree["wrfdir"],
+        convert=[dict(model="ukesm1-0-ll", variant="r2i1p1f2")],
+        snoteldir=tree["snoteldir"],
+        wrfts={"ukesm1-0-ll_bc": datadir},
+        extract={
+            "ukesm1-0-ll_bc": dict(
+                model="ukesm1-0-ll", variant="r2i1p1f2", coorddir=tree["coorddir"]
+            )
+        },
+        site_metrics="ukesm1-0-ll_bc",
+    )
+    pipeline = fos_pipeline(config)
+    assert pipeline.stages["extract:ukesm1-0-ll_bc"].deps == ["convert:ukesm1-0-ll_r2i1p1f2_snow"]
+    assert pipeline.stages["wrfts-store:ukesm1-0-ll_bc"].deps == ["extract:ukesm1-0-ll_bc"]
+    records = pipeline.run(log=lambda msg: None)
+    assert {r["status"] for r in records.values()} == {"done"}, records
+
+    # the point series is the converted store at the site's cell, NaN before it begins
+    sites = data.snotel_no_ak
+    j, k, _ = util.get_grid_locator(tree["coorddir"]).query_gdf(sites, elev_col="elev")
+    stores = pipeline.stages["convert:ukesm1-0-ll_r2i1p1f2_snow"].outputs
+    swe = np.concatenate([convert.open_store(p, "snow")[:, j[0], k[0]].values for p in stores])
+    series = os.path.join(datadir, f"wrfpoint_{site_name_key(sites.site_name.iloc[0])}.npy")
+    point = np.load(series)
+    first = (pd.Timestamp(f"{tree['years_hist'][0]}-01-01") - WRF_START).days
+    assert np.isnan(point[:first]).all()
+    np.testing.assert_allclose(point[first:], swe, rtol=1e-6)
+
+    records = fos_pipeline(config).run(log=lambda msg: None)
+    assert {name for name, r in records.items() if r["status"] != "skipped"} == {"catalog"}
+
+    # a new ssp370 year file: convert, extract and every stage downstream rerun
+    os.replace(held, newest)
+    os.utime(newest)
+    records = fos_pipeline(config).run(log=lambda msg: None)
+    assert {name for name, r in records.items() if r["status"] == "done"} == {
+        "catalog",
+        "convert:ukesm1-0-ll_r2i1p1f2_snow",
+        "extract:ukesm1-0-ll_bc",
+        "wrfts-store:ukesm1-0-ll_bc",
+        "site-metrics",
+    }
+    assert records["site-metrics"]["changed"] == len(sites)
+    end = pd.Timestamp(f"{tree['years_future'][-1]}-12-31")
+    assert len(np.load(series)) == (end - WRF_START).days + 1
+
+
+def test_fos_pipeline_config_errors(tmp_path):
+    config = dict(workdir=str(tmp_path), snoteldir=str(tmp_path), wrfts={"a_bc": str(tmp_path)})
+    with pytest.raises(ValueError, match="wrfts"):
+        fos_pipeline(dict(config, site_metrics="b_bc"))
+    with pytest.raises(ValueError, match="snoteldir"):
+        fos_pipeline(dict(config, site_metrics="a_bc", snoteldir=None))
+    with pytest.raises(ValueError, match="convert"):
+        fos_pipeline(dict(config, extract={"a_bc": dict(model="m", variant="v", coorddir=".")}))
+
+
+def test_failed_stage_reruns_despite_its_outputs(tmp_path):
+    out = tmp_path / "out.txt"
+    attempts = []
+
+    def partial():
+        attempts.append(len(attempts))
+        out.write_text("partial")
+        if len(attempts) == 1:
+            raise RuntimeError("2 tasks failed")
+
+    stages = [Stage("write", partial, outputs=[str(out)])]
+    workdir = str(tmp_path / "work")
+    assert Pipeline(stages, workdir).run(log=lambda msg: None)["write"]["status"] == "failed"
+    record = Pipeline(stages, workdir).run(log=lambda msg: None)["write"]
+    assert record["status"] == "done" and record["reason"] == "failed last run"
+    assert Pipeline(stages, workdir).run(log=lambda msg: None)["write"]["status"] == "skipped"
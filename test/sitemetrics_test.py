@@ -0,0 +1,51 @@
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from fos import synthetic, util
+from fos.sitemetrics import build_site_metrics, read_site_metrics
+
+
+def test_build_site_metrics_matches_create_wrf_df(tmp_path, monkeypatch):
+    tree = synthetic.make_fake_tree(
+        tmp_path / "tree", scale="tiny", models=(("ukesm1-0-ll", "r2i1p1f2"),)
+    )
+    meta = pd.read_csv(os.path.join(tree["snoteldir"], "snotelmeta.csv"))
+    missing, corrupt = meta.site_number.iloc[-2:]
+    os.remove(os.path.join(tree["snoteldir"], f"snotel{missing}.csv"))
+    with open(os.path.join(tree["snoteldir"], f"snotel{corrupt}.csv"), "w") as fh:
+        fh.write("not a,snotel file\n1,2\n")
+
+    output = str(tmp_path / "metrics.parquet")
+    table, failures = build_site_metrics(
+        meta,
+        datadir=tree["wrfts"]["ukesm1-0-ll"],
+        snoteldir=tree["snoteldir"],
+        output=output,
+        workers=2,
+    )
+    # the bad sites are reported, every other site is in the table
+    written = pd.read_csv(str(tmp_path / "metrics.failures.csv"))
+    assert sorted(written.site_number) == sorted([missing, corrupt])
+    assert written.error.str.contains("FileNotFoundError").sum() == 1
+    assert sorted(failures.site_number) == sorted(written.site_number)
+    assert set(table.site_number) == set(meta.site_number) - {missing, corrupt}
+    assert len(read_site_metrics(output)) == len(table)
+
+    # the same peaks as the serial notebook path
+    monkeypatch.setattr(util, "projectdir", tree["projectdir"])
+    gdf = gpd.GeoDataFrame(meta, geometry=gpd.points_from_xy(meta.lon, meta.lat))
+    expected = util.create_wrf_df(gdf.iloc[:3])
+    assert len(expected) == 3
+    for i, entry in expected.iterrows():
+        site = meta.site_number.iloc[i]
+        for source, key in (("wrfpoint", "wpt"), ("wrfbasin", "wbas"), ("snotel", "sm")):
+            rows = table[(table.site_number == site) & (table.source == source)]
+            peaks = entry[key]
+            assert len(peaks) > 0
+            assert rows.water_year.tolist() == peaks.index.tolist()
+            np.testing.assert_allclose(rows.maxval, peaks.maxval)
+            assert rows.maxarg.tolist() == peaks.maxarg.tolist()
+            assert pd.DatetimeIndex(rows.maxdate).date.tolist() == peaks.maxdate.tolist()
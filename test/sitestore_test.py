@@ -0,0 +1,120 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fos import sitestore
+
+
+def _write_csv(snoteldir, site, start, values):
+    dates = pd.date_range(start, periods=len(values))
+    path = os.path.join(snoteldir, f"snotel{site}.csv")
+    pd.DataFrame({"SWE": values}, index=dates).to_csv(path)
+    return path
+
+
+def test_snotel_store_refresh(tmp_path):
+    snoteldir, path = str(tmp_path / "snotel"), str(tmp_path / "store")
+    os.makedirs(snoteldir)
+    _write_csv(snoteldir, 1000, "2000-01-01", [1.0, 2.0, 3.0])
+    _write_csv(snoteldir, 1001, "2000-01-02", [4.0, np.nan])
+    _write_csv(snoteldir, 1002, "2000-01-01", [5.0])
+
+    store = sitestore.build_snotel_store(snoteldir, path)
+    assert store.sites.tolist() == [1000, 1001, 1002]
+    assert store.units("SWE") == "in"
+    np.testing.assert_array_equal(
+        store.values("SWE"),
+        [[1.0, 2.0, 3.0], [np.nan, 4.0, np.nan], [5.0, np.nan, np.nan]],
+    )
+    # contiguous subsets are views of the memory map
+    sub = store.values("SWE", sites=[1000, 1001], start="2000-01-02")
+    assert np.shares_memory(sub, store.array("SWE"))
+    np.testing.assert_array_equal(sub, [[2.0, 3.0], [4.0, np.nan]])
+    assert store.series("SWE", 1001).index[0] == pd.Timestamp("2000-01-01")
+
+    # only the touched csv is re-read, the range grows and the other rows are kept
+    mtime = os.stat(os.path.join(path, "SWE.npy")).st_mtime_ns
+    csv = _write_csv(snoteldir, 1002, "2000-01-01", [6.0, 7.0])
+    os.utime(csv, ns=(mtime + 10**9, mtime + 10**9))
+    store = sitestore.build_snotel_store(snoteldir, path)
+    np.testing.assert_array_equal(store.values("SWE", sites=[1002]), [[6.0, 7.0, np.nan]])
+    _write_csv(snoteldir, 1003, "2000-01-04", [8.0])
+    store = sitestore.build_snotel_store(snoteldir, path)
+    assert store.ndays == 4
+    np.testing.assert_array_equal(
+        store.to_xarray("SWE", sites=[1000, 1003]).values,
+        [[1.0, 2.0, 3.0, np.nan], [np.nan, np.nan, np.nan, 8.0]],
+    )
+
+
+def test_wrfts_store_units(tmp_path):
+    datadir, path = str(tmp_path / "wrfts"), str(tmp_path / "store")
+    os.makedirs(datadir)
+    sites = pd.DataFrame({"site_number": [7, 3], "site_name": ["Big (Hill)", "Missing"]})
+    for source, scale in [("wrfpoint", 1.0), ("wrfbasin", 2.0)]:
+        np.save(os.path.join(datadir, f"{source}_BigHill.npy"), scale * np.arange(4.0))
+
+    store = sitestore.build_wrfts_store(datadir, sites, path)
+    assert store.sites.tolist() == [7]
+    assert 7 in store and np.int64(7) in store and 3 not in store
+    assert store.start == pd.Timestamp(sitestore.WRF_START)
+    assert store.units("wrfbasin") == "mm"
+    assert np.shares_memory(store.values("wrfbasin", sites=[7]), store.array("wrfbasin"))
+    np.testing.assert_allclose(
+        store.series("wrfbasin", 7, units="in").values, 2 * np.arange(4.0) * sitestore.MM_TO_IN
+    )
+    lazy = store.to_xarray("wrfpoint", start="1980-09-02", units="in")
+    assert lazy.attrs["units"] == "in" and lazy.chunks is not None
+    np.testing.assert_allclose(lazy.values, [np.arange(1.0, 4.0) * sitestore.MM_TO_IN])
+
+
+def test_stores_without_inputs(tmp_path):
+    empty = str(tmp_path / "empty")
+    os.makedirs(empty)
+    with pytest.raises(FileNotFoundError, match="empty"):
+        sitestore.build_snotel_store(empty, str(tmp_path / "snotel"))
+    sites = pd.DataFrame({"site_number": [7], "site_name": ["Big Hill"]})
+    with pytest.raises(FileNotFoundError, match="empty"):
+        sitestore.build_wrfts_store(empty, sites, str(tmp_path / "wrfts"))
+    # files without any dated row
+    pd.DataFrame({"SWE": []}, index=pd.DatetimeIndex([])).to_csv(f"{empty}/snotel1.csv")
+    with pytest.raises(ValueError, match="No dated values"):
+        sitestore.build_snotel_store(empty, str(tmp_path / "snotel"))
+    assert not os.path.exists(tmp_path / "snotel")
+
+
+def test_extract_wrfts_reduces_once(tmp_path, monkeypatch):
+    from fos import convert, data, dirs, synthetic
+    from fos.zonal import BasinWeights
+
+    tree = synthetic.make_fake_tree(tmp_path / "tree", scale="tiny")
+    monkeypatch.setattr(dirs, "snoteldir", tree["snoteldir"])
+    monkeypatch.setattr(dirs, "projectdir", tree["projectdir"])
+    monkeypatch.setattr(dirs, "cachedir", str(tmp_path / "cache"))
+    data.reset()
+    stores = convert.convert_run(tree["wrfdir"], "cesm2", "r11i1p1f1", storedir=str(tmp_path))
+    field = [convert.open_store(path, "snow") for path in stores]
+    ndays = sum(f.sizes["day"] for f in field)
+
+    calls = []
+    kernel = BasinWeights._kernel
+
+    def counted(self, block):
+        calls.append(block.shape[0])
+        return kernel(self, block)
+
+    monkeypatch.setattr(BasinWeights, "_kernel", counted)
+    datadir = str(tmp_path / "wrfts")
+    written = sitestore.extract_wrfts(field, data.snotel_no_ak, datadir, tree["coorddir"])
+    assert len(written) == 2 * len(data.snotel_no_ak)
+    # every day goes through the basin reduction once, whatever the number of sites
+    assert sum(calls) == ndays
+
+    # the basin series is the mean of the site's HUC6 from the same reduction
+    key = sitestore.site_name_key(data.snotel_no_ak.site_name.iloc[0])
+    basin = np.load(os.path.join(datadir, f"wrfbasin_{key}.npy"))
+    assert np.isfinite(basin[-ndays:]).all() and np.isnan(basin[:-ndays]).all()
+    # unchanged values are not rewritten
+    assert sitestore.extract_wrfts(field, data.snotel_no_ak, datadir, tree["coorddir"]) == []
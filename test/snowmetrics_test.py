@@ -0,0 +1,85 @@
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from fos.snowmetrics import (
+    _block_metrics,
+    water_year_metrics,
+    water_year_stats,
+    write_water_year_stats,
+)
+from fos.timeaxis import day_of_water_year, water_year
+
+
+def test_water_year_metrics_gridded_dask_matches_numpy():
+    days = pd.date_range("1999-10-01", "2004-09-30", freq="D")
+    season = np.clip(np.sin((days.dayofyear.values - 300) / 365 * 2 * np.pi), 0, None)
+    values = season[:, None, None] * np.random.default_rng(0).uniform(50, 500, (1, 3, 4))
+    data = xr.DataArray(values, dims=["day", "lat2d", "lon2d"], coords={"day": days})
+
+    eager = water_year_metrics(data, threshold=1.0)
+    lazy = water_year_metrics(data.chunk({"day": 400, "lat2d": 2}), threshold=1.0, years_per_chunk=2)
+    assert lazy.peak.chunks is not None
+    xr.testing.assert_identical(eager, lazy.compute())
+    assert eager.peak.dims == ("lat2d", "lon2d", "water_year")
+    assert eager.water_year.values.tolist() == [2000, 2001, 2002, 2003, 2004]
+
+    # check one series against a direct per-year computation
+    series = data.isel(lat2d=1, lon2d=2).to_series()
+    wy = series[(series.index >= "2001-10-01") & (series.index < "2002-10-01")]
+    got = eager.isel(lat2d=1, lon2d=2).sel(water_year=2002)
+    assert got.peak == wy.max()
+    assert pd.Timestamp(got.peak_date.values) == wy.idxmax()
+    assert pd.Timestamp(got.onset_date.values) == wy[wy > 1.0].index[0]
+    after = wy[wy.index > wy.idxmax()]
+    assert pd.Timestamp(got.meltout_date.values) == after[after <= 1.0].index[0]
+    assert got.snow_days == (wy > 1.0).sum()
+
+
+def test_water_year_stats_match_per_year_loop(tmp_path):
+    days = pd.date_range("2000-09-01", "2004-12-31", freq="D")
+    values = np.random.default_rng(1).uniform(0, 10, (len(days), 3, 4))
+    values[:100, 0, 0] = np.nan
+    data = xr.DataArray(values, dims=["day", "lat2d", "lon2d"], coords={"day": days})
+
+    eager = water_year_stats(data, thresholds=[2, 5])
+    lazy = water_year_stats(
+        data.chunk({"day": 200, "lat2d": 2}), thresholds=[2, 5], years_per_chunk=2
+    )
+    xr.testing.assert_allclose(eager, lazy.compute())
+
+    # the notebook formulation: (da < threshold).sum('day') per water year
+    for year in eager.water_year.values:
+        wy = data.sel(day=slice(f"{year - 1}-10-01", f"{year}-09-30"))
+        got = eager.sel(water_year=year)
+        np.testing.assert_array_equal(got.days_below.sel(threshold=5), (wy < 5).sum("day"))
+        np.testing.assert_array_equal(got.days_above.sel(threshold=2), (wy > 2).sum("day"))
+        np.testing.assert_allclose(got["mean"], wy.mean("day"))
+        np.testing.assert_allclose(got["max"], wy.max("day"))
+
+    path = str(tmp_path / "wy.zarr")
+    write_water_year_stats(data.chunk({"day": 400}), path, thresholds=[5])
+    xr.testing.assert_allclose(xr.open_zarr(path).load(), water_year_stats(data, thresholds=[5]))
+
+
+def test_water_year_metrics_blocks_are_bounded():
+    days = pd.date_range("1999-10-01", "2009-09-30", freq="D")
+    values = np.random.default_rng(2).uniform(0, 100, (len(days), 40, 30)).astype(np.float32)
+    data = xr.DataArray(values, dims=["day", "lat2d", "lon2d"], coords={"day": days})
+
+    # one full-grid chunk is split so a float64 block stays within the budget
+    budget = 2**20
+    lazy = water_year_metrics(data.chunk({"day": -1}), threshold=1.0, block_bytes=budget)
+    series = [a * b for a in lazy.peak.chunks[0] for b in lazy.peak.chunks[1]]
+    assert max(series) * 3653 * 8 <= budget and len(lazy.peak.chunks[0]) > 1
+    xr.testing.assert_identical(lazy.compute(), water_year_metrics(data, threshold=1.0))
+
+    # the kernel works one water year at a time: its peak is not a multiple of the block
+    block = values.reshape(len(days), -1).T
+    tracemalloc.start()
+    _block_metrics(block, water_year(days), day_of_water_year(days), 1.0)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert peak < 2 * block.nbytes
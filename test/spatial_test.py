@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from fos import spatial, util
+
+
+def _grid():
+    lat2d, lon2d = np.meshgrid(np.linspace(35, 49, 30), np.linspace(-125, -105, 40), indexing="ij")
+    # make it curvilinear like the WRF grid
+    return lat2d + 0.1 * np.sin(lon2d), lon2d + 0.1 * np.cos(lat2d)
+
+
+def test_locator_matches_brute_force():
+    lat2d, lon2d = _grid()
+    rng = np.random.default_rng(0)
+    lats, lons = rng.uniform(36, 48, 50), rng.uniform(-124, -106, 50)
+    j, k, _ = spatial.GridLocator(lat2d, lon2d).query(lats, lons)
+    for lat, lon, jj, kk in zip(lats, lons, j, k):
+        dis = np.sqrt((lat2d - lat) ** 2 + (lon2d - lon) ** 2)
+        assert (jj, kk) == np.unravel_index(dis.argmin(), dis.shape)
+
+    # elevation-aware picks never do worse on elevation than the nearest cell
+    hgt = rng.uniform(0, 3000, lat2d.shape)
+    locator = spatial.GridLocator(lat2d, lon2d, hgt, great_circle=True)
+    jn, kn, dist = locator.query(lats, lons)
+    je, ke, _ = locator.query(lats, lons, elev=np.full(50, 1500.0))
+    assert np.all(np.abs(hgt[je, ke] - 1500) <= np.abs(hgt[jn, kn] - 1500))
+    assert dist.max() < 50  # km
+
+
+def test_get_wrf_data_points_batched():
+    days = pd.date_range("2000-01-01", periods=30)
+    wrfdata = [
+        xr.DataArray(
+            np.random.rand(15, 6, 7), dims=["day", "lat2d", "lon2d"], coords={"day": d}
+        ).chunk({"day": 10})
+        for d in (days[:15], days[15:])
+    ]
+    j, k = np.array([0, 3, 5]), np.array([6, 2, 0])
+    batched = util.get_wrf_data_points(wrfdata, j, k)
+    assert batched.shape == (3, 30)
+    for i in range(3):
+        np.testing.assert_array_equal(batched[i], util.get_wrf_data_points(wrfdata, j[i], k[i]))
+
+
+def test_get_wrf_from_shp_matches_full_domain_compute():
+    import geopandas as gpd
+    from shapely.geometry import Point, Polygon
+
+    lat2d, lon2d = _grid()
+    data = xr.DataArray(
+        np.random.rand(20, *lat2d.shape), dims=["day", "lat2d", "lon2d"]
+    ).chunk({"day": 7})
+    basin = gpd.GeoDataFrame(
+        geometry=[Polygon([(-120, 38), (-112, 37), (-110, 44), (-118, 45)])], crs="epsg:4326"
+    )
+    lon, lat, got = util.get_wrf_from_shp(basin, lat2d, lon2d, data, time_chunk=6)
+
+    # the original implementation: whole-domain compute then per-point contains
+    bounds = basin.bounds.values.flatten()
+    bboxmask = (lat2d > bounds[1]) & (lat2d < bounds[3]) & (lon2d > bounds[0]) & (lon2d < bounds[2])
+    polygon = basin.geometry.values[0]
+    inmask = np.array([polygon.contains(Point(x, y)) for x, y in zip(lon2d[bboxmask], lat2d[bboxmask])])
+    expected = data.values[:, bboxmask]
+    expected[:, ~inmask] = np.nan
+    np.testing.assert_array_equal(got, expected)
+    np.testing.assert_array_equal(lon, lon2d[bboxmask])
+
+    cells = spatial.extract_basin(basin, lat2d, lon2d, data)
+    assert cells.dims == ("cell", "day")
+    np.testing.assert_array_equal(cells.values, expected[:, inmask].T)
+
+
+def test_subset_window_and_reader_pushdown(tmp_path):
+    import os
+
+    from shapely.geometry import Point, Polygon
+
+    lat2d, lon2d = _grid()
+    rows, cols = spatial.subset_window(lat2d, lon2d, "SW")
+    mask = spatial.region_mask(lat2d, lon2d, "SW")
+    assert mask[rows, cols].sum() == mask.sum()
+    box = spatial.subset_window(lat2d, lon2d, (35.0, 42.0, -121.0, -114.0))
+    assert box == (rows, cols)
+
+    basin = Polygon([(-120, 38), (-112, 37), (-110, 44), (-118, 45)])
+    window, bboxmask, _ = spatial.basin_cells(basin, lat2d, lon2d)
+    brows, bcols = spatial.subset_window(lat2d, lon2d, basin)
+    assert brows.start <= window[0].start and bcols.stop >= window[1].stop
+    points = [Point(-124, 36), Point(-106, 48)]
+    j, k, _ = spatial.GridLocator(lat2d, lon2d).query([36, 48], [-124, -106])
+    prows, pcols = spatial.subset_window(lat2d, lon2d, points, pad=1)
+    assert prows == slice(max(j.min() - 1, 0), min(j.max() + 2, lat2d.shape[0]))
+    assert pcols == slice(max(k.min() - 1, 0), min(k.max() + 2, lat2d.shape[1]))
+
+    # a fake postprocess tree and wrfinput file, read with and without the subset
+    wrfdir = tmp_path / "postprocess"
+    run = "cesm2_r11i1p1f1_historical_bc"
+    d02 = wrfdir / run / "postprocess" / "d02"
+    d02.mkdir(parents=True)
+    full = []
+    for year in (2000, 2001):
+        days = pd.date_range(f"{year}-01-01", f"{year}-12-31")
+        values = np.random.rand(len(days), *lat2d.shape).astype("f4")
+        full.append(values)
+        xr.Dataset(
+            {"snow": (("day", "south_north", "west_east"), values)},
+            coords={"day": days.strftime("%Y%m%d").astype(float)},
+        ).to_netcdf(d02 / f"snow.daily.cesm2_hist_r11i1p1f1_d02_{year}.nc")
+    coorddir = wrfdir / "WRF-data" / "wrf_coordinates"
+    coorddir.mkdir(parents=True)
+    xr.Dataset(
+        {
+            name: (("Time", "south_north", "west_east"), field[None])
+            for name, field in dict(XLAT=lat2d, XLONG=lon2d, HGT=lat2d * 0).items()
+        }
+    ).to_netcdf(coorddir / "wrfinput_d02")
+
+    datadir = os.path.join(wrfdir, run, "postprocess")
+    args = ("hist", run, "r11i1p1f1", datadir, "snow", "d02")
+    sub = util._wrfread_gcm(*args, use_store=False, subset="SW")
+    assert sub.shape == (len(sub.day), rows.stop - rows.start, cols.stop - cols.start)
+    np.testing.assert_array_equal(sub.values, np.concatenate(full)[:, rows, cols])
+    np.testing.assert_array_equal(sub.lat.values, lat2d[rows, cols])
+    assert sub.j.values[0] == rows.start and sub.k.values[-1] == cols.stop - 1
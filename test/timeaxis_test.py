@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from fos import timeaxis, util
+
+
+def test_decode_day_with_invalid_days():
+    dates = timeaxis.decode_day(np.array([19800101.0, 19800230.0, 20001231.0]))
+    assert list(dates.strftime("%Y-%m-%d")) == ["1980-01-01", "1980-02-28", "2000-12-31"]
+    assert (timeaxis.decode_day(np.array([19991001])) == pd.Timestamp("1999-10-01")).all()
+
+
+def test_water_year_coords():
+    dates = pd.DatetimeIndex(["2001-09-30", "2001-10-01", "2002-02-01"])
+    assert timeaxis.water_year(dates).tolist() == [2001, 2002, 2002]
+    assert timeaxis.day_of_water_year(dates).tolist() == [364, 0, 123]
+
+
+def test_screen_times_wrf_matches_sequential_screen():
+    days = pd.date_range("1979-06-01", "2015-03-01", freq="D")
+    data = xr.DataArray(np.arange(len(days)), dims=["day"], coords={"day": days})
+    start, end = [1980, 1, 1], [2013, 12, 31]
+    expected = data
+    for drop in [
+        lambda d: (d.month < start[1]) & (d.year <= start[0]),
+        lambda d: d.year < start[0],
+        lambda d: (d.month >= end[1]) & (d.year >= end[0]),
+        lambda d: d.year > end[0],
+    ]:
+        expected = expected.sel(day=~drop(pd.to_datetime(expected.day)))
+    screened = util.screen_times_wrf(data, start, end)
+    assert (screened.values == expected.values).all()
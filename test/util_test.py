@@ -17,3 +17,76 @@ def test_gen_analysis_dataframe_for_something():
     assert coords.dimensions['lat'].size == wrfdata['var_wrf'].shape[1], "Coords dimensions are different from wrfdata coords"
     
     
+
+
+def test_read_wrf_vars_one_pass(tmp_path):
+    import numpy as np
+
+    from fos import synthetic
+    from fos.spatial import extract_basin, extract_sites
+
+    variables = ["snow", "prec", "t2"]
+    tree = synthetic.make_fake_tree(tmp_path / "tree", scale="tiny", variables=variables)
+    run = "cesm2_r11i1p1f1_historical_bc"
+    datadir = os.path.join(tree["wrfdir"], run, "postprocess")
+    args = ("hist", run, "r11i1p1f1", datadir)
+
+    data = util.read_wrf_vars(*args, variables, "d02", use_store=False)
+    assert list(data.data_vars) == variables
+    assert {"water_year", "dowy"} <= set(data.coords)
+    first = tree["years_hist"][0]
+    data = util.screen_times_wrf(data, [first, 3, 1], [first + 1, 6, 30])
+    single = {}
+    for var in variables:
+        field = util._wrfread_gcm(*args, var, "d02", use_store=False)
+        single[var] = util.screen_times_wrf(field, [first, 3, 1], [first + 1, 6, 30])
+        xr.testing.assert_equal(data[var], single[var])
+
+    # all variables per site and per basin in one pass
+    j, k = np.array([2, 5, 11]), np.array([3, 20, 7])
+    sites = extract_sites(data, j, k, time_chunk=100)
+    huc8 = gpd.read_file(os.path.join(tree["spatialdir"], "huc8.shp")).iloc[[5]]
+    lat, lon, _ = synthetic.make_grid(tree["shape"])
+    basin = extract_basin(huc8, lat, lon, data, time_chunk=100)
+    _, _, cells = util.get_wrf_from_shp(huc8, lat, lon, data)
+    for var in variables:
+        np.testing.assert_array_equal(sites[var].values, extract_sites(single[var], j, k).values)
+        np.testing.assert_array_equal(
+            basin[var].values, extract_basin(huc8, lat, lon, single[var]).values
+        )
+        np.testing.assert_array_equal(
+            cells[var], util.get_wrf_from_shp(huc8, lat, lon, single[var])[2]
+        )
+
+    # a subset is cropped once for every variable
+    sub = util.read_wrf_vars(*args, ["snow", "t2"], "d02", use_store=False, subset="SW")
+    assert {"j", "k", "lat", "lon"} <= set(sub.coords)
+    assert sub.snow.shape == sub.t2.shape and sub.sizes["lat2d"] < tree["shape"][0]
+
+
+def test_elevation_bands_are_area_weighted(tmp_path):
+    import numpy as np
+
+    from fos import synthetic
+    from fos.spatial import region_mask
+    from fos.zonal import grid_cell_area
+
+    tree = synthetic.make_fake_tree(tmp_path / "tree", scale="tiny")
+    lat, lon, hgt = synthetic.make_grid(tree["shape"])
+    area = util.get_cell_area(tree["coorddir"])
+    with xr.open_dataset(os.path.join(tree["coorddir"], "wrfinput_d02")) as wrfinput:
+        mapfac = wrfinput.MAPFAC_M[0].values
+    np.testing.assert_allclose(area, 81.0 / mapfac**2)
+    # without MAPFAC_M: the cell polygons on the sphere, dlat x dlon x cos(lat) x R^2
+    dlat, dlon = np.deg2rad(14.0 / 19), np.deg2rad(20.0 / 24)
+    sphere = 6371.0**2 * dlat * dlon * np.cos(np.deg2rad(lat))
+    np.testing.assert_allclose(grid_cell_area(lat, lon).mean(), sphere.mean(), rtol=0.02)
+
+    bands = util.get_elevation_bands(tree["coorddir"], step=500.0, regions=("ALL",))
+    inside = region_mask(lat, lon, "ALL") & (bands.labels >= 0)
+    np.testing.assert_allclose(bands.weights.sum(), area[inside].sum())
+    swe = xr.DataArray(hgt[None], dims=("day", "lat2d", "lon2d"))
+    stats = bands.reduce(swe).isel(day=0)
+    band = inside & (bands.labels == 1)
+    expected = (hgt * area)[band].sum() / area[band].sum()
+    np.testing.assert_allclose(stats["mean"].sel(region="ALL", band=1), expected)
@@ -0,0 +1,96 @@
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from shapely.geometry import box
+
+from fos import synthetic
+from fos.compact import compact
+from fos.zonal import BasinWeights, basin_weights, cell_polygons
+
+
+def _grid():
+    # 1 degree cells centered on integers, lat 0..5, lon 0..7
+    lat, lon = np.meshgrid(np.arange(6.0), np.arange(8.0), indexing="ij")
+    return lat, lon
+
+
+def _swe(shape, chunks=None):
+    rng = np.random.default_rng(0)
+    days = pd.date_range("2000-10-01", periods=40)
+    values = rng.random((len(days), *shape)) * 500
+    values[3, 2, 2] = np.nan
+    data = xr.DataArray(
+        values, dims=("day", "lat2d", "lon2d"), coords={"day": days}, attrs={"units": "mm"}
+    )
+    return data if chunks is None else data.chunk(chunks)
+
+
+def test_fractional_overlap_means():
+    lat, lon = _grid()
+    cells = cell_polygons(lat, lon)
+    assert cells[0].equals(box(-0.5, -0.5, 0.5, 0.5))
+    # a: 2 x 2 whole cells, b: half of each of 3 cells, c: outside the grid
+    basins = gpd.GeoDataFrame(
+        {"name": ["a", "b", "c"]},
+        geometry=[box(1.5, 1.5, 3.5, 3.5), box(4.5, 0.5, 7.5, 1.0), box(20, 20, 21, 21)],
+        crs="epsg:4326",
+    )
+    weights = BasinWeights.build(basins, lat, lon)
+    assert weights.weights.shape == (3, lat.size)
+    np.testing.assert_allclose(weights.coverage[:2], [1.0, 1.0])
+    assert weights.coverage[2] == 0
+
+    data = _swe(lat.shape)
+    means = weights.reduce(data)
+    assert means.dims == ("basin", "day") and means.basin.values.tolist() == ["a", "b", "c"]
+    assert means.attrs == {"units": "mm"}
+    # the same cos(lat) for every cell of b, so its mean is the plain mean of its cells
+    np.testing.assert_allclose(means.sel(basin="b"), data[:, 1, 5:8].mean(["lon2d"]))
+    a = data[:, 2:4, 2:4]
+    area = xr.DataArray(np.cos(np.deg2rad(lat[2:4, 2:4])), dims=("lat2d", "lon2d"))
+    expected = (a * area).sum(["lat2d", "lon2d"]) / (area * a.notnull()).sum(["lat2d", "lon2d"])
+    np.testing.assert_allclose(means.sel(basin="a"), expected)
+    assert means.sel(basin="c").isnull().all()
+
+    # one sparse product per time chunk, packed and Dataset input
+    lazy = weights.reduce(_swe(lat.shape, {"day": 7}), time_chunk=10)
+    assert lazy.chunks == ((3,), (10, 10, 10, 10))
+    xr.testing.assert_allclose(lazy.compute(), means)
+    packed = weights.reduce(compact(data, "int16"))
+    np.testing.assert_allclose(packed, means, atol=0.25)
+    both = weights.reduce(xr.Dataset({"snow": data, "snow2": data * 2}))
+    xr.testing.assert_allclose(both.snow2, 2 * means.rename("snow2"))
+    peak = weights.reduce(data.max("day"))
+    assert peak.dims == ("basin",)
+    with pytest.raises(ValueError):
+        weights.reduce(data.isel(lat2d=slice(1, None)))
+
+
+def test_huc_weights_cached(tmp_path):
+    tree = synthetic.make_fake_tree(tmp_path / "tree", scale="tiny")
+    lat, lon, _ = synthetic.make_grid(tree["shape"])
+    huc6 = gpd.read_file(os.path.join(tree["spatialdir"], "huc6.shp"))
+    huc8 = gpd.read_file(os.path.join(tree["spatialdir"], "huc8.shp"))
+
+    w8 = basin_weights(huc8, lat, lon, cachedir=str(tmp_path))
+    files = os.listdir(tmp_path / "zonal")
+    assert len(files) == 1
+    again = basin_weights(huc8, lat, lon, cachedir=str(tmp_path))
+    assert (again.weights != w8.weights).nnz == 0
+    assert again.ids.tolist() == huc8.name.tolist()
+    basin_weights(huc8, lat + 0.01, lon, cachedir=str(tmp_path))
+    assert len(os.listdir(tmp_path / "zonal")) == 2
+
+    # overlap weights add up: each HUC6 mean is the area-weighted mean of its HUC8s
+    w6 = basin_weights(huc6, lat, lon, cachedir=str(tmp_path))
+    data = _swe(tree["shape"])
+    m6, m8 = w6.reduce(data), w8.reduce(data)
+    area8 = np.asarray(w8.weights.sum(axis=1)).ravel()
+    for i, name in enumerate(huc6.name):
+        inside = np.flatnonzero(huc8.huc8.str[:6] == huc6.huc6[i])
+        combined = (m8.isel(basin=inside) * area8[inside, None]).sum("basin") / area8[inside].sum()
+        np.testing.assert_allclose(m6.sel(basin=name).isel(day=[0, 1, 2]), combined[:3])